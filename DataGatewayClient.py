@@ -1,6 +1,8 @@
 import json
 import datetime
+from json.encoder import encode_basestring_ascii
 from libhttp import *
+from ReviewRecord import ReviewRecord
 
 
 class AggressiveEncoder(json.JSONEncoder):
@@ -9,11 +11,59 @@ class AggressiveEncoder(json.JSONEncoder):
             return o.isoformat(' ')
         elif isinstance(o, datetime.time) or isinstance(o, datetime.date):
             return o.isoformat()
+        elif hasattr(o, 'to_dict'):
+            return o.to_dict()
         elif hasattr(o, '__dict__'):
             return o.__dict__
         return json.JSONEncoder.default(self, o)
 
 
+_encode = AggressiveEncoder(encoding='utf-8').encode
+
+# Functions returning the JSON text of data pushed, by type of the data
+_encoders = {}
+
+
+def register_encoder(cls, encoder):
+    """ Makes pushes encode data of type cls as encoder(data) instead of through AggressiveEncoder.
+
+    encoder must return, as a str, JSON text equivalent to what AggressiveEncoder gives: it
+    decodes to the same value, but members may come in another order and with other whitespace.
+    Subclasses of cls are not affected.
+    """
+    _encoders[cls] = encoder
+
+
+def _encode_value(v):
+    """ Encodes v as AggressiveEncoder does, without going through it for strings, datetimes
+    and ints, which it builds a new C encoder for.
+    """
+    if isinstance(v, basestring):
+        return encode_basestring_ascii(v)
+    if isinstance(v, datetime.datetime):
+        return '"' + v.isoformat(' ') + '"'
+    if type(v) is int:
+        return str(v)
+    return _encode(v)
+
+
+def _encode_review_record(r):
+    return ''.join(('{"hotel_name":', _encode_value(r.hotel_name),
+                    ',"hotel_url":', _encode_value(r.hotel_url),
+                    ',"source_site":', _encode_value(r.source_site),
+                    ',"rate":', _encode_value(r.rate),
+                    ',"nick_name":', _encode_value(r.nick_name),
+                    ',"comment":', _encode_value(r.comment),
+                    ',"comment_date":', _encode_value(r.comment_date),
+                    ',"check_in_date":', _encode_value(r.check_in_date),
+                    ',"timestamp":', _encode_value(r.timestamp),
+                    ',"consume_detail":', _encode_value(r.consume_detail),
+                    '}'))
+
+
+register_encoder(ReviewRecord, _encode_review_record)
+
+
 class DataGatewayJSONRequest(object):
     def __init__(self, key, data, storage):
         self.key = key
@@ -21,13 +71,61 @@ class DataGatewayJSONRequest(object):
         self.storage = storage
 
     def getstr(self):
-        return json.dumps(self, cls=AggressiveEncoder, encoding='utf-8')
+        encoder = _encoders.get(type(self.data))
+        if encoder is None:
+            return json.dumps(self, cls=AggressiveEncoder, encoding='utf-8')
+        return ''.join(('{"key":', _encode_value(self.key), ',"data":', encoder(self.data),
+                        ',"storage":', _encode_value(self.storage), '}'))
+
+
+class DataGatewayBatchError(IOError):
+    """ Raised when a batch or pipelined push is interrupted by a connection failure.
+
+    The statuses attribute holds the per-record results collected so far, in which records that
+    have not been acknowledged by the gateway are marked as None.
+    """
+    def __init__(self, message, statuses):
+        IOError.__init__(self, message)
+        self.statuses = statuses
 
 
 class DataGatewayClient(object):
-    def __init__(self, address):
+    BATCH_SIZE = 100
+    BATCH_BYTES = 1024 * 1024
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = 60
+
+    def __init__(self, address, batch_size=BATCH_SIZE, batch_bytes=BATCH_BYTES, ndjson=False,
+                 pipeline=1, replays=1, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, timeout=None):
+        """
+        Args:
+            address: (host, port) of the gateway server.
+            batch_size: Maximum number of records carried by a batch request.
+            batch_bytes: Maximum body size of a batch request. A single record larger than this
+                is still sent, alone in its batch.
+            ndjson: Send batch bodies as newline delimited JSON instead of a JSON array.
+            pipeline: Maximum number of requests in flight on the connection. 1 disables
+                pipelining.
+            replays: Number of times requests left unanswered by a broken connection are
+                replayed on a new connection.
+            connect_timeout: Seconds connecting to the gateway may take, None for no limit.
+            read_timeout: Seconds the gateway may take to answer or to take a request, None
+                for no limit.
+            timeout: Seconds a push may take, replays included, None for no limit.
+
+        Timeouts raise HTTPTimeoutError, or DataGatewayBatchError for pipelined and batch
+        pushes.
+        """
         self._address = address
-        self._ios = HTTPIOStream(addr=address)
+        self._ios = HTTPIOStream(addr=address, connect_timeout=connect_timeout,
+                                 read_timeout=read_timeout)
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.ndjson = ndjson
+        self.pipeline = pipeline
+        self.replays = replays
 
     def reconnect(self):
         self.close()
@@ -43,10 +141,172 @@ class DataGatewayClient(object):
         req.add(("Content-Length", len(req.body)))
         return req
 
+    def _compose_batch(self, items):
+        req = HTTPRequest(method='PUT')
+        # Each body is built with a single join, the only copy of the encoded records
+        if self.ndjson:
+            req.add(("Content-Type", "application/x-ndjson"))
+            req.body = "\n".join(items + [""])
+        else:
+            req.add(("Content-Type", "application/json"))
+            pieces = ["["]
+            for item in items:
+                pieces.append(item)
+                pieces.append(",")
+            pieces[-1] = "]"
+            req.body = ''.join(pieces)
+        req.add(("Content-Length", len(req.body)))
+        return req
+
+    def _split_batches(self, items):
+        """ Groups encoded records into batches honoring batch_size and batch_bytes. """
+        batch = []
+        size = 0
+        for item in items:
+            if batch and (len(batch) >= self.batch_size or size + len(item) + 1 > self.batch_bytes):
+                yield batch
+                batch = []
+                size = 0
+            batch.append(item)
+            size += len(item) + 1
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _batch_statuses(resp, count):
+        """ Extracts per-record statuses from a batch response.
+
+        The gateway answers a batch with a JSON array holding one status for each record, either
+        as an object with code and reason, a [code, reason] pair or a bare code. Any other
+        response, or a status without a numeric code, applies to the whole batch.
+        """
+        try:
+            results = json.loads(resp.body)
+        except ValueError:
+            results = None
+        if not isinstance(results, list) or len(results) != count:
+            return [(resp.code, resp.body)] * count
+
+        statuses = []
+        try:
+            for r in results:
+                if isinstance(r, dict):
+                    statuses.append((int(r.get("code", resp.code)), r.get("reason", "")))
+                elif isinstance(r, list) and r:
+                    statuses.append((int(r[0]), r[1] if len(r) > 1 else ""))
+                else:
+                    statuses.append((int(r), ""))
+        except (ValueError, TypeError):
+            return [(resp.code, resp.body)] * count
+        return statuses
+
+    def _read_response(self):
+        """ Reads a response with its body, however it's framed, so that the next one can be read
+        off the connection. """
+        return self._ios.read_body(self._ios.read_response())
+
+    def _transfer(self, messages, responses):
+        """ Sends messages not answered yet, keeping up to `pipeline` requests in flight.
+
+        Responses are appended to `responses` in order as they arrive, so on failure it tells
+        which messages have been acknowledged.
+        """
+        sent = len(responses)
+        while len(responses) < len(messages):
+            try:
+                while sent < len(messages) and sent - len(responses) < max(1, self.pipeline):
+                    self._ios.write_message(messages[sent])
+                    sent += 1
+            except Exception:
+                # The server may have answered requests in flight before closing the connection
+                while len(responses) < sent:
+                    try:
+                        responses.append(self._read_response())
+                    except Exception:
+                        break
+                raise
+            responses.append(self._read_response())
+
+    def _exchange(self, messages, responses):
+        """ Sends messages and collects their responses, replaying unacknowledged messages on a
+        new connection when the current one fails. """
+        replays = 0
+        self._ios.set_deadline(self.timeout)
+        try:
+            while True:
+                try:
+                    if not self.is_connected():
+                        self.reconnect()
+                    self._transfer(messages, responses)
+                    return responses
+                except HTTPDeadlineExceeded:
+                    self.close()
+                    raise
+                except Exception:
+                    self.close()
+                    if replays >= self.replays:
+                        raise
+                    replays += 1
+        finally:
+            self._ios.set_deadline(None)
+
     def push(self, key, data, storage):
-        self._ios.write_message(self._compose_message(key, data, storage))
-        resp = self._ios.read_response()
+        self._ios.set_deadline(self.timeout)
+        try:
+            self._ios.write_message(self._compose_message(key, data, storage))
+            resp = self._read_response()
+        finally:
+            self._ios.set_deadline(None)
         return resp.code, resp.body
 
+    def push_many(self, key, records, storage):
+        """ Pushes records with one request for each, pipelined as configured.
+
+        Returns:
+            A list of (code, reason) tuples, one for each record in order.
+
+        Raises:
+            DataGatewayBatchError: The connection failed before all records were acknowledged.
+        """
+        messages = [self._compose_message(key, r, storage) for r in records]
+        responses = []
+        try:
+            self._exchange(messages, responses)
+        except Exception, e:
+            statuses = [(resp.code, resp.body) for resp in responses]
+            statuses.extend([None] * (len(records) - len(statuses)))
+            raise DataGatewayBatchError(str(e), statuses)
+        return [(resp.code, resp.body) for resp in responses]
+
+    def push_batch(self, key, records, storage):
+        """ Pushes records with as few requests as batch_size and batch_bytes allow.
+
+        Batch requests are pipelined as configured.
+
+        Returns:
+            A list of (code, reason) tuples, one for each record in order.
+
+        Raises:
+            DataGatewayBatchError: The connection failed before all records were acknowledged.
+        """
+        items = [DataGatewayJSONRequest(key, r, storage).getstr() for r in records]
+        batches = list(self._split_batches(items))
+        messages = [self._compose_batch(batch) for batch in batches]
+        responses = []
+        try:
+            self._exchange(messages, responses)
+        except Exception, e:
+            error = e
+        else:
+            error = None
+
+        statuses = []
+        for batch, resp in zip(batches, responses):
+            statuses.extend(self._batch_statuses(resp, len(batch)))
+        if error is not None:
+            statuses.extend([None] * (len(items) - len(statuses)))
+            raise DataGatewayBatchError(str(error), statuses)
+        return statuses
+
     def is_connected(self):
         return self._ios.is_open()
@@ -0,0 +1,144 @@
+import sys
+import struct
+from array import array
+
+_EMPTY = -1
+_DELETED = -2
+
+
+class DigestSet(object):
+    """ A set of raw 16-byte digests, such as ReviewRecord.digest.
+
+    Digests are kept in insertion order in one contiguous bytearray, and an open addressing
+    table of offsets into that buffer gives O(1) membership tests. No Python object is kept
+    per digest.
+
+    If capacity is non-zero, adding a digest to a full set evicts the oldest one.
+    """
+    WIDTH = 16
+
+    def __init__(self, digests=(), capacity=0):
+        self._capacity = capacity
+        self._data = bytearray()        # digests, oldest first
+        self._head = 0                  # offset of the oldest live digest in _data
+        self._table = array('i', [_EMPTY] * 8)
+        self._count = 0
+        self._deleted = 0
+        for d in digests:
+            self.add(d)
+
+    @property
+    def capacity(self):
+        """ Maximum number of digests kept, 0 for no limit. """
+        return self._capacity
+
+    @capacity.setter
+    def capacity(self, capacity):
+        self._capacity = capacity
+        while capacity and self._count > capacity:
+            self._evict()
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, digest):
+        return self._lookup(digest)[0]
+
+    def __iter__(self):
+        """ Iterates over digests, oldest first. """
+        for off in range(self._head, len(self._data), DigestSet.WIDTH):
+            yield str(self._data[off:off+DigestSet.WIDTH])
+
+    def add(self, digest):
+        """ Adds a digest to the set.
+
+        Returns:
+            True if the digest was not in the set, False otherwise.
+        """
+        if len(digest) != DigestSet.WIDTH:
+            raise ValueError("DigestSet.add: digest must be %d bytes long" % DigestSet.WIDTH)
+        found, slot = self._lookup(digest)
+        if found:
+            return False
+
+        if self._table[slot] == _DELETED:
+            self._deleted -= 1
+        self._table[slot] = len(self._data)
+        self._data.extend(digest)
+        self._count += 1
+        if self._capacity and self._count > self._capacity:
+            self._evict()
+        if (self._count + self._deleted) * 3 >= len(self._table) * 2:
+            self._rebuild()
+        return True
+
+    def tobytes(self):
+        """ Returns all digests concatenated, oldest first. """
+        return str(self._data[self._head:])
+
+    @staticmethod
+    def frombytes(data, capacity=0):
+        """ Builds a DigestSet from a string returned by tobytes(). """
+        s = DigestSet(capacity=capacity)
+        for off in range(0, len(data) - DigestSet.WIDTH + 1, DigestSet.WIDTH):
+            s.add(data[off:off+DigestSet.WIDTH])
+        return s
+
+    def memory_usage(self):
+        """ Number of bytes used by the set. """
+        return sys.getsizeof(self) + sys.getsizeof(self._data) + sys.getsizeof(self._table)
+
+    @staticmethod
+    def _hash(digest):
+        return struct.unpack_from("<Q", digest)[0]
+
+    def _lookup(self, digest):
+        """ Finds the slot of a digest.
+
+        Returns:
+            2-tuple (found, slot). If the digest is not in the set, slot is where it should be
+        inserted.
+        """
+        table = self._table
+        mask = len(table) - 1
+        i = DigestSet._hash(digest) & mask
+        free = -1
+        while True:
+            off = table[i]
+            if off == _EMPTY:
+                return False, (i if free < 0 else free)
+            if off == _DELETED:
+                if free < 0:
+                    free = i
+            elif self._data[off:off+DigestSet.WIDTH] == digest:
+                return True, i
+            i = (i + 1) & mask
+
+    def _evict(self):
+        """ Removes the oldest digest. """
+        oldest = str(self._data[self._head:self._head+DigestSet.WIDTH])
+        found, slot = self._lookup(oldest)
+        self._table[slot] = _DELETED
+        self._deleted += 1
+        self._count -= 1
+        self._head += DigestSet.WIDTH
+        if self._head * 2 >= len(self._data):
+            # compact the buffer, which moves every digest
+            del self._data[:self._head]
+            self._head = 0
+            self._rebuild()
+
+    def _rebuild(self):
+        """ Rebuilds the offset table, sized to keep its load factor under 1/2. """
+        size = 8
+        while size <= self._count * 2:
+            size *= 2
+        table = array('i', [_EMPTY] * size)
+        mask = size - 1
+        for off in range(self._head, len(self._data), DigestSet.WIDTH):
+            i = DigestSet._hash(self._data[off:off+DigestSet.WIDTH]) & mask
+            while table[i] != _EMPTY:
+                i = (i + 1) & mask
+            table[i] = off
+        self._table = table
+        self._deleted = 0
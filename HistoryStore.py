@@ -0,0 +1,147 @@
+import sqlite3
+import threading
+import collections
+from DigestSet import DigestSet
+
+
+class HistoryStore(object):
+    """ A disk backed mapping from hotel keys to DigestSets of the reviews seen on the hotel page.
+
+    It stands in for the in-memory history dict of the crawler, so that reviews pushed before a
+    restart are not taken as new ones after it. Entries are loaded lazily, one hotel at a time,
+    and at most cache_size hotels are kept in memory. Updates are held in memory until flush()
+    writes and commits them, which the crawler does once the records of a cycle have been
+    pushed. A crash in between thus makes the reviews of the cycle be taken as new again
+    instead of being lost, and the cost of syncing to disk is shared by many hotels.
+
+    flush() and rollback() act on the updates of the keys given, so that crawlers sharing a
+    store each settle their own cycle, without committing or dropping the updates of the others.
+
+    A path of ":memory:" gives a store that is not persisted.
+
+    The store remembers the digest algorithm its digests were computed with, and refuses to be
+    opened with another one as none of its digests would ever match.
+    """
+    def __init__(self, path, cache_size=1024, digest="md5"):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute("CREATE TABLE IF NOT EXISTS history (hotel TEXT PRIMARY KEY, digests BLOB)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'digest'").fetchone()
+        if row is None:
+            # stores created before digests were selectable are md5 ones
+            has_history = self._db.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+            stored = "md5" if has_history else digest
+            self._db.execute("INSERT INTO meta (name, value) VALUES ('digest', ?)", (stored,))
+        else:
+            stored = row[0]
+        self._db.commit()
+        if stored != digest:
+            self._db.close()
+            raise ValueError("History %s holds %s digests, not %s" % (path, stored, digest))
+        self._lock = threading.RLock()
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+        self._dirty = {}        # updates not flushed yet, by key
+
+    def __len__(self):
+        with self._lock:
+            count = self._db.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+            return count + sum(1 for key in self._dirty if self._select(key) is None)
+
+    def __contains__(self, key):
+        return self._load(key) is not None
+
+    def __getitem__(self, key):
+        seen = self._load(key)
+        if seen is None:
+            raise KeyError(key)
+        return seen
+
+    def __setitem__(self, key, seen):
+        with self._lock:
+            self._dirty[key] = seen
+            self._cache.pop(key, None)
+
+    def get(self, key, default_value=None):
+        seen = self._load(key)
+        if seen is None:
+            return default_value
+        return seen
+
+    def memory_usage(self):
+        """ Number of bytes used by the DigestSets held in memory. """
+        with self._lock:
+            seen = self._cache.values() + self._dirty.values()
+            return sum(s.memory_usage() for s in seen)
+
+    def flush(self, keys=None):
+        """ Writes pending updates of keys to disk and commits them.
+
+        Args:
+            keys: Keys whose updates are committed, all of them if None.
+        """
+        with self._lock:
+            if keys is None:
+                keys = self._dirty.keys()
+            keys = [key for key in keys if key in self._dirty]
+            if not keys:
+                return
+            for key in keys:
+                self._db.execute("INSERT OR REPLACE INTO history (hotel, digests) VALUES (?, ?)",
+                                 (self._dbkey(key), sqlite3.Binary(self._dirty[key].tobytes())))
+            self._db.commit()
+            for key in keys:
+                self._cache_put(key, self._dirty.pop(key))
+
+    def rollback(self, keys=None):
+        """ Drops pending updates of keys, which read as they were last flushed again.
+
+        Args:
+            keys: Keys whose updates are dropped, all of them if None.
+        """
+        with self._lock:
+            if keys is None:
+                keys = self._dirty.keys()
+            for key in keys:
+                # the DigestSet cached may have been changed in place before being stored
+                self._dirty.pop(key, None)
+                self._cache.pop(key, None)
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._db.close()
+            self._cache.clear()
+
+    @staticmethod
+    def _dbkey(key):
+        if isinstance(key, unicode):
+            return key.encode('utf-8')
+        return key
+
+    def _select(self, key):
+        return self._db.execute("SELECT digests FROM history WHERE hotel = ?",
+                                (self._dbkey(key),)).fetchone()
+
+    def _load(self, key):
+        with self._lock:
+            if key in self._dirty:
+                return self._dirty[key]
+            if key in self._cache:
+                seen = self._cache.pop(key)
+                self._cache[key] = seen
+                return seen
+
+            row = self._select(key)
+            if row is None:
+                return None
+            seen = DigestSet.frombytes(str(row[0]))
+            self._cache_put(key, seen)
+            return seen
+
+    def _cache_put(self, key, seen):
+        self._cache.pop(key, None)
+        self._cache[key] = seen
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
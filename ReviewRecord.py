@@ -1,7 +1,32 @@
-import md5
+import hashlib
+import binascii
+
+
+def _md5(text):
+    return hashlib.md5(text).digest()
+
+
+def _blake2b(text):
+    return hashlib.blake2b(text, digest_size=16).digest()
+
+
+# Digest algorithms for ReviewRecord.digest. All of them produce 16 bytes.
+DIGESTS = {"md5": _md5}
+if hasattr(hashlib, "blake2b"):
+    DIGESTS["blake2b"] = _blake2b
 
 
 class ReviewRecord(object):
+    FIELDS = ("hotel_name", "hotel_url", "source_site", "rate", "nick_name", "comment",
+              "comment_date", "check_in_date", "timestamp", "consume_detail")
+    # Fields the digest is computed from
+    HASHED_FIELDS = frozenset(("nick_name", "hotel_name", "source_site", "comment", "check_in_date", "rate"))
+
+    __slots__ = FIELDS + ("_digest",)
+
+    # Name of the algorithm of digest, one of DIGESTS
+    digest_algorithm = "md5"
+
     def __init__(self):
         self.hotel_name = ""
         self.hotel_url = ""
@@ -14,20 +39,50 @@ class ReviewRecord(object):
         self.timestamp = ""
         self.consume_detail = ""
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in ReviewRecord.HASHED_FIELDS:
+            object.__setattr__(self, "_digest", None)
+
+    @staticmethod
+    def set_digest_algorithm(name):
+        """ Selects the algorithm of digest for all records.
+
+        Digests of different algorithms never match, so a history must be read with the
+        algorithm it was written with.
+        """
+        if name not in DIGESTS:
+            raise ValueError("Unsupported digest algorithm: %s" % name)
+        ReviewRecord.digest_algorithm = name
+
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in ReviewRecord.FIELDS)
+
     @property
     def hash(self):
-        h = md5.new()
-        text = []
-        if self.nick_name:
-            text.append(self.nick_name.encode('utf-8'))
-        if self.hotel_name:
-            text.append(self.hotel_name.encode('utf-8'))
-        if self.source_site:
-            text.append(self.source_site.encode('utf-8'))
-        if self.comment:
-            text.append(self.comment.encode('utf-8'))
-        if self.check_in_date:
-            text.append(self.check_in_date.encode('utf-8'))
-        text.append(str(self.rate))
-        h.update('-'.join(text))
-        return h.hexdigest()
+        """ Hex digest identifying the review. """
+        return binascii.hexlify(self.digest)
+
+    @property
+    def digest(self):
+        """ Raw 16-byte digest identifying the review.
+
+        The digest is computed once and cached until one of HASHED_FIELDS is assigned.
+        """
+        d = self._digest
+        if d is None:
+            text = []
+            if self.nick_name:
+                text.append(self.nick_name.encode('utf-8'))
+            if self.hotel_name:
+                text.append(self.hotel_name.encode('utf-8'))
+            if self.source_site:
+                text.append(self.source_site.encode('utf-8'))
+            if self.comment:
+                text.append(self.comment.encode('utf-8'))
+            if self.check_in_date:
+                text.append(self.check_in_date.encode('utf-8'))
+            text.append(str(self.rate))
+            d = DIGESTS[ReviewRecord.digest_algorithm]('-'.join(text))
+            object.__setattr__(self, "_digest", d)
+        return d
@@ -0,0 +1,302 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# benchmark - micro-benchmarks of the crawler hot paths
+#   Each case prints the cost of one operation. Run a subset of cases by
+# naming them on the command line.
+
+import os
+import sys
+import json
+import time
+import socket
+import datetime
+import threading
+
+from ReviewRecord import ReviewRecord, DIGESTS
+import DataGatewayClient
+from DataGatewayClient import DataGatewayJSONRequest
+import libhttp
+from jpc import JSONPrototypeCompiler, LAYOUTS
+from jsonstream import JSONStream
+from qunar.fetch import read_count
+from libhttp import HTTPInputStream, HTTPOutputStream, HTTPHeaders, HTTPParser, HTTPResponse
+
+
+def measure(func, number):
+    """ Runs func number times and returns the average cost in microseconds. """
+    best = None
+    for _ in range(3):
+        start = time.time()
+        func(number)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e6 / number
+
+
+def report(name, usec):
+    print("  %-40s %10.3f us" % (name, usec))
+
+
+class ReplaySocket(object):
+    """ A socket stand-in whose recv replays data, in pieces of at most piece_size bytes. """
+    def __init__(self, data, piece_size=64 * 1024):
+        self._data = data
+        self._pos = 0
+        self._piece_size = piece_size
+
+    def recv(self, n):
+        n = min(n, self._piece_size)
+        d = self._data[self._pos:self._pos+n]
+        self._pos += len(d)
+        return d
+
+    def recv_into(self, buf, n=0):
+        d = self.recv(n or len(buf))
+        buf[:len(d)] = d
+        return len(d)
+
+
+SAMPLE_RESPONSE = ("HTTP/1.1 200 OK\r\n"
+                   "Server: nginx\r\n"
+                   "Date: Mon, 23 Feb 2015 08:00:00 GMT\r\n"
+                   "Content-Type: application/json;charset=UTF-8\r\n"
+                   "Connection: keep-alive\r\n"
+                   "Vary: Accept-Encoding\r\n"
+                   "Cache-Control: no-cache\r\n"
+                   "Pragma: no-cache\r\n"
+                   "Expires: Thu, 01 Jan 1970 00:00:00 GMT\r\n"
+                   "Set-Cookie: QN1=eIQjmlTq; path=/; domain=.qunar.com\r\n"
+                   "Set-Cookie: QN48=tc_5ab; path=/; domain=.qunar.com\r\n"
+                   "ETag: \"5d41402abc4b2a76b9719d911017c592\"\r\n"
+                   "Content-Length: 2\r\n"
+                   "\r\n"
+                   "{}")
+
+
+def bench_headers():
+    headers = HTTPHeaders()
+    block = SAMPLE_RESPONSE.split("\r\n", 1)[1].split("\r\n\r\n")[0]
+    for kv in HTTPParser.split_headers(block):
+        headers.append(kv)
+
+    def lookup(n):
+        for _ in range(n):
+            headers.get("Content-Length")
+            headers.get("Transfer-Encoding")
+            "Connection" in headers
+            headers.getall("Set-Cookie")
+
+    def parse(n):
+        stream = HTTPInputStream(ReplaySocket(SAMPLE_RESPONSE * n))
+        for _ in range(n):
+            m = stream.read_response()
+            m.get("Transfer-Encoding")
+            m.get("Connection")
+
+    def feed(n):
+        parser = HTTPParser(HTTPResponse)
+        for _ in range(n):
+            parser.feed(SAMPLE_RESPONSE)
+
+    report("4 lookups in %d headers" % len(headers), measure(lookup, 100000))
+    usec = measure(parse, 10000)
+    report("parse response and look up", usec)
+    print("  %-40s %10d /s" % ("headers parsed", len(headers) * 1e6 / usec))
+    report("feed response to HTTPParser", measure(feed, 10000))
+
+
+def bench_review_record():
+    comment = u"房间挺大的，朝向也不错。" * 20
+
+    def make(n):
+        for i in range(n):
+            r = ReviewRecord()
+            r.hotel_name = u"吴江东恒盛国际大酒店"
+            r.source_site = "qunar"
+            r.nick_name = u"kzrx3559"
+            r.comment = comment
+            r.check_in_date = u"2015-02"
+            r.rate = 4
+
+    records = []
+    make(1)
+    for i in range(10000):
+        r = ReviewRecord()
+        r.comment = comment + unicode(i)
+        records.append(r)
+
+    def first_digest(n):
+        for r in records[:n]:
+            r.rate = 3
+            r.digest
+
+    def cached_digest(n):
+        for r in records[:n]:
+            r.digest
+
+    report("create and fill", measure(make, 10000))
+    saved = ReviewRecord.digest_algorithm
+    for name in sorted(DIGESTS):
+        ReviewRecord.set_digest_algorithm(name)
+        report("digest (%s)" % name, measure(first_digest, len(records)))
+    ReviewRecord.set_digest_algorithm(saved)
+    report("digest (cached)", measure(cached_digest, len(records)))
+
+    for r in records:
+        r.comment_date = datetime.datetime(2015, 2, 23, 8, 0, 0)
+        r.timestamp = datetime.datetime.now()
+
+    def encode(n):
+        for r in records[:n]:
+            DataGatewayJSONRequest("hotel_review", r, "mysql").getstr()
+
+    report("encode for gateway (registered)", measure(encode, len(records)))
+    saved = DataGatewayClient._encoders.pop(ReviewRecord)
+    report("encode for gateway (AggressiveEncoder)", measure(encode, len(records)))
+    DataGatewayClient.register_encoder(ReviewRecord, saved)
+
+
+def bench_copy():
+    size = 256 * 1024 * 1024
+
+    def throughput(copy):
+        """ Returns bytes per second copy(src, dst) moves between two socketpairs. """
+        a, b = socket.socketpair()
+        c, d = socket.socketpair()
+
+        def produce():
+            data = "x" * (1024 * 1024)
+            for _ in range(size // len(data)):
+                a.sendall(data)
+            a.close()
+
+        def consume():
+            buf = bytearray(256 * 1024)
+            while d.recv_into(buf):
+                pass
+
+        threads = [threading.Thread(target=produce), threading.Thread(target=consume)]
+        for t in threads:
+            t.start()
+        start = time.time()
+        copy(HTTPInputStream(b), HTTPOutputStream(c))
+        elapsed = time.time() - start
+        c.close()
+        for t in threads:
+            t.join()
+        b.close()
+        d.close()
+        return size / elapsed
+
+    def strings(src, dst):
+        copied = 0
+        while copied < size:
+            d = src.read_some(min(16 * 1024, size - copied))
+            dst.write(d)
+            copied += len(d)
+
+    def copy_bytes(src, dst):
+        dst.copy_bytes(src, size)
+
+    paths = [("read_some and write", strings, False),
+             ("copy_bytes, pooled buffer", copy_bytes, False)]
+    if libhttp._splice is not None:
+        paths.append(("copy_bytes, splice", copy_bytes, True))
+    saved = libhttp.ZERO_COPY
+    for name, copy, zero_copy in paths:
+        libhttp.ZERO_COPY = zero_copy
+        print("  %-40s %10.1f MB/s" % (name, throughput(copy) / 1e6))
+    libhttp.ZERO_COPY = saved
+
+
+# Members of hotel_review.json qunar/fetch.py reads
+QUNAR_PROJECTION = ["data.count", "data.list.content", "data.list.nickName", "data.list.feedTime"]
+
+
+def bench_jpc():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "qunar", "hotel_review.json")
+    dct = json.load(open(path))
+    watermark = sorted(item["feedTime"] for item in dct["data"]["list"])[5]
+
+    variants = [(layout, None, False) for layout in LAYOUTS]
+    variants += [(layout, QUNAR_PROJECTION, False) for layout in LAYOUTS if layout != "dict"]
+    variants += [("slots", QUNAR_PROJECTION, True)]
+    for layout, projection, columns in variants:
+        compiler = JSONPrototypeCompiler(layout, columns)
+        compiler.compile_object("hotel_review", dct, projection)
+        if projection:
+            layout += ", projected"
+        if columns:
+            layout += ", columns"
+        ns = {}
+        exec compiler.python_code() in ns
+        from_dict = ns["hotel_review"].from_dict
+
+        def decode(n):
+            for _ in range(n):
+                from_dict(dct)
+
+        items = from_dict(dct).data.list
+        if columns:
+            size = sys.getsizeof(items) + sum(sys.getsizeof(getattr(items, name))
+                                              for name in ("content", "nickName", "feedTime"))
+            size //= len(items)
+
+            def newer(n):
+                for _ in range(n):
+                    len([t for t in items.feedTime if t > watermark])
+        else:
+            size = sys.getsizeof(items[0])
+            if hasattr(items[0], "__dict__"):
+                size += sys.getsizeof(items[0].__dict__)
+
+            def newer(n):
+                for _ in range(n):
+                    len([r for r in items if r.feedTime > watermark])
+
+        report("decode (%s)" % layout, measure(decode, 10000))
+        print("  %-40s %10d bytes" % ("review item (%s)" % layout, size))
+        if projection:
+            report("count newer (%s)" % layout, measure(newer, 100000))
+
+    text = open(path).read()
+    pieces = [text[i:i+4096] for i in range(0, len(text), 4096)]
+    compiler = JSONPrototypeCompiler("slots")
+    compiler.compile_object("hotel_review", dct, QUNAR_PROJECTION)
+    ns = {}
+    exec compiler.python_code() in ns
+    hotel_review = ns["hotel_review"]
+
+    def loads(n):
+        for _ in range(n):
+            hotel_review.from_dict(json.loads(''.join(pieces)))
+
+    def from_stream(n):
+        for _ in range(n):
+            hotel_review.from_stream(JSONStream(pieces))
+
+    def count(n):
+        for _ in range(n):
+            read_count(JSONStream(pieces))
+
+    report("json.loads and from_dict (projected)", measure(loads, 1000))
+    report("from_stream, 4K pieces (projected)", measure(from_stream, 1000))
+    report("read_count (qunar)", measure(count, 1000))
+
+
+CASES = [
+    ("review_record", bench_review_record),
+    ("headers", bench_headers),
+    ("copy", bench_copy),
+    ("jpc", bench_jpc),
+]
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:]
+    for name, case in CASES:
+        if names and name not in names:
+            continue
+        print("%s:" % name)
+        case()
@@ -2,10 +2,22 @@ import logging
 import time
 import os
 import sys
+import heapq
+import Queue
 import importlib
+from multiprocessing.pool import ThreadPool
 
 sys.path.append(os.path.abspath("../"))
-from DataGatewayClient import DataGatewayClient
+from DataGatewayClient import DataGatewayClient, DataGatewayBatchError
+from HistoryStore import HistoryStore
+from DigestSet import DigestSet
+from ReviewRecord import ReviewRecord, DIGESTS
+import httpfetch
+from libhttp import HTTPTimeoutError
+
+# Reviews remembered per hotel by a PARTIAL crawler when keep is None. Its walks never tell
+# which reviews left the site, so the oldest are forgotten past this many.
+PARTIAL_KEEP = 1000
 
 
 def load_hotels(target):
@@ -26,7 +38,61 @@ def load_hotels(target):
     return hotels
 
 
-def fetch_latest(target, history):
+def fetch_hotel(target, fetch, hotel_arg):
+    """ Fetch reviews of a single hotel, isolating any error raised by the crawler.
+
+    Returns:
+        2-tuple (records, validators), validators being those of the pages fetched, staged by
+    httpfetch.stage_validators. If the fetch failed, records are None and validators empty.
+    """
+    validators = {}
+    httpfetch.stage_validators(validators)
+    try:
+        return fetch(hotel_arg), validators
+    except HTTPTimeoutError, e:
+        # a stalled site only costs this hotel, it's fetched again next cycle
+        logging.warning("** Crawler [%s] timed out on %s: %s" % (target, hotel_arg, str(e)))
+        return None, {}
+    except Exception, e:
+        # ignore errors
+        logging.error("** Crawler [%s] exception: %s" % (target, str(e)))
+        return None, {}
+    finally:
+        httpfetch.stage_validators(None)
+
+
+class Cycle(object):
+    """ Updates made by a crawling cycle of a target, to be committed once its records are pushed. """
+    def __init__(self):
+        self.keys = []          # history keys updated
+        self.validators = {}    # validators of the pages fetched
+        self.commits = []       # (commit, hotel_arg) of the hotels fetched by a crawler with commit
+
+
+def fetch_latest(target, history, jobs=1, keep=None, cycle=None):
+    """ Fetch new reviews of all hotels listed for the target crawler.
+
+    Hotels are fetched by up to `jobs` worker threads, further capped by the
+    CONCURRENCY attribute of the crawler module if it defines one. Results and
+    history updates are always applied in hotels.txt order.
+
+    history maps hotel keys to DigestSets of the reviews seen. If keep is None,
+    reviews no longer on a hotel page are forgotten. Otherwise reviews are
+    remembered after leaving the page, up to `keep` per hotel (0 for no limit),
+    the oldest being forgotten first.
+
+    A crawler module setting PARTIAL returns only some of the reviews of a hotel
+    in a cycle, such as those of the pages it walked. Reviews it leaves out are
+    still on the site, so they are not forgotten when they leave the page, but
+    past PARTIAL_KEEP per hotel if keep is None.
+
+    A crawler module may define commit(hotel_arg), to settle state its fetch of
+    a hotel staged, such as how far it read, only once the records are pushed.
+
+    The history keys updated, the validators of the pages fetched and the hotels
+    to commit are recorded in cycle, for end_cycle to commit once the records are
+    pushed. Validators and hotels are committed right away if cycle is None.
+    """
     try:
         mod = importlib.import_module('%s.fetch' % target)
         fetch = mod.fetch
@@ -38,74 +104,220 @@ def fetch_latest(target, history):
         return None
 
     hotels = load_hotels(target)
-    results = []
-    for hotel_arg in hotels:
+    partial = getattr(mod, "PARTIAL", False)
+    commit = getattr(mod, "commit", None)
+    workers = min(jobs, getattr(mod, "CONCURRENCY", jobs), len(hotels))
+    if workers > 1:
+        pool = ThreadPool(workers)
         try:
-            records = fetch(hotel_arg)
-            if not records:
-                continue
-        except Exception, e:
-            # ignore errors
-            logging.error("** Crawler [%s] exception: %s" % (target, str(e)))
+            fetched = pool.map(lambda hotel_arg: fetch_hotel(target, fetch, hotel_arg), hotels, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        fetched = [fetch_hotel(target, fetch, hotel_arg) for hotel_arg in hotels]
+
+    results = []
+    for hotel_arg, (records, pages) in zip(hotels, fetched):
+        if cycle is None:
+            httpfetch.store_validators(pages)
+        else:
+            cycle.validators.update(pages)
+        if records is not None and commit is not None:
+            if cycle is None:
+                commit(hotel_arg)
+            else:
+                cycle.commits.append((commit, hotel_arg))
+        if not records:
             continue
 
         hotel_key = target + '-' + '-'.join(hotel_arg)
-        if hotel_key in history:
-            hl = history[hotel_key]
+        if cycle is not None:
+            cycle.keys.append(hotel_key)
+        seen = history.get(hotel_key)
+        if keep is None and not partial:
+            newseen = DigestSet()
+            for r in records:
+                d = r.digest
+                if seen is None or d not in seen:
+                    results.append(r)
+                newseen.add(d)
+            history[hotel_key] = newseen
         else:
-            hl = []
-        newhl = []
-        for r in records:
-            h = r.hash
-            if h not in hl:
-                results.append(r)
-            newhl.append(h)
-        history[hotel_key] = newhl
+            if seen is None:
+                seen = DigestSet()
+            seen.capacity = PARTIAL_KEEP if keep is None else keep
+            for r in records:
+                if seen.add(r.digest):
+                    results.append(r)
+            history[hotel_key] = seen
     return results
 
 
-def push_record(client, record):
+def push_records(client, records):
+    """ Pushes records in batches, or with one request for each if batching is disabled on the
+    client, retrying records that were not acknowledged.
+
+    Returns:
+        A list of (code, reason) tuples, one for each record in order. Records that could not
+    be pushed are marked as None.
+    """
+    push = client.push_batch if client.batch_size > 0 else client.push_many
+    statuses = [None] * len(records)
     retries = 0
     while retries < 2:
+        pending = [i for i, s in enumerate(statuses) if s is None]
+        if not pending:
+            break
         try:
             if not client.is_connected():
                 client.reconnect()
-            code, reason = client.push("hotel_review", record, "mysql")
-            if code != 200:
-                logging.warning("DataGatewayClient reports " + reason)
-                break
-            return True
+            results = push("hotel_review", [records[i] for i in pending], "mysql")
+        except DataGatewayBatchError, e:
+            results = e.statuses
+            retries += 1
+            logging.error("DataGatewayClient error, retry[" + str(retries) + "] " + str(e))
         except Exception, e:
             client.close()
             retries += 1
             logging.error("DataGatewayClient error, retry[" + str(retries) + "] " + str(e))
-    return False
+            continue
+        for i, status in zip(pending, results):
+            statuses[i] = status
+
+    for status in statuses:
+        if status is not None and status[0] != 200:
+            logging.warning("DataGatewayClient reports " + str(status[1]))
+    if None in statuses:
+        logging.error("DataGatewayClient failed to push %d records" % statuses.count(None))
+    return statuses
+
 
+def end_cycle(history, cycle, statuses):
+    """ Commits history updates, validators and hotels of a cycle if all its records were pushed.
 
-def run_crawler(target, period, gateway):
-    history = {}
+    Otherwise its history updates are rolled back and the rest is dropped, so that the
+    reviews of the cycle are fetched and pushed again, rather than being lost, by the next
+    cycle. Only the hotels of the cycle are settled, cycles of other targets sharing history
+    are left pending.
+    """
+    if statuses is None or None in statuses:
+        history.rollback(cycle.keys)
+    else:
+        history.flush(cycle.keys)
+        httpfetch.store_validators(cycle.validators)
+        for commit, hotel_arg in cycle.commits:
+            commit(hotel_arg)
+
+
+def run_crawler(target, period, gateway, jobs=1, batch_size=DataGatewayClient.BATCH_SIZE, pipeline=1,
+                history_path=":memory:", keep=None):
+    try:
+        history = HistoryStore(history_path, digest=ReviewRecord.digest_algorithm)
+    except ValueError, e:
+        logging.error(str(e))
+        return -1
     try:
-        client = DataGatewayClient(gateway)
+        client = DataGatewayClient(gateway, batch_size=batch_size, pipeline=pipeline)
     except Exception, e:
         logging.error(str(e))
         logging.error("*** Can't connect to gateway server " + str(gateway))
         return -1
 
     while True:
+        cycle = Cycle()
+        statuses = None
         try:
             logging.info("crawler [%s] is started..." % target)
-            records = fetch_latest(target, history)
-            count = 0
-            for r in records:
-                push_record(client, r)
-                count += 1
+            records = fetch_latest(target, history, jobs, keep, cycle)
+            statuses = push_records(client, records)
+            count = len(records)
             logging.info("crawler [%s] got %d new records" % (target, count))
         except Exception, e:
             logging.error("Unhandled exception from \'%s\': %s" % (target, str(e)))
+        end_cycle(history, cycle, statuses)
+        logging.info("crawler [%s] history uses %d bytes in memory" % (target, history.memory_usage()))
         logging.info("crawler [%s] is slept" % target)
         time.sleep(period)
 
 
+def _run_cycle(target, history, jobs, keep, done):
+    """ Worker side of run_daemon: runs one blocking crawling cycle and hands the result back. """
+    cycle = Cycle()
+    try:
+        records = fetch_latest(target, history, jobs, keep, cycle)
+    except Exception, e:
+        logging.error("Unhandled exception from \'%s\': %s" % (target, str(e)))
+        records = None
+    done.put((target, records or [], cycle))
+
+
+def run_daemon(targets, period, gateway, jobs=1, batch_size=DataGatewayClient.BATCH_SIZE, pipeline=1,
+               history_path=":memory:", keep=None):
+    """ Drive several crawlers from a single process.
+
+    Crawling cycles of all targets are scheduled on one loop. The blocking fetch of a cycle
+    runs on a worker thread, and its records are handed back to the loop, which pushes them
+    through a single gateway connection shared by all targets. The history is shared too, each
+    push committing or rolling back the history updates of its own cycle only.
+    """
+    if not targets:
+        logging.error("*** No crawler to run")
+        return -1
+    try:
+        history = HistoryStore(history_path, digest=ReviewRecord.digest_algorithm)
+    except ValueError, e:
+        logging.error(str(e))
+        return -1
+    try:
+        client = DataGatewayClient(gateway, batch_size=batch_size, pipeline=pipeline)
+    except Exception, e:
+        logging.error(str(e))
+        logging.error("*** Can't connect to gateway server " + str(gateway))
+        return -1
+
+    pool = ThreadPool(len(targets))
+    done = Queue.Queue()
+    schedule = [(time.time(), t) for t in targets]
+    heapq.heapify(schedule)
+    while True:
+        now = time.time()
+        while schedule and schedule[0][0] <= now:
+            target = heapq.heappop(schedule)[1]
+            logging.info("crawler [%s] is started..." % target)
+            pool.apply_async(_run_cycle, (target, history, jobs, keep, done))
+
+        timeout = schedule[0][0] - now if schedule else period
+        try:
+            target, records, cycle = done.get(True, timeout)
+        except Queue.Empty:
+            continue
+
+        statuses = None
+        try:
+            statuses = push_records(client, records)
+            count = len(records)
+            logging.info("crawler [%s] got %d new records" % (target, count))
+        except Exception, e:
+            logging.error("Unhandled exception from \'%s\': %s" % (target, str(e)))
+        end_cycle(history, cycle, statuses)
+        logging.info("history uses %d bytes in memory" % history.memory_usage())
+        logging.info("crawler [%s] is slept" % target)
+        heapq.heappush(schedule, (time.time() + period, target))
+
+
+def discover_crawlers(root="./"):
+    """ Returns names of crawler packages found in root. """
+    crawlers = []
+    for e in os.listdir(root):
+        d = os.path.join(root, e)
+        if not os.path.isdir(d):
+            continue
+        if all(os.path.exists(os.path.join(d, f)) for f in ("fetch.py", "hotels.txt", "__init__.py")):
+            crawlers.append(e)
+    return sorted(crawlers)
+
+
 def getarg(argv, name, default=None):
     capture = False
     for a in argv:
@@ -117,22 +329,29 @@ def getarg(argv, name, default=None):
 
 
 if __name__ == "__main__":
-    crawlers = []
-    for e in os.listdir("./"):
-        if not os.path.isdir(e):
-            continue
-        if os.path.exists(e+"/fetch.py") and os.path.exists(e+"/hotels.txt") and os.path.exists(e+"/__init__.py"):
-            crawlers.append(e)
+    crawlers = discover_crawlers()
 
     if len(sys.argv) < 2:
         print("Usage: crawler.py <CRAWLER-ID> [OPTIONS]")
         print("Currently available crawlers are:")
         print("  " + ' '.join(crawlers))
+        print("Use 'all' as CRAWLER-ID to run every available crawler in a single process.")
         print("")
         print("OPTIONS may be:")
         print("  -t <PERIOD>   period of crawling, in seconds. Default is 3600.")
         print("  -g <GATEWAR>  address of data gateway server. Default is localhost:8086")
         print("  -l <LEVEL>    log level, within range [0, 50]. Default is 30(warning).")
+        print("  -j <JOBS>     number of hotels fetched in parallel. Default is 1.")
+        print("  -b <SIZE>     max records per gateway request, 0 to push one by one. Default is 100.")
+        print("  -p <DEPTH>    max gateway requests in flight (HTTP pipelining). Default is 1.")
+        print("  -H <FILE>     file keeping reviews already pushed across restarts. Default is")
+        print("                history.db, use :memory: to keep them in memory only.")
+        print("  -V <FILE>     file keeping validators of the pages fetched across restarts. Default")
+        print("                is validators.db next to the -H file, or in memory if history is.")
+        print("  -k <COUNT>    remember up to COUNT reviews per hotel, 0 for no limit. By default")
+        print("                reviews are forgotten once they are no longer on the hotel page, or")
+        print("                past %d for crawlers walking only some of the pages." % PARTIAL_KEEP)
+        print("  -D <DIGEST>   digest identifying reviews, one of: %s. Default is md5." % ' '.join(sorted(DIGESTS)))
         exit(1)
 
     # set log level
@@ -140,9 +359,29 @@ if __name__ == "__main__":
     logging.getLogger().setLevel(lvl)
 
     target = sys.argv[1]
-    if target not in crawlers:
+    if target != "all" and target not in crawlers:
         print("Crawler \'%s\' not found!" % target)
     period = int(getarg(sys.argv, "-t", "3600"))
     addr = getarg(sys.argv, "-g", "localhost:8086").split(':')
     gateway = (addr[0], int(addr[1]))
-    run_crawler(target, period, gateway)
+    jobs = max(1, int(getarg(sys.argv, "-j", "1")))
+    batch_size = int(getarg(sys.argv, "-b", str(DataGatewayClient.BATCH_SIZE)))
+    pipeline = max(1, int(getarg(sys.argv, "-p", "1")))
+    history_path = getarg(sys.argv, "-H", "history.db")
+    if history_path == ":memory:":
+        validators_path = ":memory:"
+    else:
+        validators_path = os.path.join(os.path.dirname(history_path), "validators.db")
+    httpfetch.VALIDATORS_PATH = getarg(sys.argv, "-V", validators_path)
+    keep = getarg(sys.argv, "-k")
+    if keep is not None:
+        keep = int(keep)
+    try:
+        ReviewRecord.set_digest_algorithm(getarg(sys.argv, "-D", "md5"))
+    except ValueError, e:
+        print(str(e) + ", use one of: " + ' '.join(sorted(DIGESTS)))
+        exit(1)
+    if target == "all":
+        run_daemon(crawlers, period, gateway, jobs, batch_size, pipeline, history_path, keep)
+    else:
+        run_crawler(target, period, gateway, jobs, batch_size, pipeline, history_path, keep)
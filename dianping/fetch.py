@@ -1,12 +1,18 @@
 import os
 import sys
-import urllib2
 import logging
 import datetime
 from bs4 import BeautifulSoup
 
 sys.path.append(os.path.abspath("../"))
 from ReviewRecord import *
+import httpfetch
+
+# Maximum number of hotels fetched from this site in parallel
+CONCURRENCY = 2
+
+# Seconds fetching one page from this site may take before it's given up
+TIMEOUT = 30
 
 
 def fetch(args):
@@ -14,8 +20,10 @@ def fetch(args):
     hotel_id = args[1]
     api_url = hotel_id
     headers = {'User-Agent': 'Mozilla/5.0 (Windows; U; Windows NT 6.1; en-US; rv:1.9.1.6) Gecko/20141201 Firefox/3.5.6'}
-    req = urllib2.Request(url=api_url, headers=headers)
-    f = urllib2.urlopen(req)
+    f = httpfetch.urlopen(api_url, headers, timeout=TIMEOUT)
+    if f is None:
+        # not modified since last fetch
+        return []
     if f.getcode() != 200:
         logging.error("http %d --> Get %s " % (f.getcode(), api_url))
         return None
@@ -0,0 +1,230 @@
+import time
+import sqlite3
+import urllib2
+import urlparse
+import threading
+from libhttp import HTTPClient, HTTPDeadlineExceeded
+
+
+class ValidatorCache(object):
+    """ Remembers the validators (ETag and Last-Modified) of fetched URLs.
+
+    Validators are written through to a sqlite database but only committed on flush(). The
+    crawler has urlopen stage them instead, see stage_validators, and only stores those of pages
+    whose records have been pushed. A page whose records were lost is thus fetched again instead
+    of being taken as unchanged.
+    """
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS validators "
+                         "(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT)")
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """ Returns 2-tuple (etag, last_modified) of url, either may be None. """
+        with self._lock:
+            row = self._db.execute("SELECT etag, last_modified FROM validators WHERE url = ?",
+                                   (url,)).fetchone()
+        if row is None:
+            return None, None
+        return row[0], row[1]
+
+    def update(self, url, etag, last_modified):
+        with self._lock:
+            if etag or last_modified:
+                self._db.execute("INSERT OR REPLACE INTO validators (url, etag, last_modified) "
+                                 "VALUES (?, ?, ?)", (url, etag, last_modified))
+            else:
+                self._db.execute("DELETE FROM validators WHERE url = ?", (url,))
+
+    def flush(self):
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+
+# File keeping validators across restarts, set before the first fetch. The crawler puts it next
+# to its history, ":memory:" keeps them in memory only.
+VALIDATORS_PATH = "validators.db"
+_validators = None
+_validators_lock = threading.Lock()
+
+
+def validators():
+    """ Returns the ValidatorCache shared by all fetchers, stored at VALIDATORS_PATH. """
+    global _validators
+    with _validators_lock:
+        if _validators is None:
+            _validators = ValidatorCache(VALIDATORS_PATH)
+        return _validators
+
+
+def flush():
+    """ Commits validators of pages fetched so far. """
+    with _validators_lock:
+        if _validators is not None:
+            _validators.flush()
+
+
+_staging = threading.local()
+
+
+def stage_validators(pending):
+    """ Makes urlopen calls of the calling thread add the validators of the pages they fetch to
+    pending, a dict mapping URLs to (etag, last_modified), instead of storing them. None makes
+    them store validators again.
+    """
+    _staging.pending = pending
+
+
+def store_validators(pending):
+    """ Stores and commits validators staged by stage_validators. """
+    if not pending:
+        return
+    cache = validators()
+    for url, (etag, last_modified) in pending.iteritems():
+        cache.update(url, etag, last_modified)
+    cache.flush()
+
+
+# Fetch http pages through a keep-alive HTTPClient instead of urllib2
+POOLED = True
+MAX_REDIRECTS = 5
+# Seconds connecting to a site may take, and a site may keep a fetch waiting for data
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+_client = HTTPClient(connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT)
+
+
+class Page(object):
+    """ A page fetched through HTTPClient, in the file-like form urllib2.urlopen returns.
+
+    The body of a streamed page is left on the connection, and read once, as it arrives,
+    by either read or iter_body. The page must then be closed, unless read was called. Its
+    connection is closed too if the body is not completely read by then.
+    """
+    def __init__(self, url, resp):
+        self._url = url
+        self._resp = resp
+        self._body = getattr(resp, "body_pieces", None)
+        self._pieces = self._body       # None once handed out
+
+    def getcode(self):
+        return self._resp.code
+
+    def geturl(self):
+        return self._url
+
+    def getheader(self, name, default=None):
+        return self._resp.get(name, default)
+
+    def read(self):
+        if self._pieces is not None:
+            self._resp.body = ''.join(self._pieces)
+            self._pieces = None
+        return self._resp.body
+
+    def iter_body(self):
+        """ Returns an iterator over the pieces of the body. """
+        if self._pieces is None:
+            return iter([self._resp.body] if self._resp.body else [])
+        pieces = self._pieces
+        self._pieces = None
+        return pieces
+
+    def close(self):
+        """ Gives up what's left of a streamed body, closing its connection if there is any. """
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+            self._pieces = None
+
+
+def iter_body(f, chunk_size=16 * 1024):
+    """ Returns an iterator over the body of a page urlopen returned, piece by piece. """
+    if isinstance(f, Page):
+        return f.iter_body()
+    return iter(lambda: f.read(chunk_size), "")
+
+
+def _urllib2_get(url, headers, timeout):
+    try:
+        return urllib2.urlopen(urllib2.Request(url=url, headers=headers),
+                               timeout=READ_TIMEOUT if timeout is None else timeout)
+    except urllib2.HTTPError, e:
+        if e.code != 304:
+            raise
+        return e
+
+
+def _get(url, headers, timeout, stream):
+    """ Fetches url through the HTTPClient, following redirects. A redirect out of http, to https
+    for instance, is followed through urllib2.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    for _ in range(MAX_REDIRECTS + 1):
+        if deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                raise HTTPDeadlineExceeded("Fetching %s took more than its timeout" % url)
+        if not url.startswith("http://"):
+            return _urllib2_get(url, headers, timeout)
+        resp = _client.get(url, headers, timeout, stream)
+        if resp.code not in (301, 302, 303, 307, 308) or "Location" not in resp:
+            return Page(url, resp)
+        # reading the short body of a redirect keeps its connection
+        Page(url, resp).read()
+        url = urlparse.urljoin(url, resp.get("Location"))
+    raise IOError("Too many redirects: " + url)
+
+
+def urlopen(url, headers=None, conditional=True, timeout=None, stream=False):
+    """ GET url, conditionally on the validators of its last fetch unless conditional is False.
+
+    http URLs are fetched through a shared HTTPClient if POOLED is set, others through urllib2.
+    Fetches give up after CONNECT_TIMEOUT and READ_TIMEOUT, and after timeout seconds in all,
+    redirects included, if timeout is not None. The HTTPClient raises libhttp.HTTPTimeoutError
+    then, urllib2 socket.timeout or urllib2.URLError.
+
+    If stream is set, the body is read as it arrives, through iter_body(page) or page.read().
+    The page must then be closed, unless read was called. Closing it before the body is
+    completely read closes the connection, which saves transferring the rest of the body.
+
+    Returns:
+        A file-like object with getcode() and read(), or None if the page has not been modified
+    since it was last fetched.
+    """
+    headers = dict(headers or {})
+    if conditional:
+        cache = validators()
+        etag, last_modified = cache.get(url)
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    if POOLED and url.startswith("http://"):
+        f = _get(url, headers, timeout, stream)
+    else:
+        f = _urllib2_get(url, headers, timeout)
+    if isinstance(f, Page):
+        getheader = f.getheader
+    else:
+        getheader = f.info().getheader
+    if not conditional:
+        return f
+    if f.getcode() == 304:
+        f.close()
+        return None
+    if f.getcode() == 200:
+        pending = getattr(_staging, "pending", None)
+        if pending is None:
+            cache.update(url, getheader("ETag"), getheader("Last-Modified"))
+        else:
+            pending[url] = (getheader("ETag"), getheader("Last-Modified"))
+    return f
@@ -2,12 +2,34 @@
 # jpc - JSON prototype compiler for python
 #   jpc takes several JSON files as input then generates python code that
 # can be used to serialize/deserialize those JSON data structures.
+#   Generated classes come in one of LAYOUTS:
+#     dict   plain objects, every instance has a __dict__
+#     slots  __slots__ objects, much smaller, and from_dict skips __init__
+#     tuple  read-only tuple subclasses with named properties, the smallest
+#            and fastest to decode
+# All layouts give the same attribute names, the same from_dict decoders, and
+# the same to_dict and to_json_fragment encoders, the latter writing members
+# in a fixed order with their keys encoded beforehand.
+#   A projection, a list of dotted member paths such as "data.list.nickName",
+# restricts the generated classes to those members: others are neither
+# declared nor decoded, and the decoders of skipped objects never run. Paths
+# go through lists to their items, and a path ending on an object keeps all
+# of its members.
+#   With columns, lists of objects decode into <name>_columns containers that
+# hold one column per member instead of one object per item: an array of ints
+# or floats for numeric members, a list for others. Indexing or iterating a
+# container gives <name>_item row views, with the attributes of the items.
+#   Classes also get from_stream decoders, reading a jsonstream.JSONStream
+# instead of a dict decoded beforehand: members not generated are skipped over
+# without being decoded.
 
 import os
 import sys
 import json
 from keyword import iskeyword
 
+LAYOUTS = ("dict", "slots", "tuple")
+
 
 class PythonFormatWriter(object):
     def __init__(self, tab_spaces=4, line_ending='\n'):
@@ -55,10 +77,13 @@ class PythonFormatWriter(object):
 
 
 class JSONObjectMetadata(object):
-    def __init__(self, name):
+    def __init__(self, name, layout="dict"):
         if iskeyword(name):
             raise SyntaxError("Can't use a python keyword as class name: %s" % name)
+        if layout not in LAYOUTS:
+            raise ValueError("Unsupported layout: %s" % layout)
         self._classname = name
+        self._layout = layout
         self._members = []
 
     def add_member(self, key, hint, decoder=None):
@@ -82,6 +107,129 @@ class JSONObjectMetadata(object):
         self._members.append((name, key, default, decoder))
 
     def python_code(self):
+        if self._layout == "slots":
+            return self._slots_code()
+        if self._layout == "tuple":
+            return self._tuple_code()
+        return self._dict_code()
+
+    @staticmethod
+    def _decode_expr(key, decoder):
+        """ Returns the expression decoding member key of dct, for from_dict. """
+        if decoder:
+            return "%s(get(\"%s\"))" % (decoder, key)
+        return "get(\"%s\")" % key
+
+    @staticmethod
+    def _encode_exprs(value, decoder):
+        """ Returns 2-tuple (to_dict, to_json) of the expressions encoding value, which decoder
+        decodes.
+        """
+        if not decoder:
+            return value, "_encode(%s)" % value
+        if decoder.endswith(".from_dict"):
+            return ("(None if %s is None else %s.to_dict())" % (value, value),
+                    "(\"null\" if %s is None else %s.to_json_fragment())" % (value, value))
+        if decoder.endswith(".from_list"):
+            return ("(None if %s is None else %s.to_list())" % (value, value),
+                    "(\"null\" if %s is None else %s.to_json_fragment())" % (value, value))
+        prefix = decoder[:-len("_from_list")]
+        return "%s_to_list(%s)" % (prefix, value), "%s_to_json(%s)" % (prefix, value)
+
+    def _put_encoders(self, w):
+        w.putln("def to_dict(self):")
+        w.indent()
+        w.putln("return {")
+        w.indent()
+        for name, key, default, decoder in self._members:
+            w.putln("\"%s\": %s," % (key, self._encode_exprs("self." + name, decoder)[0]))
+        w.back()
+        w.putln("}")
+        w.back()  # to_dict
+        w.putln()
+
+        w.putln("def to_json_fragment(self):")
+        w.indent()
+        w.putln("return \"\".join((")
+        w.indent()
+        sep = "{"
+        for name, key, default, decoder in self._members:
+            w.putln("%r, %s," % (sep + json.dumps(key) + ":",
+                                 self._encode_exprs("self." + name, decoder)[1]))
+            sep = ","
+        w.putln("%r," % ("}" if self._members else "{}"))
+        w.back()
+        w.putln("))")
+        w.back()  # to_json_fragment
+
+    @staticmethod
+    def _stream_expr(decoder):
+        """ Returns the expression decoding a value which decoder decodes, from stream. """
+        if not decoder:
+            return "stream.value()"
+        if decoder.endswith(".from_dict") or decoder.endswith(".from_list"):
+            return decoder[:-len("from_dict")] + "from_stream(stream)"
+        return decoder[:-len("from_list")] + "from_stream(stream)"
+
+    def _put_members_from_stream(self, w, target):
+        """ Puts the loop decoding the members of an object entered in stream.
+
+        Members are assigned to target(index, name).
+        """
+        w.putln("while key is not None:")
+        w.indent()
+        branch = "if"
+        for i, (name, key, default, decoder) in enumerate(self._members):
+            w.putln("%s key == \"%s\":" % (branch, key))
+            w.indent()
+            w.putln("%s = %s" % (target(i, name), self._stream_expr(decoder)))
+            w.back()
+            branch = "elif"
+        if self._members:
+            w.putln("else:")
+            w.indent()
+        w.putln("stream.skip()")
+        if self._members:
+            w.back()
+        w.putln("key = stream.next_key()")
+        w.back()  # while
+
+    def _put_from_stream(self, w):
+        w.putln("@staticmethod")
+        w.putln("def from_stream(stream):")
+        w.indent()
+        w.putln("if not stream.begin_object():")
+        w.indent()
+        w.putln("return None")
+        w.back()
+        w.putln("key = stream.next_key()")
+        w.putln("if key is None:")
+        w.indent()
+        w.putln("return None")
+        w.back()
+        if self._layout == "tuple":
+            w.putln("values = [None] * %d" % len(self._members))
+            self._put_members_from_stream(w, lambda i, name: "values[%d]" % i)
+            w.putln("return tuple.__new__(%s, values)" % self._classname)
+        else:
+            w.putln("obj = object.__new__(%s)" % self._classname)
+            for name, key, default, decoder in self._members:
+                w.putln("obj.%s = None" % name)
+            self._put_members_from_stream(w, lambda i, name: "obj." + name)
+            w.putln("return obj")
+        w.back()  # from_stream
+
+    def _put_from_dict_head(self, w):
+        w.putln("@staticmethod")
+        w.putln("def from_dict(dct):")
+        w.indent()
+        w.putln("if not dct:")
+        w.indent()
+        w.putln("return None")
+        w.back()
+        w.putln("get = dct.get")
+
+    def _dict_code(self):
         w = PythonFormatWriter()
         w.putln("class %s(object):" % self._classname)
         w.indent()
@@ -111,25 +259,279 @@ class JSONObjectMetadata(object):
                 w.putln("obj.%s = dct.get(\"%s\")" % (name, key))
         w.putln("return obj")
         w.back()  # from_dict
+        w.putln()
+        self._put_from_stream(w)
+        w.putln()
+        self._put_encoders(w)
+
+        w.back()  # class
+        return w.getstr()
+
+    def _slots_code(self):
+        w = PythonFormatWriter()
+        w.putln("class %s(object):" % self._classname)
+        w.indent()
+        w.putln("__slots__ = (%s)" % "".join("\"%s\", " % m[0] for m in self._members))
+        w.putln()
+
+        w.putln("def __init__(self):")
+        w.indent()
+        for name, key, default, decoder in self._members:
+            w.putln("self.%s = %s" % (name, default))
+        if not self._members:
+            w.putln("pass")
+        w.back()  # __init__
+        w.putln()
+
+        # members are assigned once, from dct, instead of over the defaults of __init__
+        self._put_from_dict_head(w)
+        w.putln("obj = object.__new__(%s)" % self._classname)
+        for name, key, default, decoder in self._members:
+            w.putln("obj.%s = %s" % (name, self._decode_expr(key, decoder)))
+        w.putln("return obj")
+        w.back()  # from_dict
+        w.putln()
+        self._put_from_stream(w)
+        w.putln()
+        self._put_encoders(w)
+
+        w.back()  # class
+        return w.getstr()
+
+    def _tuple_code(self):
+        w = PythonFormatWriter()
+        w.putln("class %s(tuple):" % self._classname)
+        w.indent()
+        w.putln("__slots__ = ()")
+        w.putln("_fields = (%s)" % "".join("\"%s\", " % m[0] for m in self._members))
+        w.putln()
+
+        w.putln("def __new__(cls):")
+        w.indent()
+        w.putln("return tuple.__new__(cls, (%s))" % "".join(m[2] + ", " for m in self._members))
+        w.back()  # __new__
+        w.putln()
+
+        for i, m in enumerate(self._members):
+            w.putln("%s = property(itemgetter(%d))" % (m[0], i))
+        if self._members:
+            w.putln()
+
+        self._put_from_dict_head(w)
+        w.putln("return tuple.__new__(%s, (" % self._classname)
+        w.indent()
+        for name, key, default, decoder in self._members:
+            w.putln(self._decode_expr(key, decoder) + ",")
+        w.back()
+        w.putln("))")
+        w.back()  # from_dict
+        w.putln()
+        self._put_from_stream(w)
+        w.putln()
+        self._put_encoders(w)
+
+        w.back()  # class
+        return w.getstr()
+
+
+class JSONColumnsMetadata(JSONObjectMetadata):
+    """ Describes the items of a list of objects, decoded into columns. """
+    def __init__(self, name, columns_name):
+        JSONObjectMetadata.__init__(self, name, "slots")
+        self._columns_name = columns_name
+        self._typecodes = []
+
+    def add_member(self, key, hint, decoder=None):
+        JSONObjectMetadata.add_member(self, key, hint, decoder)
+        if decoder or isinstance(hint, bool):
+            typecode = None
+        elif isinstance(hint, (int, long)):
+            typecode = "l"
+        elif isinstance(hint, float):
+            typecode = "d"
+        else:
+            typecode = None
+        self._typecodes.append(typecode)
+
+    def python_code(self):
+        return self._row_code() + "\n\n" + self._columns_code()
+
+    def _row_code(self):
+        w = PythonFormatWriter()
+        w.putln("class %s(object):" % self._classname)
+        w.indent()
+        w.putln("__slots__ = (\"_columns\", \"_index\")")
+        w.putln()
+
+        w.putln("def __init__(self, columns, index):")
+        w.indent()
+        w.putln("self._columns = columns")
+        w.putln("self._index = index")
+        w.back()  # __init__
+        w.putln()
+
+        for name, key, default, decoder in self._members:
+            w.putln("@property")
+            w.putln("def %s(self):" % name)
+            w.indent()
+            w.putln("return self._columns.%s[self._index]" % name)
+            w.back()
+            w.putln()
+
+        self._put_encoders(w)
+
+        w.back()  # class
+        return w.getstr()
+
+    def _columns_code(self):
+        w = PythonFormatWriter()
+        w.putln("class %s(object):" % self._columns_name)
+        w.indent()
+        w.putln("__slots__ = (%s\"_count\")" % "".join("\"%s\", " % m[0] for m in self._members))
+        w.putln()
+
+        w.putln("def __init__(self):")
+        w.indent()
+        for m, typecode in zip(self._members, self._typecodes):
+            w.putln("self.%s = %s" % (m[0], "array(\"%s\")" % typecode if typecode else "[]"))
+        w.putln("self._count = 0")
+        w.back()  # __init__
+        w.putln()
+
+        w.putln("def __len__(self):")
+        w.indent()
+        w.putln("return self._count")
+        w.back()
+        w.putln()
+
+        w.putln("def __getitem__(self, index):")
+        w.indent()
+        w.putln("if index < 0:")
+        w.indent()
+        w.putln("index += self._count")
+        w.back()
+        w.putln("if not 0 <= index < self._count:")
+        w.indent()
+        w.putln("raise IndexError(\"%s index out of range\")" % self._columns_name)
+        w.back()
+        w.putln("return %s(self, index)" % self._classname)
+        w.back()  # __getitem__
+        w.putln()
+
+        w.putln("def __iter__(self):")
+        w.indent()
+        w.putln("for index in xrange(self._count):")
+        w.indent()
+        w.putln("yield %s(self, index)" % self._classname)
+        w.back()
+        w.back()  # __iter__
+        w.putln()
+
+        # null items are dropped, columns are filled in one pass each
+        w.putln("@staticmethod")
+        w.putln("def from_list(lst):")
+        w.indent()
+        w.putln("if not lst:")
+        w.indent()
+        w.putln("return None")
+        w.back()
+        w.putln("lst = [v for v in lst if v]")
+        w.putln("obj = object.__new__(%s)" % self._columns_name)
+        for (name, key, default, decoder), typecode in zip(self._members, self._typecodes):
+            values = "[%s for v in lst]" % (("%s(v.get(\"%s\"))" % (decoder, key)) if decoder
+                                            else "v.get(\"%s\")" % key)
+            if typecode:
+                values = "_column(\"%s\", %s)" % (typecode, values)
+            w.putln("obj.%s = %s" % (name, values))
+        w.putln("obj._count = len(lst)")
+        w.putln("return obj")
+        w.back()  # from_list
+        w.putln()
+
+        w.putln("@staticmethod")
+        w.putln("def from_stream(stream):")
+        w.indent()
+        w.putln("return %s.from_list(stream.value())" % self._columns_name)
+        w.back()  # from_stream
+        w.putln()
+
+        w.putln("def to_list(self):")
+        w.indent()
+        w.putln("return [row.to_dict() for row in self]")
+        w.back()
+        w.putln()
+
+        w.putln("def to_json_fragment(self):")
+        w.indent()
+        w.putln("return \"[\" + \",\".join([row.to_json_fragment() for row in self]) + \"]\"")
+        w.back()
 
         w.back()  # class
         return w.getstr()
 
 
+_COLUMN_CODE = """def _column(typecode, values):
+    try:
+        return array(typecode, values)
+    except (TypeError, OverflowError):
+        # nulls or values out of the range of typecode
+        return values
+"""
+
+
+def projection_tree(paths):
+    """ Turns dotted member paths into a tree of nested dicts, None marking a kept subtree.
+
+    Returns:
+        The tree, or None if paths is None, which keeps everything.
+    """
+    if paths is None:
+        return None
+    tree = {}
+    for path in paths:
+        node = tree
+        keys = path.split('.')
+        for key in keys[:-1]:
+            sub = node.setdefault(key, {})
+            if sub is None:
+                # an ancestor is kept whole
+                break
+            node = sub
+        else:
+            node[keys[-1]] = None
+    return tree
+
+
 class JSONPrototypeCompiler(object):
-    def __init__(self):
+    def __init__(self, layout="dict", columns=False):
+        if layout not in LAYOUTS:
+            raise ValueError("Unsupported layout: %s" % layout)
+        self._layout = layout
+        self._columns = columns
         self._objs = []
         self._metas = []
         self._decoders = []
 
-    def compile_object(self, name, dct):
+    def compile_object(self, name, dct, projection=None):
+        """ Compiles the prototype dct into classes, the top one being named name.
+
+        Args:
+            projection: Dotted paths of the members to keep, or None to keep all of them.
+        Raises:
+            ValueError: If a path of projection doesn't name a member of dct.
+        """
         self._objs = []
         self._metas = []
         self._decoders = []
-        self._parse_dict(name, dct)
+        self._parse_dict(name, dct, projection_tree(projection))
 
     def python_code(self):
-        code = []
+        code = ["from json import JSONEncoder\n_encode = JSONEncoder().encode\n"]
+        if self._layout == "tuple":
+            code[0] = "from operator import itemgetter\n" + code[0]
+        if self._columns:
+            code[0] = "from array import array\n" + code[0]
+            code.append(_COLUMN_CODE)
         for m in self._metas:
             code.append(m.python_code())
 
@@ -137,29 +539,44 @@ class JSONPrototypeCompiler(object):
             code.append(d)
         return "\n\n".join(code)
 
-    def _parse_dict(self, name, dct):
-        obj = JSONObjectMetadata(name)
+    def _parse_dict(self, name, dct, keep=None):
+        self._parse_members(JSONObjectMetadata(name, self._layout), name, dct, keep)
+        return name + ".from_dict"
+
+    def _parse_members(self, obj, name, dct, keep):
+        if keep is not None:
+            for member in keep:
+                if member not in dct:
+                    raise ValueError("Projection names no member %s of %s" % (member, name))
         self._metas.append(obj)
         self._objs.append((name, dct))
         for member, value in dct.items():
+            if keep is not None and member not in keep:
+                continue
+            sub = keep[member] if keep is not None else None
             decoder = None
             if not value:
                 # null or empty values
                 pass
             elif isinstance(value, dict):
-                decoder = self._parse_dict(name+"_"+member, value)
+                decoder = self._parse_dict(name+"_"+member, value, sub)
             elif isinstance(value, list):
-                decoder = self._parse_list(name+"_"+member, value)
+                decoder = self._parse_list(name+"_"+member, value, sub)
+            if sub is not None and decoder is None:
+                raise ValueError("Projection goes into %s.%s, which has no members" % (name, member))
             obj.add_member(member, value, decoder)
-        return name + ".from_dict"
 
-    def _parse_list(self, name, lst):
+    def _parse_list(self, name, lst, keep=None):
         elem = lst[0]
         item_decoder = None
-        if isinstance(elem, dict):
-            item_decoder = self._parse_dict(name+"_item", elem)
+        if isinstance(elem, dict) and self._columns:
+            self._parse_members(JSONColumnsMetadata(name+"_item", name+"_columns"),
+                                name+"_item", elem, keep)
+            return name + "_columns.from_list"
+        elif isinstance(elem, dict):
+            item_decoder = self._parse_dict(name+"_item", elem, keep)
         elif isinstance(elem, list):
-            item_decoder = self._parse_list(name+"_item", elem)
+            item_decoder = self._parse_list(name+"_item", elem, keep)
 
         if item_decoder:
             list_decoder = name + "_from_list"
@@ -171,12 +588,46 @@ class JSONPrototypeCompiler(object):
             w.putln("return None")
             w.back()
 
+            w.putln("return [%s(v) for v in lst]" % item_decoder)
+            w.back()
+            w.putln()
+            w.putln()
+
+            to_dict, to_json = JSONObjectMetadata._encode_exprs("v", item_decoder)
+            w.putln("def %s_to_list(lst):" % name)
+            w.indent()
+            w.putln("if lst is None:")
+            w.indent()
+            w.putln("return None")
+            w.back()
+            w.putln("return [%s for v in lst]" % to_dict)
+            w.back()
+            w.putln()
+            w.putln()
+
+            w.putln("def %s_to_json(lst):" % name)
+            w.indent()
+            w.putln("if lst is None:")
+            w.indent()
+            w.putln("return \"null\"")
+            w.back()
+            w.putln("return \"[\" + \",\".join([%s for v in lst]) + \"]\"" % to_json)
+            w.back()
+            w.putln()
+            w.putln()
+
+            w.putln("def %s_from_stream(stream):" % name)
+            w.indent()
+            w.putln("if not stream.begin_array():")
+            w.indent()
+            w.putln("return None")
+            w.back()
             w.putln("values = []")
-            w.putln("for v in lst:")
+            w.putln("while stream.next_item():")
             w.indent()
-            w.putln("values.append(%s(v))" % item_decoder)
+            w.putln("values.append(%s)" % JSONObjectMetadata._stream_expr(item_decoder))
             w.back()
-            w.putln("return values")
+            w.putln("return values or None")
             w.back()
             self._decoders.append(w.getstr())
             return list_decoder
@@ -191,6 +642,11 @@ if __name__ == "__main__":
         print("Usage: jpc.py [OPTIONS] <FILE1 [FILE2...]>")
         print("Available OPTIONS:")
         print("  -stdout    print python code to standard output instead of files")
+        print("  -slots     generate __slots__ classes")
+        print("  -tuple     generate read-only tuple classes")
+        print("  -columns   decode lists of objects into columns")
+        print("  -keep=PATH[,PATH...]")
+        print("             generate only the members on these dotted paths, e.g. data.list.nickName")
         exit(0)
 
     option_start = 1
@@ -200,15 +656,24 @@ if __name__ == "__main__":
     options = sys.argv[option_start:option_end]
 
     use_stdout = "-stdout" in options
-
-    jpc = JSONPrototypeCompiler()
+    layout = "dict"
+    if "-slots" in options:
+        layout = "slots"
+    if "-tuple" in options:
+        layout = "tuple"
+    projection = None
+    for o in options:
+        if o.startswith("-keep="):
+            projection = (projection or []) + o[len("-keep="):].split(',')
+
+    jpc = JSONPrototypeCompiler(layout, "-columns" in options)
     for fpath in sys.argv[option_end:]:
         try:
             d = json.load(open(fpath))
             fname = os.path.basename(fpath)
             fdir = fpath[:-len(fname)]
             name = fname.split('.', 1)[0]
-            jpc.compile_object(name, d)
+            jpc.compile_object(name, d, projection)
             if use_stdout:
                 f = stdout
             else:
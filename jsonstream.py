@@ -0,0 +1,207 @@
+# jsonstream - incremental JSON reading
+#   JSONStream walks a JSON document as its text arrives piece by piece, so
+# that a large document never has to be held whole, nor decoded into one tree
+# of dicts and lists. Code generated by jpc drives it through from_stream.
+
+import re
+import json
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# a string, quotes included
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+# the text of a container up to its next bracket, strings included
+_CONTENT = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*', re.DOTALL)
+# numbers, true, false and null
+_SCALAR = re.compile(r'[^ \t\n\r,:\[\]{}"]*')
+# a key and its colon, the way most keys are met
+_KEY = re.compile(r'[ \t\n\r]*"([^"\\]*)"[ \t\n\r]*:')
+
+
+class JSONStream(object):
+    """ A pull reader of a JSON document, fed by an iterable of pieces of its text.
+
+    Objects and arrays are walked with begin_object/next_key and begin_array/next_item, while
+    any value can be decoded whole with value(), or skipped with skip() without building any
+    object. Only the text of the value being read is buffered: the text before it is dropped,
+    the text after it is read from pieces as needed.
+
+    Pieces are str in encoding, strings are decoded to unicode as json.loads does.
+
+    Raises:
+        ValueError: The document is malformed or truncated.
+    """
+    def __init__(self, pieces, encoding='utf-8'):
+        self._pieces = iter(pieces)
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._encoding = encoding
+        self._decode = json.JSONDecoder(encoding=encoding).raw_decode
+        self._first = []        # for each container open, whether no member was read yet
+
+    def begin_object(self):
+        """ Enters the object at the read position.
+
+        Returns:
+            True, or False if the value is null, which is then consumed.
+        """
+        return self._begin("{")
+
+    def next_key(self):
+        """ Reads the key of the next member of the object entered, leaving its value to be read.
+
+        Returns:
+            The key, or None at the end of the object, which is then left.
+        """
+        if not self._next("}"):
+            return None
+        m = _KEY.match(self._buf, self._pos)
+        if m is not None:
+            self._pos = m.end()
+            return m.group(1).decode(self._encoding)
+        # escaped, or not completely buffered yet
+        if self._peek() != '"':
+            raise self._error("a key")
+        key = self.value()
+        if self._peek() != ":":
+            raise self._error("':'")
+        self._pos += 1
+        return key
+
+    def begin_array(self):
+        """ Enters the array at the read position.
+
+        Returns:
+            True, or False if the value is null, which is then consumed.
+        """
+        return self._begin("[")
+
+    def next_item(self):
+        """ Moves to the next item of the array entered, leaving it to be read.
+
+        Returns:
+            True, or False at the end of the array, which is then left.
+        """
+        return self._next("]")
+
+    def value(self):
+        """ Reads and decodes the value at the read position. """
+        end = self._scan(True)
+        try:
+            v, end = self._decode(self._buf, self._pos)
+        except ValueError, e:
+            raise ValueError("JSONStream: %s" % e)
+        self._pos = end
+        return v
+
+    def skip(self):
+        """ Reads the value at the read position without decoding it. """
+        self._pos = self._scan(False)
+
+    def _begin(self, bracket):
+        c = self._peek()
+        if c == bracket:
+            self._pos += 1
+            self._first.append(True)
+            return True
+        if c == "n" and self.value() is None:
+            return False
+        raise self._error("'%s' or null" % bracket)
+
+    def _next(self, bracket):
+        c = self._peek()
+        if c == bracket:
+            self._pos += 1
+            self._first.pop()
+            return False
+        if self._first[-1]:
+            self._first[-1] = False
+        elif c == ",":
+            self._pos += 1
+        else:
+            raise self._error("',' or '%s'" % bracket)
+        return True
+
+    def _error(self, expected):
+        found = self._buf[self._pos:self._pos+16]
+        if not found:
+            return ValueError("JSONStream: expected %s, found the end of the document" % expected)
+        return ValueError("JSONStream: expected %s, found %r" % (expected, found))
+
+    def _fill(self):
+        """ Appends the next piece to the buffer, dropping the text before the read position.
+
+        Returns:
+            The number of characters dropped, or -1 at the end of the document.
+        """
+        for piece in self._pieces:
+            if piece:
+                break
+        else:
+            self._eof = True
+            return -1
+        dropped = self._pos
+        self._buf = self._buf[dropped:] + piece
+        self._pos = 0
+        return dropped
+
+    def _peek(self):
+        """ Skips whitespace and returns the next character, "" at the end of the document. """
+        c = self._buf[self._pos:self._pos+1]
+        if c and c not in " \t\n\r":
+            return c
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or self._fill() < 0:
+                return self._buf[self._pos:self._pos+1]
+
+    def _scan(self, keep):
+        """ Finds the end of the value at the read position, reading pieces till it's buffered.
+
+        If keep is False, the read position follows the scan so that the text scanned is
+        dropped as the buffer is refilled.
+
+        Returns:
+            The offset in the buffer of the end of the value.
+        """
+        c = self._peek()
+        if not c:
+            raise self._error("a value")
+        i = self._pos
+        if c not in '"[{':
+            while True:
+                end = _SCALAR.match(self._buf, i).end()
+                if end < len(self._buf) or self._eof:
+                    if end == i:
+                        raise self._error("a value")
+                    return end
+                # the scalar may go on in the next piece
+                if not keep:
+                    self._pos = i
+                i -= max(self._fill(), 0)
+
+        depth = 0
+        while True:
+            if depth:
+                i = _CONTENT.match(self._buf, i).end()
+            c = self._buf[i:i+1]
+            if c == '"':
+                s = _STRING.match(self._buf, i)
+                if s is not None:
+                    i = s.end()
+                    if depth == 0:
+                        return i
+                    continue
+                # the string is scanned again from its quote once the next piece is read
+            elif c:
+                i += 1
+                depth += 1 if c in "[{" else -1
+                if depth == 0:
+                    return i
+                continue
+            if not keep:
+                self._pos = i
+            dropped = self._fill()
+            if dropped < 0:
+                raise ValueError("JSONStream: truncated document")
+            i -= dropped
@@ -1,27 +1,15 @@
+import os
+import sys
+import time
+import heapq
+import errno
+import types
+import bisect
 import socket
 import select
-
-
-class StringBuilder(object):
-    """ An helper class used to build string. """
-    def __init__(self):
-        self._pieces = []
-        self._length = 0
-
-    def __str__(self):
-        return ''.join(self._pieces)
-
-    def __len__(self):
-        return self._length
-
-    @property
-    def length(self):
-        return self._length
-
-    def append(self, x):
-        p = str(x)
-        self._length += len(p)
-        return self._pieces.append(p)
+import urlparse
+import threading
+import collections
 
 
 class HTTPAddress(object):
@@ -35,6 +23,12 @@ class HTTPAddress(object):
     def __eq__(self, other):
         return isinstance(other, HTTPAddress) and self.host == other.host and self.port == other.port
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.host, self.port))
+
     @property
     def fullname(self):
         """ Returns 'host:port' """
@@ -117,14 +111,20 @@ class HTTPStatus:
 
 
 class HTTPHeaders(object):
+    """ An ordered list of HTTP header fields, which may hold several fields of the same name.
+
+    Fields keep the name they were added with, but are looked up case-insensitively through an
+    index from lower-cased names to positions, so that lookups don't scan the list.
+    """
     def __init__(self):
         self._items = []
+        self._index = {}         # lower-cased name -> ascending positions in _items
 
     def __len__(self):
         return len(self._items)
 
     def __contains__(self, key):
-        return self.find(key) != -1
+        return key.lower() in self._index
 
     def __getitem__(self, key):
         val = self.get(key)
@@ -149,69 +149,83 @@ class HTTPHeaders(object):
             yield item[1]
 
     def get(self, key, default_value=None):
-        key = key.lower()
-        for item in self._items:
-            if key == item[0].lower():
-                return item[1]
+        positions = self._index.get(key.lower())
+        if positions:
+            return self._items[positions[0]][1]
         return default_value
 
     def getall(self, key):
         """ Get all header values associated with the specified key.
         :return: A list of values that are associated with the key
         """
-        values = []
-        key = key.lower()
-        for item in self._items:
-            if key == item[0].lower():
-                values.append(item[1])
-        return values
+        items = self._items
+        return [items[i][1] for i in self._index.get(key.lower(), ())]
 
     def set(self, key, value):
+        """ Sets the value of the first header matching the key, or appends a header if none. """
         i = self.find(key)
         if i != -1:
-            self._items[i] = (key, value)
-        self.append((key, value))
+            self._items[i] = (str(key), str(value))
+        else:
+            self.append((key, value))
 
     def setall(self, key, value):
         i = self.find(key)
         if i != -1:
-            self._items[i] = (key, value)
+            self._items[i] = (str(key), str(value))
             # remove other values
-            self.remove(key, i + 1)
+            self.removeall(key, i + 1)
         else:
             self.append((key, value))
 
     def find(self, key, start=0):
-        key = key.lower()
-        for i in range(start, len(self._items)):
-            if key == self._items[i][0].lower():
-                return i
+        positions = self._index.get(key.lower())
+        if positions:
+            if start <= positions[0]:
+                return positions[0]
+            i = bisect.bisect_left(positions, start)
+            if i < len(positions):
+                return positions[i]
         return -1
 
     def append(self, kv):
-        self._items.append((str(kv[0]), str(kv[1])))
+        key = str(kv[0])
+        lkey = key.lower()
+        positions = self._index.get(lkey)
+        if positions is None:
+            self._index[lkey] = [len(self._items)]
+        else:
+            positions.append(len(self._items))
+        self._items.append((key, str(kv[1])))
 
     def remove(self, key, start=0):
         """ Removes the first header matching the key starting from start """
         i = self.find(key, start)
         if i != -1:
-            self._items.pop(i)
+            self.pop(i)
 
     def removeall(self, key, start=0):
         """ Removes all headers matching the key starting from start """
-        i = self.find(key, start)
-        while i != -1:
-            self._items.pop(i)
-            i = self.find(key, i)
+        positions = self._index.get(key.lower(), ())
+        removed = set(i for i in positions if i >= start)
+        if removed:
+            self._items = [item for i, item in enumerate(self._items) if i not in removed]
+            self._reindex()
 
     def pop(self, i):
         """ Removes the i-th header. """
         self._items.pop(i)
+        self._reindex()
 
     def at(self, i):
         """ Gets the i-th header. Returns 2-tuple (key, value) """
         return self._items[i]
 
+    def _reindex(self):
+        self._index = {}
+        for i, item in enumerate(self._items):
+            self._index.setdefault(item[0].lower(), []).append(i)
+
 
 class HTTPMessage(object):
     def __init__(self):
@@ -220,14 +234,17 @@ class HTTPMessage(object):
         self.body_pending = False
 
     def __str__(self):
-        s = StringBuilder()
-        s.append(self.start + "\r\n")
+        if self.body:
+            return self.header_str() + self.body
+        return self.header_str()
+
+    def header_str(self):
+        """ Returns the start line and header fields, ending with the empty line. """
+        s = [self.start, "\r\n"]
         for k, v in self.headers.items():
-            s.append(k + ": " + v + "\r\n")
+            s.extend((k, ": ", v, "\r\n"))
         s.append("\r\n")
-        if self.body:
-            s.append(self.body)
-        return str(s)
+        return ''.join(s)
 
     def __contains__(self, item):
         return self.headers.__contains__(item)
@@ -338,6 +355,9 @@ class HTTPResponse(HTTPMessage):
         while start_line[a] == ' ':
             a += 1
         b = start_line.find(' ', a)
+        if b == -1:
+            # no reason phrase
+            b = len(start_line)
         self.code = int(start_line[a:b])
         self.phrase = start_line[b:].strip(" \t")
 
@@ -352,25 +372,484 @@ class HTTPResponse(HTTPMessage):
         self.phrase = r[2]
 
 
-class HTTPInputStream(object):
-    """ An HTTPInputStream represents an inbound HTTP octet stream. """
+# HTTPParser states
+_PARSE_START = 0
+_PARSE_HEADERS = 1
+_PARSE_LENGTH = 2
+_PARSE_CHUNK_SIZE = 3
+_PARSE_CHUNK_DATA = 4
+_PARSE_CHUNK_END = 5
+_PARSE_TRAILERS = 6
+_PARSE_CLOSE = 7
+_PARSE_COMPLETE = 8
+_PARSE_UPGRADED = 9
+
+
+class HTTPParser(object):
+    """ An incremental HTTP message parser doing no I/O.
+
+    Bytes are fed to the parser as they arrive, in pieces of any size, and it reports what they
+    complete as events, 2-tuples (event, value):
+        (START_LINE, message)       the start line has been parsed into message
+        (HEADERS, message)          the header fields have been added to message
+        (BODY, data)                a piece of the message body
+        (MESSAGE_COMPLETE, message) the message is complete, trailer fields included
+    Messages are HTTPRequest or HTTPResponse objects. Message bodies are not kept by the parser,
+    which holds nothing but the bytes of the field it's parsing.
+
+    The body of a message is delimited by a "chunked" Transfer-Encoding, Content-Length, or for
+    responses, the end of the connection, which feed_eof() tells. Responses to HEAD, set as
+    request_method, like 1xx, 204 and 304 responses have no body. After a 101 or a 2xx response
+    to CONNECT, or a CONNECT request, the bytes that follow belong to another protocol. The
+    parser then stops, and leaves them in trailing_data.
+
+    feed() and feed_eof() parse data of their own. Streams with a buffer of their own call parse()
+    on it instead, so that no byte is copied before it's parsed.
+    """
+    START_LINE = "start_line"
+    HEADERS = "headers"
+    BODY = "body"
+    MESSAGE_COMPLETE = "message_complete"
+
+    def __init__(self, message_class=HTTPRequest, line_limit=128 * 1024):
+        self.message_class = message_class
+        self.line_limit = line_limit   # maximum length of a start line, chunk size or header section
+        self.request_method = None     # method of the request answered by responses
+        self._data = ""                # data fed but not parsed yet
+        self.reset()
+
+    def reset(self, m=None):
+        """ Starts parsing a new message, into m if it's not None. """
+        self._state = _PARSE_START
+        self._message = m
+        self._framing = None
+        self._remaining = 0
+        self._scan = 0                 # bytes already searched for a delimiter
+
+    @property
+    def message(self):
+        """ The message being parsed, None if its start line has not been parsed yet. """
+        return self._message
+
+    @property
+    def framing(self):
+        """ How the body of the message is delimited, known once its headers have been parsed:
+        None if it has no body, "length", "chunked" or "close".
+        """
+        return self._framing
+
+    @property
+    def upgraded(self):
+        """ Whether the connection has left HTTP. """
+        return self._state == _PARSE_UPGRADED
+
+    @property
+    def trailing_data(self):
+        """ Data fed but not parsed. """
+        return self._data
+
+    def feed(self, data):
+        """ Parses data following what has been fed so far.
+
+        Returns:
+            A list of the events completed by data.
+
+        Raises:
+            IOError: Something is wrong with the message format.
+        """
+        if data:
+            self._data += data
+        return self._parse_fed(False)
+
+    def feed_eof(self):
+        """ Tells the parser the connection has been closed.
+
+        Returns:
+            A list of the events completed by the end of the connection.
+
+        Raises:
+            IOError: Something is wrong with the message format.
+            EOFError: The connection was closed in the middle of a message.
+        """
+        return self._parse_fed(True)
+
+    def _parse_fed(self, eof):
+        events = []
+        while True:
+            pos, event = self.parse(self._data, 0, len(self._data), eof)
+            if pos:
+                self._data = self._data[pos:]
+            if event is None:
+                return events
+            events.append(event)
+
+    def parse(self, buf, start, end, eof=False, view=None, max_body=0):
+        """ Parses the next event out of buf[start:end].
+
+        Args:
+            buf: A str or a bytearray.
+            start, end: Offsets of the data to parse in buf.
+            eof: Whether the connection has been closed after buf[end - 1].
+            view: An optional memoryview of buf, which BODY data is copied out of.
+            max_body: Maximum length of BODY data, 0 for no limit.
+
+        Returns:
+            2-tuple (offset, event). offset is where parsing stopped in buf, and event is None if
+        more data is needed to complete one.
+
+        Raises:
+            IOError: Something is wrong with the message format.
+            EOFError: eof is set and the connection was closed in the middle of a message.
+        """
+        while True:
+            state = self._state
+            if state == _PARSE_START:
+                pos = self._find(buf, "\r\n", start, end, eof, "start line")
+                if pos == -1:
+                    return start, None
+                if pos == start:
+                    # empty lines ahead of a message are ignored
+                    start += 2
+                    continue
+                m = self._message
+                if m is None:
+                    m = self._message = self.message_class()
+                line = view[start:pos].tobytes() if view is not None else str(buf[start:pos])
+                try:
+                    m.start = line
+                except (ValueError, IndexError):
+                    raise IOError("Bad HTTP start line: " + repr(line))
+                self._state = _PARSE_HEADERS
+                return pos + 2, (HTTPParser.START_LINE, m)
+
+            elif state == _PARSE_HEADERS or state == _PARSE_TRAILERS:
+                pos = self._find_headers(buf, start, end, eof)
+                if pos == -1:
+                    return start, None
+                m = self._message
+                if pos > start:
+                    block = view[start:pos].tobytes() if view is not None else str(buf[start:pos])
+                    for kv in self.split_headers(block):
+                        m.add(kv)
+                    pos += 2
+                pos += 2
+                if state == _PARSE_TRAILERS:
+                    self._state = _PARSE_COMPLETE
+                    start = pos
+                    continue
+                self._frame(m)
+                return pos, (HTTPParser.HEADERS, m)
+
+            elif state == _PARSE_LENGTH or state == _PARSE_CHUNK_DATA \
+                    or state == _PARSE_CLOSE:
+                n = end - start
+                if state != _PARSE_CLOSE and n > self._remaining:
+                    n = self._remaining
+                if max_body and n > max_body:
+                    n = max_body
+                if n == 0:
+                    if not eof:
+                        return start, None
+                    if state != _PARSE_CLOSE:
+                        raise EOFError("HTTPParser: connection closed in message body")
+                    self._state = _PARSE_COMPLETE
+                    continue
+                if view is not None:
+                    d = view[start:start+n].tobytes()
+                else:
+                    d = str(buf[start:start+n])
+                self._remaining -= n
+                if self._remaining == 0:
+                    if state == _PARSE_LENGTH:
+                        self._state = _PARSE_COMPLETE
+                    elif state == _PARSE_CHUNK_DATA:
+                        self._state = _PARSE_CHUNK_END
+                return start + n, (HTTPParser.BODY, d)
+
+            elif state == _PARSE_CHUNK_SIZE:
+                pos = self._find(buf, "\r\n", start, end, eof, "chunk size")
+                if pos == -1:
+                    return start, None
+                line = str(buf[start:pos])
+                try:
+                    size = int(line.split(';', 1)[0].strip(" \t"), 16)
+                except ValueError:
+                    raise IOError("Corrupted chunk stream: bad chunk size " + repr(line))
+                if size < 0:
+                    raise IOError("Corrupted chunk stream: bad chunk size " + repr(line))
+                self._remaining = size
+                self._state = _PARSE_CHUNK_DATA if size else _PARSE_TRAILERS
+                start = pos + 2
+
+            elif state == _PARSE_CHUNK_END:
+                if end - start < 2:
+                    if eof:
+                        raise EOFError("HTTPParser: connection closed in chunk")
+                    return start, None
+                if not buf.startswith("\r\n", start, end):
+                    raise IOError("Corrupted chunk stream: inconsistent chunk size.")
+                self._state = _PARSE_CHUNK_SIZE
+                start += 2
+
+            elif state == _PARSE_COMPLETE:
+                m = self._message
+                upgraded = self._is_upgrade(m)
+                self.reset()
+                if upgraded:
+                    self._state = _PARSE_UPGRADED
+                return start, (HTTPParser.MESSAGE_COMPLETE, m)
+
+            else:
+                # _UPGRADED
+                return start, None
+
+    @staticmethod
+    def split_headers(block):
+        """ Splits a header section, excluding the empty line ending it, into header fields.
+
+        Folded field values are unfolded.
+
+        Returns:
+            A list of 2-tuples (name, value).
+        """
+        headers = []
+        for line in block.split("\r\n"):
+            if line[0] in " \t" and headers:
+                # folded header field value
+                name, value = headers[-1]
+                headers[-1] = (name, value + line.strip(" \t"))
+            else:
+                p = line.find(":")
+                headers.append((line[:p].strip(" \t"), line[p + 1:].strip(" \t")))
+        return headers
+
+    def _find(self, buf, delim, start, end, eof, what):
+        """ Finds delim in buf[start:end], not searching bytes searched by the last call again.
+
+        Returns:
+            Offset of delim, -1 if more data is needed.
+        """
+        pos = buf.find(delim, start + self._scan, end)
+        if pos != -1:
+            self._scan = 0
+            return pos
+        if eof:
+            if self._state == _PARSE_START and start == end:
+                return -1
+            raise EOFError("HTTPParser: connection closed in " + what)
+        if end - start >= self.line_limit:
+            raise IOError("HTTPParser: %s too long" % what)
+        self._scan = max(0, end - start - len(delim) + 1)
+        return -1
+
+    def _find_headers(self, buf, start, end, eof):
+        """ Returns offset of the CRLF ending the last field of a header section, or start if
+        the section is empty, -1 if more data is needed.
+        """
+        if end - start >= 2 and buf.startswith("\r\n", start, end):
+            return start
+        if end - start < 2 and not eof:
+            return -1
+        return self._find(buf, "\r\n\r\n", start, end, eof, "header section")
+
+    def _frame(self, m):
+        """ Tells how the body of m is delimited from its headers. """
+        self._framing = None
+        if isinstance(m, HTTPResponse):
+            if self.request_method == "HEAD" or 100 <= m.code < 200 or m.code in (204, 304) \
+                    or (self.request_method == "CONNECT" and 200 <= m.code < 300):
+                self._state = _PARSE_COMPLETE
+                return
+        codings = m.get("Transfer-Encoding", "").lower()
+        if codings:
+            if codings.split(",")[-1].strip(" \t") == "chunked":
+                self._framing = "chunked"
+                self._state = _PARSE_CHUNK_SIZE
+                return
+            if isinstance(m, HTTPRequest):
+                raise IOError("Request body of unknown length: " + codings)
+        else:
+            length = m.get("Content-Length")
+            if length is not None:
+                try:
+                    self._remaining = int(length)
+                except ValueError:
+                    self._remaining = -1
+                if self._remaining < 0:
+                    raise IOError("Invalid Content-Length: " + length)
+                self._framing = "length"
+                self._state = _PARSE_LENGTH if self._remaining else _PARSE_COMPLETE
+                return
+            if isinstance(m, HTTPRequest):
+                self._state = _PARSE_COMPLETE
+                return
+        self._framing = "close"
+        self._state = _PARSE_CLOSE
+
+    def _is_upgrade(self, m):
+        if isinstance(m, HTTPRequest):
+            return m.method == "CONNECT"
+        return m.code == 101 or (self.request_method == "CONNECT" and 200 <= m.code < 300)
+
+
+class HTTPTimeoutError(IOError):
+    """ Base class of the timeouts of HTTP streams. """
+
+
+class HTTPConnectTimeout(HTTPTimeoutError):
+    """ A connection was not established within the connect timeout. """
+
+
+class HTTPReadTimeout(HTTPTimeoutError):
+    """ The peer sent or took nothing for longer than the read timeout. """
+
+
+class HTTPDeadlineExceeded(HTTPTimeoutError):
+    """ An operation was not complete by the deadline set on the stream. """
+
+
+class _StreamTimeouts(object):
+    """ The read timeout and the deadline of a stream, applied to each socket operation. """
+    _read_timeout = None
+    _deadline = None
+
+    @property
+    def read_timeout(self):
+        """ Seconds a socket read or write may wait for the peer, None for no limit. """
+        return self._read_timeout
+
+    @read_timeout.setter
+    def read_timeout(self, timeout):
+        self._read_timeout = timeout
+        if self._conn is not None:
+            self._conn.settimeout(timeout)
+
+    @property
+    def deadline(self):
+        """ time.time() by which operations must be complete, None for no deadline. """
+        return self._deadline
+
+    def set_deadline(self, seconds):
+        """ Makes operations fail with HTTPDeadlineExceeded after seconds from now, or never if
+        seconds is None. """
+        if seconds is None:
+            self._deadline = None
+            if self._conn is not None:
+                self._conn.settimeout(self._read_timeout)
+        else:
+            self._deadline = time.time() + seconds
+
+    def _arm(self):
+        """ Sets the socket timeout of the next operation to what is left before the deadline. """
+        if self._deadline is not None:
+            left = self._deadline - time.time()
+            if left <= 0:
+                raise HTTPDeadlineExceeded("HTTP stream deadline exceeded")
+            if self._read_timeout is not None and self._read_timeout < left:
+                left = self._read_timeout
+            self._conn.settimeout(left)
+
+    def _timeout_error(self):
+        if self._deadline is not None and time.time() >= self._deadline - 0.001:
+            return HTTPDeadlineExceeded("HTTP stream deadline exceeded")
+        return HTTPReadTimeout("HTTP stream timed out after %ss" % self._read_timeout)
+
+
+def _connect(addr, timeout):
+    """ Connects to addr, an HTTPAddress or a (host, port) tuple, within timeout seconds. """
+    if isinstance(addr, HTTPAddress):
+        addr = (addr.host, addr.port)
+    try:
+        return socket.create_connection(addr, timeout)
+    except socket.timeout:
+        raise HTTPConnectTimeout("Connecting to %s:%s timed out" % addr)
+
+
+class _InputBuffer(object):
+    """ The read buffer of an inbound HTTP stream, and the HTTPParser parsing it.
+
+    Received data is kept in a growable bytearray between a read offset and a write offset. The
+    socket fills the buffer in place through recv_into, and data is extracted through memoryview
+    slices, so consuming data never copies what is left behind it. Unread data is moved to the
+    front of the buffer only when there is no room left after it.
+
+    It's shared by HTTPInputStream, which blocks on the socket, and AsyncHTTPIOStream, which
+    doesn't. Each receives data with a _recv_into(view, n) of its own.
+    """
     BUFFER_LIMIT = 128 * 1024
+    BUFFER_SIZE = 16 * 1024
 
     def __init__(self, conn=None):
         self._conn = conn              # socket connection
         self._bytes_in = 0
-        self._rdbuf = ""               # read buffer
+        self._buf = bytearray(_InputBuffer.BUFFER_SIZE)   # read buffer
+        self._view = memoryview(self._buf)
+        self._rpos = 0                 # offset of unread data in the read buffer
+        self._wpos = 0                 # offset of free space in the read buffer
+        self._parser = HTTPParser(line_limit=_InputBuffer.BUFFER_LIMIT)
 
     @property
     def rdbuf(self):
         """ Gets the read buffer """
-        return self._rdbuf
+        return self._view[self._rpos:self._wpos].tobytes()
+
+    @property
+    def framing(self):
+        """ How the pending body of the message being read is delimited, see HTTPParser. """
+        return self._parser.framing
 
     @property
     def bytes_in(self):
         """ Total number of bytes read from the socket """
         return self._bytes_in
 
+    def _discard_buffer(self):
+        self._rpos = self._wpos = 0
+
+    def _recv(self):
+        """ Receives data from the socket and appends it to the read buffer.
+
+        Unread data is moved to the front of the buffer if there is no room after it, and the
+        buffer is enlarged if it's more than half full of unread data.
+
+        Returns:
+            Number of bytes received, 0 if the connection has been closed, None if nothing can
+        be received without blocking.
+        """
+        if self._rpos == self._wpos:
+            self._rpos = self._wpos = 0
+        elif self._wpos == len(self._buf):
+            unread = self._wpos - self._rpos
+            if unread * 2 > len(self._buf):
+                buf = bytearray(len(self._buf) * 2)
+                buf[:unread] = self._view[self._rpos:self._wpos]
+                self._buf = buf
+                self._view = memoryview(buf)
+            else:
+                self._buf[:unread] = self._view[self._rpos:self._wpos].tobytes()
+            self._rpos = 0
+            self._wpos = unread
+
+        n = self._recv_into(self._view[self._wpos:], len(self._buf) - self._wpos)
+        if n:
+            self._wpos += n
+            self._bytes_in += n
+        return n
+
+
+class HTTPInputStream(_InputBuffer, _StreamTimeouts):
+    """ An HTTPInputStream represents an inbound HTTP octet stream, read by blocking on its
+    socket. See _InputBuffer for how received data is buffered.
+    """
+    def _recv_into(self, view, n):
+        self._arm()
+        try:
+            return self._conn.recv_into(view, n)
+        except socket.timeout:
+            raise self._timeout_error()
+        except Exception, e:
+            raise IOError(str(e))
+
     def wait(self):
         """ Wait till the underlying socket object is ready for reading.
 
@@ -380,13 +859,9 @@ class HTTPInputStream(object):
             Number of bytes available for reading, which may be 0 if the read buffer
         is empty and the connection has been closed.
         """
-        if not self._rdbuf:
-            try:
-                self._rdbuf = self._conn.recv(HTTPInputStream.BUFFER_LIMIT)
-                self._bytes_in += len(self._rdbuf)
-            except Exception, e:
-                raise IOError(str(e))
-        return len(self._rdbuf)
+        if self._rpos == self._wpos:
+            self._recv()
+        return self._wpos - self._rpos
 
     def read_some(self, max_count):
         """ Read up to max_count bytes from the stream.
@@ -399,9 +874,10 @@ class HTTPInputStream(object):
         """
         if not self.wait():
             return ""
-        r = self._rdbuf[:max_count]
-        self._rdbuf = self._rdbuf[max_count:]
-        return r
+        a = self._rpos
+        b = min(self._wpos, a + max_count)
+        self._rpos = b
+        return self._view[a:b].tobytes()
 
     def read(self, n):
         """ Read exactly n bytes from the stream.
@@ -416,18 +892,54 @@ class HTTPInputStream(object):
             IOError: An error occurred reading the underlying socket.
             EOFError: EOF was encountered before read complete.
         """
-        r = StringBuilder()
-        while len(r) < n:
-            if not self.wait():
+        if n <= len(self._buf):
+            while self._wpos - self._rpos < n:
+                if not self._recv():
+                    raise EOFError("Connection closed unexpectedly.")
+            a = self._rpos
+            self._rpos += n
+            return self._view[a:a+n].tobytes()
+
+        # Larger than the read buffer: receive straight into the result
+        r = bytearray(n)
+        view = memoryview(r)
+        got = self._wpos - self._rpos
+        view[:got] = self._view[self._rpos:self._wpos]
+        self._discard_buffer()
+        while got < n:
+            count = self._recv_into(view[got:], n - got)
+            if not count:
                 raise EOFError("Connection closed unexpectedly.")
-
-            a = n - r.length
-            if a < len(self._rdbuf):
-                a = len(self._rdbuf)
-            r.append(self._rdbuf[:a])
-            self._rdbuf = self._rdbuf[a:]
+            got += count
+            self._bytes_in += count
         return str(r)
 
+    def _find(self, delim, caller):
+        """ Finds delim in the stream, receiving data till it's found.
+
+        Bytes already searched are not searched again after more data is received, except for
+        the last len(delim) - 1 of them, in case delim is split between two receptions.
+
+        Returns:
+            Offset of delim in the read buffer.
+
+        Raises:
+            IOError: An error occurred reading the underlying socket, or more than BUFFER_LIMIT
+                bytes were searched.
+            EOFError: EOF was encountered before delim.
+        """
+        scan = 0                       # relative to the read offset, which _recv may move
+        while True:
+            pos = self._buf.find(delim, self._rpos + scan, self._wpos)
+            if pos != -1:
+                return pos
+
+            if self._wpos - self._rpos >= HTTPInputStream.BUFFER_LIMIT:
+                raise IOError("HTTPInputStream.%s too long" % caller)
+            scan = max(0, self._wpos - self._rpos - len(delim) + 1)
+            if not self._recv():
+                raise EOFError("HTTPInputStream.%s EOF" % caller)
+
     def read_line(self):
         """ Extracts characters from the stream till a CRLF is encountered.
 
@@ -440,23 +952,10 @@ class HTTPInputStream(object):
             IOError: An error occurred reading the underlying socket.
             EOFError: EOF was encountered before read complete.
         """
-        r = StringBuilder()
-        crlf_pos = -1
-        while crlf_pos == -1:
-            if len(r) >= HTTPInputStream.BUFFER_LIMIT:
-                raise IOError("HTTPInputStream.read_line too long")
-
-            if not self.wait():
-                raise EOFError("HTTPInputStream.read_line EOF")
-
-            crlf_pos = self._rdbuf.find("\r\n")
-            if crlf_pos != -1:
-                r.append(self._rdbuf[:crlf_pos])
-                self._rdbuf = self._rdbuf[crlf_pos + 2:]
-            else:
-                r.append(self._rdbuf)
-                self._rdbuf = ""
-        return str(r)
+        crlf_pos = self._find("\r\n", "read_line")
+        a = self._rpos
+        self._rpos = crlf_pos + 2
+        return self._view[a:crlf_pos].tobytes()
 
     def read_chunk(self):
         """ Extracts a chunk from the stream.
@@ -465,7 +964,10 @@ class HTTPInputStream(object):
             CHUNK = CHUNK-SIZE CRLF
                     CHUNK-BODY CRLF
         This method reads the whole chunk and returns chunk-body. The chunk-size is
-        implied by the length of returned data.
+        implied by the length of returned data. Chunk extensions are ignored.
+
+        The last chunk has a chunk-size of 0 and no chunk-body. An empty string is returned
+        for it, and the trailer section that follows is left in the stream.
 
         Returns:
             Chunk-body, a string object.
@@ -475,13 +977,81 @@ class HTTPInputStream(object):
                 the chunk format.
             EOFError: EOF was encountered before read complete.
         """
-        chunk_size = int(self.read_line())
+        chunk_header = self.read_line()
+        try:
+            chunk_size = int(chunk_header.split(';', 1)[0].strip(" \t"), 16)
+        except ValueError:
+            raise IOError("Corrupted chunk stream: bad chunk size " + repr(chunk_header))
+        if chunk_size == 0:
+            return ""
         d = self.read(chunk_size)
         if self.read(2) != "\r\n":
             raise IOError("Corrupted chunk stream: inconsistent chunk size.")
         return d
 
-    def read_message(self, m):
+    def _next_event(self, max_body=0):
+        """ Parses the next event out of the read buffer, receiving data till one is complete. """
+        parser = self._parser
+        while True:
+            self._rpos, event = parser.parse(self._buf, self._rpos, self._wpos, False, self._view,
+                                             max_body)
+            if event is not None:
+                return event
+            if not self._recv():
+                self._rpos, event = parser.parse(self._buf, self._rpos, self._wpos, True,
+                                                 self._view, max_body)
+                if event is None:
+                    raise EOFError("Connection closed unexpectedly.")
+                return event
+
+    def iter_body(self, m, chunk_size=_InputBuffer.BUFFER_SIZE):
+        """ Extracts the pending body of a message piece by piece.
+
+        The framing of the body is taken from the headers of m: a "chunked" Transfer-Encoding,
+        then Content-Length. A response with neither is delimited by the end of the connection,
+        while a request with neither has no body. Trailer fields of a chunked body are added to
+        the headers of m. Only one piece is held at a time, however large the body is.
+
+        The body_pending flag of m is cleared once the body has been completely extracted. If
+        it's not set, the body already read, if any, is yielded as the only piece.
+
+        Args:
+            m: An HTTPMessage returned by read_message, read_request or read_response.
+            chunk_size: Maximum length of the pieces.
+
+        Yields:
+            Non-empty strings, the pieces of the body in order.
+
+        Raises:
+            IOError: An error occurred reading the underlying socket or something is wrong with
+                the message framing.
+            EOFError: EOF was encountered before the end of the body.
+        """
+        if not m.body_pending:
+            if m.body:
+                yield m.body
+            return
+        if self._parser.message is not m:
+            raise IOError("HTTPInputStream.iter_body: not the message being read")
+
+        event, value = self._next_event(chunk_size)
+        while event == HTTPParser.BODY:
+            yield value
+            event, value = self._next_event(chunk_size)
+        m.body_pending = False
+
+    def read_body(self, m):
+        """ Extracts the pending body of a message into m.body.
+
+        See iter_body for how the body is delimited.
+
+        Returns:
+            m
+        """
+        m.body = ''.join(self.iter_body(m))
+        return m
+
+    def read_message(self, m, with_body=True):
         """ Extracts an HTTP message from the stream.
 
         Note that the message body will be extracted only when Content-Length header is present and
@@ -490,38 +1060,35 @@ class HTTPInputStream(object):
         body is missing or not.
 
         If the body_pending flag of the returned message is set, it simply means that the message
-         body is not processed.
+        body is not processed. It can then be extracted with iter_body or read_body.
+
+        If with_body is False, only the start line and headers are extracted, and the body is left
+        to the caller.
 
         Raises:
             IOError: An error occurred reading the underlying socket.
             EOFError: EOF was encountered before read complete.
         """
-        m.start = self.read_line()
-        prev_line = ""
-        curr_line = self.read_line()
-        while len(curr_line):
-            if curr_line[0] in " \t":
-                # folded header field value
-                prev_line += curr_line.strip(" \t")
-            else:
-                if len(prev_line):
-                    m.add(self._split_header(prev_line))
-                prev_line = curr_line
-            curr_line = self.read_line()
-
-        if len(prev_line):
-            m.add(self._split_header(prev_line))
+        self._parser.reset(m)
+        self._next_event()             # START_LINE
+        self._next_event()             # HEADERS
 
-        # Read message body only when the size of body is explicitly told
-        # and the size of message body is under buffer size limit
         m.body = ""
-        body_size = m.get_int("Content-Length", -1)
-        if 0 <= body_size <= HTTPInputStream.BUFFER_LIMIT:
-            m.body = self.read(body_size)
+        m.body_pending = True
+        framing = self._parser.framing
+        if not with_body:
+            return m
+
+        if framing is None:
+            self._next_event()         # MESSAGE_COMPLETE
             m.body_pending = False
-        else:
-            # To be determined
-            m.body_pending = True
+        elif framing == "length" and m.get_int("Content-Length") <= HTTPInputStream.BUFFER_LIMIT:
+            # Read message body only when the size of body is explicitly told
+            # and the size of message body is under buffer size limit. It's read in one go,
+            # bypassing the parser.
+            m.body = self.read(m.get_int("Content-Length"))
+            m.body_pending = False
+            self._parser.reset()
         return m
 
     def read_request(self):
@@ -533,6 +1100,7 @@ class HTTPInputStream(object):
             An HTTPRequest object.
         """
         r = HTTPRequest()
+        self._parser.request_method = None
         self.read_message(r)
         if r.method in ["GET", "HEAD", "DELETE", "CONNECT", "TRACE"]:
             # Requests with those methods may not carry a payload
@@ -540,33 +1108,77 @@ class HTTPInputStream(object):
         # POST, PUT, OPTIONS
         return r
 
-    def read_response(self):
+    def read_response(self, request_method=None, with_body=True):
         """ Extracts an HTTP response message from the input stream.
 
         See docstring of read_message method for more information.
 
+        Args:
+            request_method: Method of the request answered. Responses to HEAD, like 1xx, 204
+                and 304 responses, never have a body whatever their headers tell.
+            with_body: Whether to extract a body no larger than BUFFER_LIMIT, see read_message.
+
         Returns:
             An HTTPResponse object.
         """
         r = HTTPResponse()
-        self.read_message(r)
-        return r
+        self._parser.request_method = request_method
+        return self.read_message(r, with_body)
 
     def close(self):
         """  Close the HTTP input stream. """
         self._conn.shutdown(socket.SHUT_RD)
 
-    @staticmethod
-    def _split_header(line):
-        p = line.find(":")
-        return line[:p].strip(" \t"), line[p + 1:].strip(" \t")
 
+class _BufferPool(object):
+    """ Keeps buffers for reuse, instead of allocating one for every copy. """
+    def __init__(self, size, max_count=16):
+        self._size = size
+        self._max_count = max_count
+        self._buffers = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._buffers:
+                return self._buffers.pop()
+        return bytearray(self._size)
+
+    def put(self, buf):
+        with self._lock:
+            if len(self._buffers) < self._max_count:
+                self._buffers.append(buf)
+
+
+# Copy methods of HTTPOutputStream move data between sockets with os.splice, and from files
+# with os.sendfile, where available. Otherwise they copy through pooled buffers.
+ZERO_COPY = True
+COPY_BUFFER_SIZE = 64 * 1024
+_splice = getattr(os, "splice", None)
+_sendfile = getattr(os, "sendfile", None)
+_copy_buffers = _BufferPool(COPY_BUFFER_SIZE)
+
+
+def _is_blocking(stream):
+    """ Whether the socket of stream blocks without timeout, as os.splice and os.sendfile need. """
+    return hasattr(stream._conn, "gettimeout") and stream._conn.gettimeout() is None
+
+
+class HTTPOutputStream(_StreamTimeouts):
+    """ An HTTPInputStream represents an outbound HTTP octet stream.
+
+    Partial writes are resumed through memoryview slices instead of copying what is left of the
+    data. Where socket.sendmsg is available, the parts of a message are handed to the kernel
+    together in a single gather write.
+    """
+    # Without sendmsg, buffers smaller than this in total are joined and sent in one write
+    COALESCE_LIMIT = 16 * 1024
 
-class HTTPOutputStream(object):
-    """ An HTTPInputStream represents an outbound HTTP octet stream. """
     def __init__(self, conn):
         self._conn = conn
         self._bytes_out = 0
+        self._copied = 0               # bytes moved by the copy methods
+        self._copy_time = 0.0          # seconds spent in the copy methods
 
     @property
     def bytes_out(self):
@@ -584,7 +1196,11 @@ class HTTPOutputStream(object):
         Raises:
             IOError: An error occurred writing the underlying socket.
         """
-        n = self._conn.send(data)
+        self._arm()
+        try:
+            n = self._conn.send(data)
+        except socket.timeout:
+            raise self._timeout_error()
         if n > 0:
             self._bytes_out += n
         return n
@@ -598,13 +1214,60 @@ class HTTPOutputStream(object):
         Raises:
             IOError: An error occurred writing the underlying socket.
         """
+        count = self.write_some(data)
+        if count == len(data):
+            return count
+
+        view = memoryview(data)
         written = 0
-        while written != len(data):
-            count = self.write_some(data[written:])
+        while True:
             if count <= 0:
                 raise IOError("HTTPOutputStream.write error: Connection closed before write complete.")
             written += count
-        return len(data)
+            if written == len(data):
+                return written
+            count = self.write_some(view[written:])
+
+    def write_buffers(self, buffers):
+        """ Writes several buffers into the output stream, one after another.
+
+        With socket.sendmsg, the buffers are sent in gather writes. Otherwise small buffers are
+        joined and larger ones written one by one. In either case no buffer is copied to
+        resume a partial write.
+
+        Returns:
+            Number of bytes written.
+
+        Raises:
+            IOError: An error occurred writing the underlying socket.
+        """
+        buffers = [b for b in buffers if len(b)]
+        total = sum(len(b) for b in buffers)
+        if not hasattr(self._conn, "sendmsg"):
+            if total < HTTPOutputStream.COALESCE_LIMIT:
+                return self.write(''.join(buffers))
+            for b in buffers:
+                self.write(b)
+            return total
+
+        views = [memoryview(b) for b in buffers]
+        while views:
+            self._arm()
+            try:
+                count = self._conn.sendmsg(views)
+            except socket.timeout:
+                raise self._timeout_error()
+            if count <= 0:
+                raise IOError("HTTPOutputStream.write error: Connection closed before write complete.")
+            self._bytes_out += count
+            while count:
+                if count >= len(views[0]):
+                    count -= len(views[0])
+                    views.pop(0)
+                else:
+                    views[0] = views[0][count:]
+                    count = 0
+        return total
 
     def write_line(self, data):
         """ Writes data with a CRLF appended.
@@ -612,32 +1275,40 @@ class HTTPOutputStream(object):
         Returns:
             Number of bytes written.
         """
-        return self.write(data) + self.write("\r\n")
+        return self.write_buffers((data, "\r\n"))
 
     def write_chunk(self, data):
         """ Writes data in "chunked" transfer encoding.
 
-        This method writes "len(data) CRLF data CRLF" into the stream.
+        This method writes "len(data) CRLF data CRLF" into the stream, where len(data) is in hex.
 
         Returns:
             Number of bytes written.
         """
-        return self.write_line(str(len(data))) + self.write_line(data)
+        return self.write_buffers(("%x\r\n" % len(data), data, "\r\n"))
 
     def write_message(self, m):
         """ Writes an HTTP message into the output stream.
 
+        The start line and headers are written along with the body, which is never copied.
+
         Returns:
             Number of bytes written.
 
         Raises:
             IOError: An error occurred writing the underlying socket.
         """
-        return self.write(str(m))
+        if m.body:
+            return self.write_buffers((m.header_str(), m.body))
+        return self.write(m.header_str())
 
     def copy_bytes(self, src, count):
         """ Copy count bytes from src to the output stream.
 
+        Data src has buffered is written first. The rest is moved from socket to socket by
+        os.splice through a pipe, where available and ZERO_COPY is set, so that it never
+        enters the process. Otherwise it's received into a pooled buffer and written from it.
+
         Args:
             src: An HTTPInputStream object.
             count: Number of bytes to copy.
@@ -645,15 +1316,56 @@ class HTTPOutputStream(object):
         Returns:
             Number of bytes copied.
         """
-        copied = 0
-        while copied < count:
-            d = src.read_some(count-copied)
-            if not d:
-                raise EOFError("HTTPOutputStream.copy_bytes EOF count=" + str(count-copied))
-            self.write(d)
-            copied += len(d)
+        start = time.time()
+        buffered = min(count, src._wpos - src._rpos)
+        if buffered:
+            self.write(src._view[src._rpos:src._rpos+buffered])
+            src._rpos += buffered
+        left = count - buffered
+        if left:
+            if self._can_splice(src):
+                self._splice_from(src, left)
+            else:
+                self._copy_from(src, left)
+        self._account_copy(count, start)
         return count
 
+    def copy_file(self, f, count=None):
+        """ Copy count bytes, or all that is left, from the current position of file f.
+
+        os.sendfile is used where available and ZERO_COPY is set, a pooled buffer otherwise.
+
+        Returns:
+            Number of bytes copied.
+        """
+        start = time.time()
+        offset = f.tell()
+        if count is None:
+            count = os.fstat(f.fileno()).st_size - offset
+        copied = 0
+        if ZERO_COPY and _sendfile is not None and _is_blocking(self) and not self._deadline:
+            while copied < count:
+                n = _sendfile(self._conn.fileno(), f.fileno(), offset + copied, count - copied)
+                if n <= 0:
+                    raise EOFError("HTTPOutputStream.copy_file EOF count=" + str(count-copied))
+                copied += n
+                self._bytes_out += n
+            f.seek(offset + copied)
+        else:
+            buf = _copy_buffers.get()
+            try:
+                view = memoryview(buf)
+                while copied < count:
+                    n = f.readinto(view[:min(len(buf), count - copied)])
+                    if not n:
+                        raise EOFError("HTTPOutputStream.copy_file EOF count=" + str(count-copied))
+                    self.write(view[:n])
+                    copied += n
+            finally:
+                _copy_buffers.put(buf)
+        self._account_copy(copied, start)
+        return copied
+
     def copy_chunks(self, src):
         """ Copy chunks from src to the output stream.
 
@@ -666,17 +1378,20 @@ class HTTPOutputStream(object):
         count = 0
         while True:
             chunk_header = src.read_line()
-            chunk_size = int(chunk_header.strip(" \t").split(' ', 1)[0], 16)
+            try:
+                chunk_size = int(chunk_header.split(';', 1)[0].strip(" \t"), 16)
+            except ValueError:
+                raise IOError("Corrupted chunk stream: bad chunk size " + repr(chunk_header))
             if chunk_size <= 0:
                 # end of chunks
                 break
 
-            self.write(chunk_header + "\r\n")
+            self.write_line(chunk_header)
             self.copy_bytes(src, chunk_size + 2)
             count += len(chunk_header) + chunk_size + 4
 
         self.write("0\r\n")
-        count += 2
+        count += 3
         return count
 
     def copy_lines(self, src):
@@ -712,28 +1427,113 @@ class HTTPOutputStream(object):
         Returns:
             Number of bytes copied.
         """
-        d = src.read_some()
-        while d:
-            self.write(d)
-            d = src.read_some()
+        start = time.time()
+        count = src._wpos - src._rpos
+        if count:
+            self.write(src._view[src._rpos:src._wpos])
+            src._discard_buffer()
+        if self._can_splice(src):
+            count += self._splice_from(src, None)
+        else:
+            count += self._copy_from(src, None)
+        self._account_copy(count, start)
+        return count
+
+    @property
+    def copy_throughput(self):
+        """ Bytes per second moved by the copy methods so far, 0 if nothing has been copied. """
+        if not self._copy_time:
+            return 0.0
+        return self._copied / self._copy_time
+
+    def _account_copy(self, count, start):
+        self._copied += count
+        self._copy_time += time.time() - start
+
+    def _can_splice(self, src):
+        """ Whether data can be moved from the socket of src with os.splice. """
+        return ZERO_COPY and _splice is not None and _is_blocking(src) and _is_blocking(self) \
+            and not src._deadline and not self._deadline
+
+    def _copy_from(self, src, count):
+        """ Copies count bytes, or all till EOF if count is None, from the socket of src through
+        a pooled buffer. src must have no data buffered.
+
+        Returns:
+            Number of bytes copied.
+        """
+        buf = _copy_buffers.get()
+        try:
+            view = memoryview(buf)
+            copied = 0
+            while count is None or copied < count:
+                want = len(buf) if count is None else min(len(buf), count - copied)
+                n = src._recv_into(view, want)
+                if not n:
+                    if count is None:
+                        break
+                    raise EOFError("HTTPOutputStream.copy_bytes EOF count=" + str(count-copied))
+                src._bytes_in += n
+                self.write(view[:n])
+                copied += n
+            return copied
+        finally:
+            _copy_buffers.put(buf)
+
+    def _splice_from(self, src, count):
+        """ Like _copy_from, but moves data through a pipe with os.splice. """
+        r, w = os.pipe()
+        try:
+            src_fd = src._conn.fileno()
+            dst_fd = self._conn.fileno()
+            copied = 0
+            while count is None or copied < count:
+                want = COPY_BUFFER_SIZE if count is None else min(COPY_BUFFER_SIZE, count - copied)
+                n = _splice(src_fd, w, want)
+                if not n:
+                    if count is None:
+                        break
+                    raise EOFError("HTTPOutputStream.copy_bytes EOF count=" + str(count-copied))
+                src._bytes_in += n
+                left = n
+                while left:
+                    left -= _splice(r, dst_fd, left)
+                self._bytes_out += n
+                copied += n
+            return copied
+        finally:
+            os.close(r)
+            os.close(w)
 
     def close(self):
         self._conn.shutdown(socket.SHUT_WR)
 
 
 class HTTPIOStream(HTTPInputStream, HTTPOutputStream):
-    def __init__(self, conn=None, addr=None):
+    def __init__(self, conn=None, addr=None, connect_timeout=None, read_timeout=None):
+        """
+        Args:
+            conn: A connected socket, whose timeout becomes read_timeout, or None to connect
+                to addr.
+            addr: HTTPAddress or (host, port) of the peer.
+            connect_timeout: Seconds connecting may take, None for no limit.
+            read_timeout: Seconds a socket read or write may wait for the peer, None for no
+                limit. See also set_deadline.
+
+        Raises:
+            HTTPConnectTimeout: The connection was not established within connect_timeout.
+        """
+        self.connect_timeout = connect_timeout
         if addr is None and conn is not None:
             name = conn.getpeername()
             addr = HTTPAddress(name[0], name[1])
         elif conn is None and addr is not None:
-            if isinstance(addr, tuple):
-                conn = socket.create_connection(addr)
-            elif isinstance(addr, HTTPAddress):
-                conn = socket.create_connection((addr.host, addr.port))
+            conn = _connect(addr, connect_timeout)
         HTTPInputStream.__init__(self, conn)
         HTTPOutputStream.__init__(self, conn)
         self._address = addr
+        # replaces the connect timeout the socket was created with
+        self.read_timeout = read_timeout
 
     def is_open(self):
         return self._conn is not None
@@ -755,15 +1555,21 @@ class HTTPIOStream(HTTPInputStream, HTTPOutputStream):
         return self._address
 
     def open(self, addr):
+        """ Connects to addr, within connect_timeout and the deadline of the stream. """
         self.close()
-        if isinstance(addr, tuple):
-            conn = socket.create_connection(addr)
-        elif isinstance(addr, HTTPAddress):
-            conn = socket.create_connection((addr.host, addr.port))
-        self._conn = conn
+        timeout = self.connect_timeout
+        if self._deadline is not None:
+            left = self._deadline - time.time()
+            if left <= 0:
+                raise HTTPDeadlineExceeded("HTTP stream deadline exceeded")
+            if timeout is None or left < timeout:
+                timeout = left
+        self._conn = _connect(addr, timeout)
+        self._conn.settimeout(self._read_timeout)
         self._address = addr
 
     def close(self):
+        self._discard_buffer()
         if self._conn:
             try:
                 self._conn.shutdown(socket.SHUT_RDWR)
@@ -777,30 +1583,1202 @@ class HTTPIOStream(HTTPInputStream, HTTPOutputStream):
         self._address = None
 
 
-class HTTPTunnel:
-    def __init__(self, peers):
-        self.peers = peers
+class _StreamedBody(object):
+    """ Iterator over the pieces of a response body HTTPClient leaves on its connection.
+
+    The connection goes back to the pool of the client once the body is completely read. It's
+    closed instead if the iterator is closed before that. An iterator neither exhausted nor
+    closed keeps its connection out of the pool for good.
+    """
+    def __init__(self, client, addr, ios, resp, keep, deadline):
+        self._client = client
+        self._addr = addr
+        self._ios = ios
+        self._keep = keep
+        self._deadline = deadline
+        self._pieces = ios.iter_body(resp)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._ios is None:
+            raise StopIteration
+        try:
+            return next(self._pieces)
+        except StopIteration:
+            self._finish(self._keep)
+            raise
+        except:
+            self._finish(False)
+            raise
+
+    def close(self):
+        """ Stops reading the body, closing the connection if it's not completely read. """
+        if self._ios is not None:
+            self._finish(False)
+
+    def _finish(self, keep):
+        ios = self._ios
+        self._ios = None
+        if self._deadline is not None:
+            ios.set_deadline(None)
+        self._client._release(self._addr, ios, keep)
+
+
+class HTTPClient(object):
+    """ An HTTP client keeping persistent connections in per-host pools.
+
+    Connections are kept in a pool of the HTTPAddress they are connected to, and reused when a
+    response is completely read and neither peer asked to close the connection. No more than
+    max_connections connections are opened to one host, and connections idle for more than
+    max_idle_time seconds are closed instead of being reused. The client is thread safe.
+
+    Connections are opened with connect_timeout and read_timeout, see HTTPIOStream.
+    """
+    def __init__(self, max_connections=4, max_idle_time=60, connect_timeout=None,
+                 read_timeout=None):
+        self.max_connections = max_connections
+        self.max_idle_time = max_idle_time
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = {}          # HTTPAddress -> [(HTTPIOStream, idle since), ...]
+        self._busy = {}          # HTTPAddress -> number of connections in use
+        self._cond = threading.Condition()
+
+    def request(self, addr, req, timeout=None, stream=False):
+        """ Sends an HTTP request and reads the whole response.
+
+        A request failing on a reused connection is retried once on a new connection, as the
+        peer may have closed it while it was idle. Timeouts are not retried.
+
+        Args:
+            addr: HTTPAddress of the server.
+            req: An HTTPRequest object.
+            timeout: Seconds the whole request may take, waiting for a connection included,
+                and reading a streamed body too. None for no limit.
+            stream: Leave the body on the connection, to be read piece by piece as it arrives
+                through the body_pieces iterator of the response. body_pieces must be either
+                exhausted or closed, which closes the connection if the body is not completely
+                read. A response without a body, such as a 304 one, is read whole and has no
+                body_pieces.
+
+        Returns:
+            An HTTPResponse object with its body read, unless stream is set.
+
+        Raises:
+            HTTPTimeoutError: The request timed out, see HTTPIOStream.
+        """
+        if "Host" not in req:
+            req.add(("Host", addr.name))
+        if req.body and "Content-Length" not in req and "Transfer-Encoding" not in req:
+            req.add(("Content-Length", len(req.body)))
+
+        deadline = None if timeout is None else time.time() + timeout
+        ios, reused = self._acquire(addr, deadline)
+        try:
+            try:
+                resp, keep = self._exchange(ios, req, deadline, stream)
+            except HTTPTimeoutError:
+                raise
+            except (IOError, EOFError, socket.error):
+                if not reused:
+                    raise
+                ios.close()
+                ios = self._open(addr, deadline)
+                resp, keep = self._exchange(ios, req, deadline, stream)
+        except:
+            self._release(addr, ios, False)
+            raise
+        if stream and resp.body_pending:
+            resp.body_pieces = _StreamedBody(self, addr, ios, resp, keep, deadline)
+        else:
+            self._release(addr, ios, keep)
+        return resp
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        """ GET url. Only http URLs are supported.
+
+        Args:
+            url: The URL to get.
+            headers: A dict of extra request headers.
+            timeout: Seconds the request may take, see request.
+            stream: Leave the body to be read through body_pieces, see request.
+
+        Returns:
+            An HTTPResponse object with its body read, unless stream is set.
+        """
+        u = urlparse.urlsplit(url)
+        if u.scheme != "http":
+            raise ValueError("HTTPClient supports http URLs only: " + url)
+        target = u.path or "/"
+        if u.query:
+            target += "?" + u.query
+        req = HTTPRequest(method="GET", target=target)
+        req.add(("Host", u.netloc))
+        if headers:
+            for k, v in headers.items():
+                req.add((k, v))
+        return self.request(HTTPAddress(u.hostname, u.port or 80), req, timeout, stream)
+
+    def close(self):
+        """ Closes all idle connections. """
+        with self._cond:
+            for conns in self._idle.values():
+                for ios, _ in conns:
+                    ios.close()
+            self._idle = {}
+
+    def _exchange(self, ios, req, deadline, stream=False):
+        """ Returns 2-tuple (response, whether the connection can be reused).
+
+        If stream is set, the body of the response, if it has one, is left to be read, and so is
+        the deadline left set.
+        """
+        if deadline is not None:
+            ios.set_deadline(deadline - time.time())
+        ios.write_message(req)
+        resp = ios.read_response(req.method, not stream)
+        while 100 <= resp.code < 200 and resp.code != 101:
+            # interim response
+            resp = ios.read_response(req.method, not stream)
+
+        keep = self._keep_alive(req) and self._keep_alive(resp)
+        if resp.body_pending:
+            if ios.framing == "close":
+                # delimited by the end of the connection
+                keep = False
+            if not stream or ios.framing is None:
+                ios.read_body(resp)
+        if deadline is not None and not resp.body_pending:
+            ios.set_deadline(None)
+        return resp, keep
+
+    @staticmethod
+    def _keep_alive(m):
+        conn = m.get("Connection", "").lower()
+        if m.version == "HTTP/1.1":
+            return "close" not in conn
+        return "keep-alive" in conn
+
+    @staticmethod
+    def _is_stale(ios):
+        """ Tests whether an idle connection has been closed by the peer.
+
+        An idle connection has nothing to read, so being readable means either EOF or garbage.
+        """
+        try:
+            r, w, x = select.select([ios.socket], [], [], 0)
+        except (select.error, socket.error):
+            return True
+        return bool(r) or bool(ios.rdbuf)
+
+    def _acquire(self, addr, deadline):
+        """ Returns 2-tuple (HTTPIOStream, whether the connection is a reused one). """
+        with self._cond:
+            while True:
+                conns = self._idle.get(addr)
+                while conns:
+                    ios, since = conns.pop()
+                    if time.time() - since <= self.max_idle_time and not self._is_stale(ios):
+                        self._busy[addr] = self._busy.get(addr, 0) + 1
+                        return ios, True
+                    ios.close()
+                if self._busy.get(addr, 0) < self.max_connections:
+                    self._busy[addr] = self._busy.get(addr, 0) + 1
+                    break
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        raise HTTPDeadlineExceeded("HTTPClient: no connection to %s in time" % addr)
+                    self._cond.wait(left)
+        try:
+            return self._open(addr, deadline), False
+        except:
+            self._release(addr, None, False)
+            raise
+
+    def _open(self, addr, deadline):
+        """ Opens a connection with the timeouts of the client, connecting by deadline. """
+        timeout = self.connect_timeout
+        if deadline is not None:
+            left = deadline - time.time()
+            if left <= 0:
+                raise HTTPDeadlineExceeded("HTTPClient: deadline exceeded connecting to %s" % addr)
+            if timeout is None or left < timeout:
+                timeout = left
+        return HTTPIOStream(addr=addr, connect_timeout=timeout, read_timeout=self.read_timeout)
+
+    def _release(self, addr, ios, keep):
+        with self._cond:
+            self._busy[addr] -= 1
+            if ios is not None:
+                if keep:
+                    self._idle.setdefault(addr, []).append((ios, time.time()))
+                else:
+                    ios.close()
+            self._cond.notify()
+
+
+class Return(Exception):
+    """ Raised by a coroutine run by a Task to return a value. """
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+class Future(object):
+    """ The result of an operation that completes later, such as the reads and writes of an
+    AsyncHTTPIOStream.
+    """
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """ Returns the result of the operation, or raises the exception it failed with. """
+        if not self._done:
+            raise IOError("Future.result: the operation is not complete")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        """ Returns the exception the operation failed with, None if it succeeded. """
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, callback):
+        """ Calls callback with the future once it's done, right away if it already is. """
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, result):
+        self._result = result
+        self._complete()
+
+    def set_exception(self, e):
+        self.set_exc_info((type(e), e, None))
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._complete()
+
+    def _complete(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class Task(Future):
+    """ Runs a coroutine, a generator yielding Futures.
+
+    The coroutine is resumed with the result of each Future it yields once the Future is done,
+    or the exception of the Future is raised inside it. Yielding a generator runs it as a nested
+    coroutine, resumed with what it returns. A coroutine returns a value by raising
+    Return(value), which becomes the result of the Task.
+    """
+    def __init__(self, coroutine):
+        Future.__init__(self)
+        self._stack = [coroutine]
+        self._step(None, None)
+
+    def _step(self, value, exc_info):
+        while self._stack:
+            coroutine = self._stack[-1]
+            try:
+                if exc_info is None:
+                    yielded = coroutine.send(value)
+                else:
+                    yielded = coroutine.throw(*exc_info)
+            except Return, r:
+                self._stack.pop()
+                value, exc_info = r.value, None
+                continue
+            except StopIteration:
+                self._stack.pop()
+                value, exc_info = None, None
+                continue
+            except Exception:
+                self._stack.pop()
+                value, exc_info = None, sys.exc_info()
+                continue
+
+            value, exc_info = None, None
+            if isinstance(yielded, types.GeneratorType):
+                self._stack.append(yielded)
+            elif not isinstance(yielded, Future):
+                e = TypeError("Task: coroutines may yield Futures and generators only")
+                exc_info = (TypeError, e, None)
+            elif yielded.done():
+                value, exc_info = yielded._result, yielded._exc_info
+            else:
+                yielded.add_done_callback(self._resume)
+                return
+
+        if exc_info is not None:
+            self.set_exc_info(exc_info)
+        else:
+            self.set_result(value)
+
+    def _resume(self, future):
+        self._step(future._result, future._exc_info)
 
-    def _getpair(self, rdsock):
-        if rdsock == self.peers[0].socket:
-            return self.peers[0], self.peers[1]
-        return self.peers[1], self.peers[0]
+
+class EventLoop(object):
+    """ Waits for the events of many sockets in one thread and dispatches them to handlers.
+
+    epoll is used where the platform has it, select otherwise. Handlers are called with the
+    events that occurred, a combination of READ, WRITE and ERROR, and should not raise as
+    exceptions are not caught by the loop.
+    """
+    READ = 0x001                       # select.EPOLLIN
+    WRITE = 0x004                      # select.EPOLLOUT
+    ERROR = 0x018                      # select.EPOLLERR | select.EPOLLHUP
+
+    def __init__(self):
+        self._handlers = {}            # fd -> handler
+        self._events = {}              # fd -> events watched
+        self._epoll = select.epoll() if hasattr(select, "epoll") else None
+        self._timers = []              # heap of [deadline, sequence, callback]
+        self._sequence = 0
+        self._running = False
+
+    def add(self, fd, events, handler):
+        """ Calls handler(events) when any of events occurs on fd. """
+        self._handlers[fd] = handler
+        self._events[fd] = events
+        if self._epoll is not None:
+            self._epoll.register(fd, events)
+
+    def modify(self, fd, events):
+        self._events[fd] = events
+        if self._epoll is not None:
+            self._epoll.modify(fd, events)
+
+    def remove(self, fd):
+        if self._handlers.pop(fd, None) is not None:
+            del self._events[fd]
+            if self._epoll is not None:
+                self._epoll.unregister(fd)
+
+    def call_later(self, delay, callback):
+        """ Calls callback() after delay seconds.
+
+        Returns:
+            A timer which can be passed to cancel().
+        """
+        self._sequence += 1
+        timer = [time.time() + delay, self._sequence, callback]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        timer[2] = None
+
+    def stop(self):
+        """ Makes run() return once the events being dispatched have been. """
+        self._running = False
 
     def run(self):
-        """ Do blind forward till either of the peer connections is closed or an error occurs. """
-        if self.peers[0].rdbuf:
-            self.peers[1].write(self.peers[0].rdbuf)
-        if self.peers[1].rdbuf:
-            self.peers[0].write(self.peers[1].rdbuf)
-        watch = [self.peers[0].socket, self.peers[1].socket]
-        while watch:
-            r, w, x = select.select(watch, [], [])
-            for u in r:
-                src, dst = self._getpair(u)
-                d = src.read_some(16*1024)
+        """ Dispatches events till stop() is called or there is nothing left to wait for. """
+        self._running = True
+        timers = self._timers
+        while self._running:
+            while timers and timers[0][2] is None:
+                heapq.heappop(timers)
+            if timers:
+                timeout = max(0.0, timers[0][0] - time.time())
+            elif self._handlers:
+                timeout = None
+            else:
+                break
+
+            for fd, events in self._poll(timeout):
+                handler = self._handlers.get(fd)
+                if handler is not None:
+                    handler(events)
+
+            now = time.time()
+            while timers and timers[0][0] <= now:
+                callback = heapq.heappop(timers)[2]
+                if callback is not None:
+                    callback()
+        self._running = False
+
+    def run_until_complete(self, future):
+        """ Runs the loop till future is done.
+
+        Returns:
+            The result of future.
+        """
+        future.add_done_callback(lambda f: self.stop())
+        if not future.done():
+            self.run()
+        return future.result()
+
+    def close(self):
+        if self._epoll is not None:
+            self._epoll.close()
+
+    def _poll(self, timeout):
+        """ Returns a list of 2-tuples (fd, events). """
+        try:
+            if self._epoll is not None:
+                return self._epoll.poll(-1 if timeout is None else timeout)
+            readers = [fd for fd, events in self._events.items() if events & EventLoop.READ]
+            writers = [fd for fd, events in self._events.items() if events & EventLoop.WRITE]
+            r, w, x = select.select(readers, writers, [], timeout)
+        except (select.error, IOError), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        ready = dict((fd, EventLoop.READ) for fd in r)
+        for fd in w:
+            ready[fd] = ready.get(fd, 0) | EventLoop.WRITE
+        return ready.items()
+
+
+class AsyncHTTPIOStream(_InputBuffer):
+    """ A non-blocking HTTP connection driven by an EventLoop.
+
+    It's the counterpart of HTTPIOStream for connections served by one thread: messages are the
+    same HTTPRequest and HTTPResponse objects, parsed by the same HTTPParser with the semantics
+    of HTTPInputStream.read_message, but reading and writing methods return Futures instead of
+    blocking. Operations are meant to be chained by coroutines run by Task, such as:
+
+        def fetch(loop, addr, req):
+            ios = yield AsyncHTTPIOStream.connect(loop, addr)
+            yield ios.write_message(req)
+            resp = yield ios.read_response(req.method)
+            ios.close()
+            raise Return(resp)
+
+        resp = loop.run_until_complete(Task(fetch(loop, addr, req)))
+
+    One read and any number of writes may be pending at a time.
+    """
+    COALESCE_LIMIT = HTTPOutputStream.COALESCE_LIMIT
+
+    def __init__(self, loop, conn, addr=None, read_timeout=None):
+        _InputBuffer.__init__(self, conn)
+        conn.setblocking(False)
+        self._loop = loop
+        self._fd = conn.fileno()
+        self._address = addr
+        self._events = 0               # events watched on the loop
+        self._eof = False
+        self._reading = None           # 2-tuple (step, future) of the pending read
+        self._writes = collections.deque()   # [buffers, future, count] of pending writes
+        self._bytes_out = 0
+        self._read_timeout = read_timeout
+        self._deadline = None
+        self._timer = None             # timer checking timeouts while operations are pending
+        self._active = time.time()     # when data was last received or sent
+
+    @staticmethod
+    def connect(loop, addr, connect_timeout=None, read_timeout=None):
+        """ Opens a connection to addr, an HTTPAddress or a (host, port) tuple.
+
+        Host names are resolved before returning, which blocks.
+
+        Returns:
+            A Future of the AsyncHTTPIOStream, which fails with HTTPConnectTimeout if the
+        connection is not established within connect_timeout seconds.
+        """
+        future = Future()
+        if isinstance(addr, HTTPAddress):
+            addr = (addr.host, addr.port)
+        try:
+            family, socktype, proto, _, sockaddr = \
+                socket.getaddrinfo(addr[0], addr[1], 0, socket.SOCK_STREAM)[0]
+            conn = socket.socket(family, socktype, proto)
+            conn.setblocking(False)
+            err = conn.connect_ex(sockaddr)
+        except socket.error, e:
+            future.set_exception(IOError(str(e)))
+            return future
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            conn.close()
+            future.set_exception(IOError(err, os.strerror(err)))
+            return future
+
+        timer = []
+
+        def on_connected(events):
+            loop.remove(conn.fileno())
+            if timer:
+                loop.cancel(timer[0])
+            err = conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                conn.close()
+                future.set_exception(IOError(err, os.strerror(err)))
+            else:
+                future.set_result(AsyncHTTPIOStream(loop, conn, HTTPAddress(addr[0], addr[1]),
+                                                    read_timeout))
+
+        def on_timeout():
+            loop.remove(conn.fileno())
+            conn.close()
+            future.set_exception(HTTPConnectTimeout("Connecting to %s:%s timed out" % addr))
+        loop.add(conn.fileno(), EventLoop.WRITE, on_connected)
+        if connect_timeout is not None:
+            timer.append(loop.call_later(connect_timeout, on_timeout))
+        return future
+
+    @property
+    def read_timeout(self):
+        """ Seconds pending operations may wait for the peer, None for no limit. """
+        return self._read_timeout
+
+    @read_timeout.setter
+    def read_timeout(self, timeout):
+        self._read_timeout = timeout
+        self._update()
+
+    def set_deadline(self, seconds):
+        """ Makes pending and later operations fail with HTTPDeadlineExceeded after seconds
+        from now, or never if seconds is None. """
+        self._deadline = None if seconds is None else time.time() + seconds
+        self._update()
+
+    @property
+    def socket(self):
+        return self._conn
+
+    @property
+    def address(self):
+        """ HTTPAddress of peer """
+        return self._address
+
+    @property
+    def bytes_out(self):
+        """ Total number of bytes written to the socket """
+        return self._bytes_out
+
+    def is_open(self):
+        return self._conn is not None
+
+    def read_some(self, max_count):
+        """ Returns a Future of up to max_count bytes read from the stream, "" on EOF. """
+        def step(eof):
+            if self._rpos < self._wpos:
+                a = self._rpos
+                self._rpos = min(self._wpos, a + max_count)
+                return True, self._view[a:self._rpos].tobytes()
+            return eof, ""
+        return self._read(step)
+
+    def read(self, n):
+        """ Returns a Future of exactly n bytes read from the stream. """
+        def step(eof):
+            if self._wpos - self._rpos >= n:
+                a = self._rpos
+                self._rpos += n
+                return True, self._view[a:self._rpos].tobytes()
+            if eof:
+                raise EOFError("AsyncHTTPIOStream.read EOF")
+            return False, None
+        return self._read(step)
+
+    def read_line(self):
+        """ Returns a Future of the next line of the stream, excluding its CRLF. """
+        def step(eof):
+            pos = self._buf.find("\r\n", self._rpos, self._wpos)
+            if pos == -1:
+                if eof:
+                    raise EOFError("AsyncHTTPIOStream.read_line EOF")
+                if self._wpos - self._rpos >= _InputBuffer.BUFFER_LIMIT:
+                    raise IOError("AsyncHTTPIOStream.read_line too long")
+                return False, None
+            a = self._rpos
+            self._rpos = pos + 2
+            return True, self._view[a:pos].tobytes()
+        return self._read(step)
+
+    def read_message(self, m):
+        """ Returns a Future of m, extracted from the stream as HTTPInputStream.read_message does. """
+        return self._read(self._message_step(m))
+
+    def read_request(self):
+        """ Returns a Future of an HTTPRequest, see HTTPInputStream.read_request. """
+        r = HTTPRequest()
+        self._parser.request_method = None
+        read_message = self._message_step(r)
+
+        def step(eof):
+            done, r = read_message(eof)
+            if done and r.method in ["GET", "HEAD", "DELETE", "CONNECT", "TRACE"]:
+                r.body_pending = False
+            return done, r
+        return self._read(step)
+
+    def read_response(self, request_method=None):
+        """ Returns a Future of an HTTPResponse, see HTTPInputStream.read_response. """
+        self._parser.request_method = request_method
+        return self._read(self._message_step(HTTPResponse()))
+
+    def read_body(self, m):
+        """ Extracts the pending body of a message into m.body, see HTTPInputStream.iter_body.
+
+        Returns:
+            A Future of m.
+        """
+        if not m.body_pending:
+            future = Future()
+            future.set_result(m)
+            return future
+        if self._parser.message is not m:
+            raise IOError("AsyncHTTPIOStream.read_body: not the message being read")
+        body = []
+
+        def step(eof):
+            while True:
+                event = self._parse(eof)
+                if event is None:
+                    return False, None
+                if event[0] == HTTPParser.BODY:
+                    body.append(event[1])
+                else:
+                    m.body = ''.join(body)
+                    m.body_pending = False
+                    return True, m
+        return self._read(step)
+
+    def write(self, data):
+        """ Returns a Future of the number of bytes written, done once data is sent. """
+        return self.write_buffers((data,))
+
+    def write_buffers(self, buffers):
+        """ Writes buffers in order, see HTTPOutputStream.write_buffers.
+
+        Returns:
+            A Future of the number of bytes written, done once all of them are sent.
+        """
+        if self._conn is None:
+            raise IOError("AsyncHTTPIOStream closed")
+        buffers = [b for b in buffers if b]
+        count = sum(len(b) for b in buffers)
+        if len(buffers) > 1 and count < AsyncHTTPIOStream.COALESCE_LIMIT:
+            buffers = [''.join(buffers)]
+        future = Future()
+        self._writes.append([collections.deque(memoryview(b) for b in buffers), future, count])
+        if len(self._writes) == 1:
+            self._flush()
+        return future
+
+    def write_line(self, data):
+        return self.write_buffers((data, "\r\n"))
+
+    def write_chunk(self, data):
+        return self.write_buffers(("%x\r\n" % len(data), data, "\r\n"))
+
+    def write_message(self, m):
+        """ Returns a Future of the number of bytes written, done once m is sent. """
+        return self.write_buffers((m.header_str(), m.body))
+
+    def copy_bytes(self, src, count):
+        """ Copies count bytes from src, an AsyncHTTPIOStream, to the stream.
+
+        Returns:
+            A Future of the number of bytes copied.
+        """
+        def copy():
+            copied = 0
+            while copied < count:
+                d = yield src.read_some(min(count - copied, _InputBuffer.BUFFER_SIZE))
                 if not d:
-                    # connection closed
-                    watch.remove(u)
+                    raise EOFError("AsyncHTTPIOStream.copy_bytes EOF count=" + str(count-copied))
+                yield self.write(d)
+                copied += len(d)
+            raise Return(count)
+        return Task(copy())
+
+    def copy_chunks(self, src):
+        """ Copies chunks from src to the stream, see HTTPOutputStream.copy_chunks.
+
+        Returns:
+            A Future of the number of bytes copied.
+        """
+        def copy():
+            count = 0
+            while True:
+                chunk_header = yield src.read_line()
+                try:
+                    chunk_size = int(chunk_header.split(';', 1)[0].strip(" \t"), 16)
+                except ValueError:
+                    raise IOError("Corrupted chunk stream: bad chunk size " + repr(chunk_header))
+                if chunk_size <= 0:
+                    break
+                yield self.write_line(chunk_header)
+                yield self.copy_bytes(src, chunk_size + 2)
+                count += len(chunk_header) + chunk_size + 4
+            yield self.write("0\r\n")
+            raise Return(count + 3)
+        return Task(copy())
+
+    def copy_lines(self, src):
+        """ Copies lines from src to the stream till an empty one, which is copied too.
+
+        Returns:
+            A Future of the number of bytes copied.
+        """
+        def copy():
+            count = 0
+            line = yield src.read_line()
+            while line:
+                yield self.write_line(line)
+                count += len(line) + 2
+                line = yield src.read_line()
+            yield self.write("\r\n")
+            raise Return(count + 2)
+        return Task(copy())
+
+    def copy_all(self, src):
+        """ Copies all data from src to the stream till src is closed.
+
+        Returns:
+            A Future of the number of bytes copied.
+        """
+        def copy():
+            count = 0
+            d = yield src.read_some(_InputBuffer.BUFFER_SIZE)
+            while d:
+                yield self.write(d)
+                count += len(d)
+                d = yield src.read_some(_InputBuffer.BUFFER_SIZE)
+            raise Return(count)
+        return Task(copy())
+
+    def close(self):
+        """ Closes the connection. Pending operations fail with IOError. """
+        if self._conn is None:
+            return
+        if self._events:
+            self._loop.remove(self._fd)
+            self._events = 0
+        try:
+            self._conn.close()
+        except socket.error:
+            pass
+        self._conn = None
+        self._discard_buffer()
+        if self._timer is not None:
+            self._loop.cancel(self._timer)
+            self._timer = None
+        self._fail(IOError("AsyncHTTPIOStream closed"))
+
+    def _message_step(self, m):
+        """ Returns a read step extracting a message like HTTPInputStream.read_message. """
+        self._parser.reset(m)
+        body = []
+
+        def step(eof):
+            while True:
+                event = self._parse(eof)
+                if event is None:
+                    return False, None
+                kind = event[0]
+                if kind == HTTPParser.HEADERS:
+                    m.body = ""
+                    m.body_pending = True
+                    framing = self._parser.framing
+                    if framing is not None and (framing != "length" or
+                            m.get_int("Content-Length") > _InputBuffer.BUFFER_LIMIT):
+                        return True, m
+                elif kind == HTTPParser.BODY:
+                    body.append(event[1])
+                elif kind == HTTPParser.MESSAGE_COMPLETE:
+                    m.body = ''.join(body)
+                    m.body_pending = False
+                    return True, m
+        return step
+
+    def _parse(self, eof):
+        """ Returns the next parser event out of the read buffer, None if more data is needed. """
+        self._rpos, event = self._parser.parse(self._buf, self._rpos, self._wpos, eof,
+                                               self._view)
+        if event is None and eof:
+            raise EOFError("Connection closed unexpectedly.")
+        return event
+
+    def _read(self, step):
+        """ Starts a read, done once step(eof) returns 2-tuple (True, result).
+
+        step is called with what has been received so far, then every time more data is.
+        """
+        if self._reading is not None:
+            raise IOError("AsyncHTTPIOStream: a read is pending")
+        if self._conn is None:
+            raise IOError("AsyncHTTPIOStream closed")
+        future = Future()
+        self._reading = (step, future)
+        self._advance()
+        return future
+
+    def _advance(self):
+        step, future = self._reading
+        try:
+            done, result = step(self._eof)
+        except Exception:
+            self._reading = None
+            self._update()
+            future.set_exc_info(sys.exc_info())
+            return
+        if done:
+            self._reading = None
+        self._update()
+        if done:
+            future.set_result(result)
+
+    def _recv_into(self, view, n):
+        try:
+            return self._conn.recv_into(view, n)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return None
+            raise IOError(str(e))
+
+    def _flush(self):
+        """ Sends as much of the pending writes as the socket takes. """
+        writes = self._writes
+        try:
+            while writes:
+                buffers, future, count = writes[0]
+                while buffers:
+                    try:
+                        n = self._conn.send(buffers[0])
+                    except socket.error, e:
+                        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                            self._update()
+                            return
+                        raise IOError(str(e))
+                    self._bytes_out += n
+                    self._active = time.time()
+                    if n < len(buffers[0]):
+                        buffers[0] = buffers[0][n:]
+                    else:
+                        buffers.popleft()
+                writes.popleft()
+                future.set_result(count)
+        except IOError, e:
+            self._fail_writes(e)
+        self._update()
+
+    def _on_events(self, events):
+        if events & (EventLoop.WRITE | EventLoop.ERROR) and self._writes:
+            self._flush()
+        if events & (EventLoop.READ | EventLoop.ERROR) and self._reading is not None:
+            try:
+                n = self._recv()
+            except IOError:
+                self._reading[1].set_exc_info(sys.exc_info())
+                self._reading = None
+                self._update()
+                return
+            if n is None:
+                return
+            self._active = time.time()
+            if n == 0:
+                self._eof = True
+            self._advance()
+
+    def _update(self):
+        """ Watches the events the pending operations wait for. """
+        if self._conn is None:
+            return
+        events = 0
+        if self._reading is not None:
+            events |= EventLoop.READ
+        if self._writes:
+            events |= EventLoop.WRITE
+        if events and not self._events:
+            self._active = time.time()
+        if events and self._timer is None and \
+                (self._read_timeout is not None or self._deadline is not None):
+            self._timer = self._loop.call_later(self._time_left(), self._on_timer)
+        if events != self._events:
+            if not self._events:
+                self._loop.add(self._fd, events, self._on_events)
+            elif not events:
+                self._loop.remove(self._fd)
+            else:
+                self._loop.modify(self._fd, events)
+            self._events = events
+
+    def _time_left(self):
+        """ Seconds left before the pending operations time out. """
+        left = None
+        if self._read_timeout is not None:
+            left = self._active + self._read_timeout - time.time()
+        if self._deadline is not None and (left is None or self._deadline - time.time() < left):
+            left = self._deadline - time.time()
+        return max(0.0, left)
+
+    def _on_timer(self):
+        self._timer = None
+        if self._conn is None or not (self._reading is not None or self._writes):
+            return
+        if self._read_timeout is None and self._deadline is None:
+            return
+        left = self._time_left()
+        if left > 0:
+            self._timer = self._loop.call_later(left, self._on_timer)
+            return
+        if self._deadline is not None and time.time() >= self._deadline:
+            e = HTTPDeadlineExceeded("HTTP stream deadline exceeded")
+        else:
+            e = HTTPReadTimeout("HTTP stream timed out after %ss" % self._read_timeout)
+        self._fail(e)
+        self._update()
+
+    def _fail(self, e):
+        if self._reading is not None:
+            future = self._reading[1]
+            self._reading = None
+            future.set_exception(e)
+        self._fail_writes(e)
+
+    def _fail_writes(self, e):
+        writes = list(self._writes)
+        self._writes.clear()
+        for buffers, future, count in writes:
+            future.set_exception(e)
+
+
+class _RelayDirection(object):
+    """ Data on its way from one peer of a tunnel to the other. """
+    __slots__ = ("src", "dst", "buf", "view", "rpos", "wpos", "eof", "shut", "count")
+
+    def __init__(self, src, dst, size, data):
+        self.src = src
+        self.dst = dst
+        self.buf = bytearray(max(size, len(data)))
+        self.view = memoryview(self.buf)
+        self.buf[:len(data)] = data
+        self.rpos = 0                  # offset of data not sent yet
+        self.wpos = len(data)          # offset of free space
+        self.eof = False               # whether src has been read to its end
+        self.shut = False              # whether the end has been passed on to dst
+        self.count = 0                 # bytes sent to dst
+
+
+class RelayTunnel(object):
+    """ A tunnel relayed by an HTTPTunnelRelay. """
+    def __init__(self, peers, dirs, close):
+        self.peers = peers             # the two sockets
+        self._timeouts = [peer.gettimeout() for peer in peers]
+        self.started = time.time()
+        self.finished = None           # when the tunnel ended
+        self.error = None              # the exception the tunnel ended with, if any
+        self.done = Future()           # done with the tunnel once it has ended
+        self._dirs = dirs
+        self._events = [0, 0]
+        self._close = close
+
+    @property
+    def bytes_up(self):
+        """ Number of bytes relayed from the first peer to the second. """
+        return self._dirs[0].count
+
+    @property
+    def bytes_down(self):
+        """ Number of bytes relayed from the second peer to the first. """
+        return self._dirs[1].count
+
+
+class HTTPTunnelRelay(object):
+    """ Relays the data of many tunnels in one thread, on an EventLoop.
+
+    Each direction of a tunnel has a buffer of its own. A peer is read only when the buffer
+    of its outbound direction has room and written only when the socket is writable, so a slow
+    peer holds back the other one instead of making buffers grow. When a peer ends its side of
+    the connection, the end is passed on to the other peer after the buffered data, and the
+    tunnel goes on relaying the other direction. A tunnel ends when both directions have, or
+    when either peer fails.
+    """
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, loop=None, buffer_size=BUFFER_SIZE):
+        self.loop = loop if loop is not None else EventLoop()
+        self.buffer_size = buffer_size
+        self.tunnels = set()           # tunnels being relayed
+        self.bytes_relayed = 0         # bytes relayed by ended tunnels
+
+    def add(self, a, b, close=True):
+        """ Starts relaying data between a and b, sockets or HTTPIOStreams.
+
+        Data an HTTPIOStream has received but not read yet is relayed first.
+
+        Args:
+            close: Whether to close the peers when the tunnel ends. Otherwise they are left
+                open, with the timeouts they had.
+
+        Returns:
+            A RelayTunnel.
+        """
+        socks = []
+        data = []
+        for peer in (a, b):
+            if isinstance(peer, _InputBuffer):
+                data.append(peer.rdbuf)
+                peer._discard_buffer()
+                peer = peer.socket
+            else:
+                data.append("")
+            socks.append(peer)
+        dirs = (_RelayDirection(socks[0], socks[1], self.buffer_size, data[0]),
+                _RelayDirection(socks[1], socks[0], self.buffer_size, data[1]))
+        t = RelayTunnel(socks, dirs, close)
+        for peer in socks:
+            peer.setblocking(False)
+        self.tunnels.add(t)
+        try:
+            self._drain(dirs[0])
+            self._drain(dirs[1])
+        except IOError, e:
+            self._finish(t, e)
+            return t
+        self._update(t)
+        return t
+
+    def run(self):
+        """ Relays till all tunnels have ended. """
+        self.loop.run()
+
+    def close(self):
+        """ Ends all tunnels. """
+        for t in list(self.tunnels):
+            self._finish(t, IOError("HTTPTunnelRelay closed"))
+
+    def _on_events(self, t, i, events):
+        try:
+            if events & (EventLoop.READ | EventLoop.ERROR):
+                d = t._dirs[i]
+                if not d.eof and (d.wpos < len(d.buf) or d.rpos):
+                    self._fill(d)
+                    self._drain(d)
+            if events & (EventLoop.WRITE | EventLoop.ERROR):
+                self._drain(t._dirs[1 - i])
+        except IOError, e:
+            self._finish(t, e)
+            return
+        self._update(t)
+
+    @staticmethod
+    def _fill(d):
+        """ Receives what src has to send, as much as the buffer takes. """
+        if d.wpos == len(d.buf) and d.rpos:
+            d.buf[:d.wpos - d.rpos] = d.view[d.rpos:d.wpos].tobytes()
+            d.wpos -= d.rpos
+            d.rpos = 0
+        try:
+            n = d.src.recv_into(d.view[d.wpos:], len(d.buf) - d.wpos)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise IOError(str(e))
+        if n:
+            d.wpos += n
+        else:
+            d.eof = True
+
+    @staticmethod
+    def _drain(d):
+        """ Sends buffered data to dst, as much as it takes, then the end of src if it's reached. """
+        while d.rpos < d.wpos:
+            try:
+                n = d.dst.send(d.view[d.rpos:d.wpos])
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise IOError(str(e))
+            d.rpos += n
+            d.count += n
+        d.rpos = d.wpos = 0
+        if d.eof and not d.shut:
+            d.shut = True
+            try:
+                d.dst.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+
+    def _update(self, t):
+        """ Watches the events the tunnel waits for, or ends it if there is none. """
+        dirs = t._dirs
+        if dirs[0].shut and dirs[1].shut:
+            self._finish(t, None)
+            return
+        for i in (0, 1):
+            out, back = dirs[i], dirs[1 - i]
+            events = 0
+            if not out.eof and (out.wpos < len(out.buf) or out.rpos):
+                events |= EventLoop.READ
+            if back.rpos < back.wpos:
+                events |= EventLoop.WRITE
+            if events != t._events[i]:
+                fd = t.peers[i].fileno()
+                if not t._events[i]:
+                    self.loop.add(fd, events, lambda ev, t=t, i=i: self._on_events(t, i, ev))
+                elif not events:
+                    self.loop.remove(fd)
                 else:
-                    dst.write(d)
+                    self.loop.modify(fd, events)
+                t._events[i] = events
+
+    def _finish(self, t, error):
+        if t not in self.tunnels:
+            return
+        self.tunnels.remove(t)
+        for i in (0, 1):
+            if t._events[i]:
+                self.loop.remove(t.peers[i].fileno())
+                t._events[i] = 0
+            try:
+                if t._close:
+                    t.peers[i].close()
+                else:
+                    t.peers[i].settimeout(t._timeouts[i])
+            except socket.error:
+                pass
+        t.finished = time.time()
+        t.error = error
+        self.bytes_relayed += t.bytes_up + t.bytes_down
+        t.done.set_result(t)
 
+
+class HTTPTunnel:
+    def __init__(self, peers):
+        self.peers = peers
+
+    def run(self):
+        """ Do blind forward till both of the peer connections are closed or an error occurs.
+
+        The end of either connection is passed on to the other one, and data buffered by the
+        peer streams is forwarded first. Peers are left open, with the timeouts they had.
+
+        Returns:
+            2-tuple (bytes forwarded from peers[0] to peers[1], bytes forwarded back).
+
+        Raises:
+            IOError: An error occurred on either connection.
+        """
+        relay = HTTPTunnelRelay()
+        t = relay.add(self.peers[0], self.peers[1], close=False)
+        relay.run()
+        relay.loop.close()
+        if t.error is not None:
+            raise t.error
+        return t.bytes_up, t.bytes_down
@@ -1,6 +1,5 @@
 import os
 import sys
-import urllib
 import logging
 from datetime import datetime
 from bs4 import BeautifulSoup
@@ -8,14 +7,24 @@ from bs4 import BeautifulSoup
 
 sys.path.append(os.path.abspath("../"))
 from ReviewRecord import *
+import httpfetch
+
+# Maximum number of hotels fetched from this site in parallel
+CONCURRENCY = 2
+
+# Seconds fetching one page from this site may take before it's given up
+TIMEOUT = 30
 
 
 def fetch(args):
     hotel_name = args[0]
     hotel_url = args[1]
-    page = urllib.urlopen(hotel_url)
+    page = httpfetch.urlopen(hotel_url, timeout=TIMEOUT)
+    if page is None:
+        # not modified since last fetch
+        return []
     if page.getcode() != 200:
-        logging.error("HTTP %d --> GET %s " % (f.getcode(), api_url))
+        logging.error("HTTP %d --> GET %s " % (page.getcode(), hotel_url))
         return None
     html_doc = page.read()
     TotalScore = 5
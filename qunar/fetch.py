@@ -1,42 +1,159 @@
 import os
 import sys
 import json
-import urllib2
 import logging
 import datetime
 
 sys.path.append(os.path.abspath("../"))
 from ReviewRecord import *
+# Generated with only the members read here, by
+#   jpc.py -slots -columns -keep=data.count,data.list.content,data.list.nickName,data.list.feedTime hotel_review.json
+#   jpc.py -slots -keep=feedContent,checkInDate,evaluation,hotelUrl,hotelName hotel_review_content.json
+# Regenerate them when reading another member.
 from hotel_review import *
 from hotel_review_content import *
+from jsonstream import JSONStream
+import httpfetch
+
+# Maximum number of hotels fetched from this site in parallel
+CONCURRENCY = 4
+
+# Seconds fetching one page from this site may take before it's given up
+TIMEOUT = 30
+
+API_URL = "http://review.qunar.com/api/h/%s/detail/rank/v1/page/%d"
+
+# Maximum number of review pages walked in one cycle
+MAX_PAGES = 10
+
+# Cycles walk a varying number of pages, so reviews left out of a cycle must not be forgotten
+PARTIAL = True
+
+# hotel id -> (review count, feedTime of the newest review) seen in the last cycle pushed
+_watermarks = {}
+# hotel id -> watermark of the last fetch, for commit to move to _watermarks
+_staged = {}
+
+
+def read_count(stream):
+    """ Reads data.count off the JSONStream of a page, None if the page has none. """
+    if not stream.begin_object():
+        return None
+    key = stream.next_key()
+    while key is not None and key != "data":
+        stream.skip()
+        key = stream.next_key()
+    if key is None or not stream.begin_object():
+        return None
+    key = stream.next_key()
+    while key is not None and key != "count":
+        stream.skip()
+        key = stream.next_key()
+    return None if key is None else stream.value()
+
+
+def fetch_page(hotel_id, page, count=None):
+    """ Fetches and decodes a page of reviews.
+
+    If count is not None, the review count is read first, as the page arrives. If it's the same,
+    the rest of the page is given up, its connection being closed rather than drained.
+
+    Returns:
+        The hotel_review of the page, None if it can't be fetched, or False if its review count
+    is count.
+    """
+    api_url = API_URL % (hotel_id, page)
+    f = httpfetch.urlopen(api_url, conditional=False, timeout=TIMEOUT, stream=count is not None)
+    try:
+        if f.getcode() != 200:
+            logging.error("HTTP %d --> GET %s " % (f.getcode(), api_url))
+            return None
+        if count is None:
+            return hotel_review.from_dict(json.loads(f.read()))
+
+        body = []
+        pieces = httpfetch.iter_body(f)
+
+        def read_pieces():
+            for piece in pieces:
+                body.append(piece)
+                yield piece
+        if read_count(JSONStream(read_pieces())) == count:
+            return False
+        # the page is decoded whole, which json does much faster than JSONStream
+        body.extend(pieces)
+        return hotel_review.from_dict(json.loads(''.join(body)))
+    finally:
+        f.close()
+
+
+def make_record(hotel_name, r):
+    record = ReviewRecord()
+    record.hotel_name = hotel_name
+    record.source_site = "qunar"
+    if r.content:
+        content = hotel_review_content.from_dict(json.loads(r.content))
+        record.comment = content.feedContent
+        record.check_in_date = content.checkInDate
+        record.rate = content.evaluation
+        record.hotel_url = content.hotelUrl
+        record.hotel_name = content.hotelName
+    record.nick_name = r.nickName
+    record.comment_date = datetime.datetime.fromtimestamp(r.feedTime/1000)
+    record.timestamp = datetime.datetime.now()
+    return record
 
 
 def fetch(args):
+    """ Fetch reviews of a hotel.
+
+    The first page of reviews is always fetched. If the review count is the same as in the last
+    cycle, nothing has changed and no record is returned, the rest of the page being given up as
+    soon as the count is read. Otherwise further pages are walked until the reviews newer than
+    the watermark, the newest review of the last cycle, account for the growth of the count.
+    Pages are ranked rather than sorted by time, so the watermark may be crossed on any page.
+
+    The new watermark is only staged, commit makes it the one the next fetch reads from.
+    """
     hotel_name = args[0]
     hotel_id = args[1]
-    api_url = "http://review.qunar.com/api/h/%s/detail/rank/v1/page/1" % hotel_id
-    f = urllib2.urlopen(api_url)
-    if f.getcode() != 200:
-        logging.error("HTTP %d --> GET %s " % (f.getcode(), api_url))
+    _staged.pop(hotel_id, None)
+    last = _watermarks.get(hotel_id)
+    review = fetch_page(hotel_id, 1, None if last is None else last[0])
+    if review is False:
+        return []
+    if review is None or review.data is None:
         return None
 
-    d = f.read()
-    review = hotel_review.from_dict(json.loads(d))
-
-    rl = []
-    for r in review.data.list:
-        record = ReviewRecord()
-        record.hotel_name = hotel_name
-        record.source_site = "qunar"
-        if r.content:
-            content = hotel_review_content.from_dict(json.loads(r.content))
-            record.comment = content.feedContent
-            record.check_in_date = content.checkInDate
-            record.rate = content.evaluation
-            record.hotel_url = content.hotelUrl
-            record.hotel_name = content.hotelName
-        record.nick_name = r.nickName
-        record.comment_date = datetime.datetime.fromtimestamp(r.feedTime/1000)
-        record.timestamp = datetime.datetime.now()
-        rl.append(record)
-    return rl
+    count = review.data.count
+    # reviews of each page, as hotel_review_data_list_columns
+    pages = [review.data.list] if review.data.list else []
+    if last is not None and count == last[0]:
+        return []
+
+    if last is not None:
+        last_count, last_time = last
+        newer = sum(len([t for t in p.feedTime if t > last_time]) for p in pages)
+        page = 1
+        while page < MAX_PAGES and pages and newer < count - last_count:
+            page += 1
+            review = fetch_page(hotel_id, page)
+            if not review or not review.data or not review.data.list:
+                break
+            pages.append(review.data.list)
+            newer += len([t for t in review.data.list.feedTime if t > last_time])
+
+    if pages:
+        _staged[hotel_id] = (count, max(max(p.feedTime) for p in pages))
+    return [make_record(hotel_name, r) for p in pages for r in p]
+
+
+def commit(args):
+    """ Moves the watermark of a hotel to where its last fetch read, its records being pushed.
+
+    Until then the next fetch reads from the old watermark, so that the reviews of a fetch whose
+    records are lost are fetched again.
+    """
+    watermark = _staged.pop(args[1], None)
+    if watermark is not None:
+        _watermarks[args[1]] = watermark
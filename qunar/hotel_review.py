@@ -1,109 +1,189 @@
 # The following code is auto generated by jpc.py
-# Source JSON file: qunar\hotel_review.json
+# Source JSON file: hotel_review.json
+from array import array
+from json import JSONEncoder
+_encode = JSONEncoder().encode
+
+
+def _column(typecode, values):
+    try:
+        return array(typecode, values)
+    except (TypeError, OverflowError):
+        # nulls or values out of the range of typecode
+        return values
+
+
 class hotel_review(object):
+    __slots__ = ("data", )
+    
     def __init__(self):
         self.data = hotel_review_data()
-        self.errcode = 0
-        self.ret = False
     
     @staticmethod
     def from_dict(dct):
         if not dct:
             return None
-        obj = hotel_review()
-        obj.data = hotel_review_data.from_dict(dct.get("data"))
-        obj.errcode = dct.get("errcode")
-        obj.ret = dct.get("ret")
+        get = dct.get
+        obj = object.__new__(hotel_review)
+        obj.data = hotel_review_data.from_dict(get("data"))
         return obj
+    
+    @staticmethod
+    def from_stream(stream):
+        if not stream.begin_object():
+            return None
+        key = stream.next_key()
+        if key is None:
+            return None
+        obj = object.__new__(hotel_review)
+        obj.data = None
+        while key is not None:
+            if key == "data":
+                obj.data = hotel_review_data.from_stream(stream)
+            else:
+                stream.skip()
+            key = stream.next_key()
+        return obj
+    
+    def to_dict(self):
+        return {
+            "data": (None if self.data is None else self.data.to_dict()),
+        }
+    
+    def to_json_fragment(self):
+        return "".join((
+            '{"data":', ("null" if self.data is None else self.data.to_json_fragment()),
+            '}',
+        ))
 
 
 class hotel_review_data(object):
+    __slots__ = ("count", "list", )
+    
     def __init__(self):
         self.count = 0
-        self.ratingStat = hotel_review_data_ratingStat()
         self.list = []
-        self.loginUser = u''
-        self.identityFailed = False
     
     @staticmethod
     def from_dict(dct):
         if not dct:
             return None
-        obj = hotel_review_data()
-        obj.count = dct.get("count")
-        obj.ratingStat = hotel_review_data_ratingStat.from_dict(dct.get("ratingStat"))
-        obj.list = hotel_review_data_list_from_list(dct.get("list"))
-        obj.loginUser = dct.get("loginUser")
-        obj.identityFailed = dct.get("identityFailed")
+        get = dct.get
+        obj = object.__new__(hotel_review_data)
+        obj.count = get("count")
+        obj.list = hotel_review_data_list_columns.from_list(get("list"))
         return obj
-
-
-class hotel_review_data_ratingStat(object):
-    def __init__(self):
-        self.positiveCount = 0
-        self.neutralCount = 0
-        self.negativeCount = 0
     
     @staticmethod
-    def from_dict(dct):
-        if not dct:
+    def from_stream(stream):
+        if not stream.begin_object():
+            return None
+        key = stream.next_key()
+        if key is None:
             return None
-        obj = hotel_review_data_ratingStat()
-        obj.positiveCount = dct.get("positiveCount")
-        obj.neutralCount = dct.get("neutralCount")
-        obj.negativeCount = dct.get("negativeCount")
+        obj = object.__new__(hotel_review_data)
+        obj.count = None
+        obj.list = None
+        while key is not None:
+            if key == "count":
+                obj.count = stream.value()
+            elif key == "list":
+                obj.list = hotel_review_data_list_columns.from_stream(stream)
+            else:
+                stream.skip()
+            key = stream.next_key()
         return obj
+    
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "list": (None if self.list is None else self.list.to_list()),
+        }
+    
+    def to_json_fragment(self):
+        return "".join((
+            '{"count":', _encode(self.count),
+            ',"list":', ("null" if self.list is None else self.list.to_json_fragment()),
+            '}',
+        ))
 
 
 class hotel_review_data_list_item(object):
+    __slots__ = ("_columns", "_index")
+    
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+    
+    @property
+    def feedTime(self):
+        return self._columns.feedTime[self._index]
+    
+    @property
+    def content(self):
+        return self._columns.content[self._index]
+    
+    @property
+    def nickName(self):
+        return self._columns.nickName[self._index]
+    
+    def to_dict(self):
+        return {
+            "feedTime": self.feedTime,
+            "content": self.content,
+            "nickName": self.nickName,
+        }
+    
+    def to_json_fragment(self):
+        return "".join((
+            '{"feedTime":', _encode(self.feedTime),
+            ',"content":', _encode(self.content),
+            ',"nickName":', _encode(self.nickName),
+            '}',
+        ))
+
+
+class hotel_review_data_list_columns(object):
+    __slots__ = ("feedTime", "content", "nickName", "_count")
+    
     def __init__(self):
-        self.status = 0
-        self.feedOid = u''
-        self.feedType = 0
-        self.uid = 0
-        self.toUid = 0
-        self.feedTime = None
-        self.originType = 0
-        self.originTypeCode = 0
-        self.delTypeCode = 0
-        self.content = u''
-        self.userIdentity = 0
-        self.encodeUserName = u''
-        self.feedTypeCode = 0
-        self.feedIp = 0
-        self.nickName = u''
-        self.badgeIds = []
-        self.statusCode = 0
+        self.feedTime = array("l")
+        self.content = []
+        self.nickName = []
+        self._count = 0
+    
+    def __len__(self):
+        return self._count
+    
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("hotel_review_data_list_columns index out of range")
+        return hotel_review_data_list_item(self, index)
+    
+    def __iter__(self):
+        for index in xrange(self._count):
+            yield hotel_review_data_list_item(self, index)
     
     @staticmethod
-    def from_dict(dct):
-        if not dct:
+    def from_list(lst):
+        if not lst:
             return None
-        obj = hotel_review_data_list_item()
-        obj.status = dct.get("status")
-        obj.feedOid = dct.get("feedOid")
-        obj.feedType = dct.get("feedType")
-        obj.uid = dct.get("uid")
-        obj.toUid = dct.get("toUid")
-        obj.feedTime = dct.get("feedTime")
-        obj.originType = dct.get("originType")
-        obj.originTypeCode = dct.get("originTypeCode")
-        obj.delTypeCode = dct.get("delTypeCode")
-        obj.content = dct.get("content")
-        obj.userIdentity = dct.get("userIdentity")
-        obj.encodeUserName = dct.get("encodeUserName")
-        obj.feedTypeCode = dct.get("feedTypeCode")
-        obj.feedIp = dct.get("feedIp")
-        obj.nickName = dct.get("nickName")
-        obj.badgeIds = dct.get("badgeIds")
-        obj.statusCode = dct.get("statusCode")
+        lst = [v for v in lst if v]
+        obj = object.__new__(hotel_review_data_list_columns)
+        obj.feedTime = _column("l", [v.get("feedTime") for v in lst])
+        obj.content = [v.get("content") for v in lst]
+        obj.nickName = [v.get("nickName") for v in lst]
+        obj._count = len(lst)
         return obj
-
-
-def hotel_review_data_list_from_list(lst):
-    if not lst:
-        return None
-    values = []
-    for v in lst:
-        values.append(hotel_review_data_list_item.from_dict(v))
-    return values
+    
+    @staticmethod
+    def from_stream(stream):
+        return hotel_review_data_list_columns.from_list(stream.value())
+    
+    def to_list(self):
+        return [row.to_dict() for row in self]
+    
+    def to_json_fragment(self):
+        return "[" + ",".join([row.to_json_fragment() for row in self]) + "]"
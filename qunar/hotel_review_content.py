@@ -1,77 +1,76 @@
 # The following code is auto generated by jpc.py
-# Source JSON file: qunar\hotel_review_content.json
+# Source JSON file: qunar/hotel_review_content.json
+from json import JSONEncoder
+_encode = JSONEncoder().encode
+
+
 class hotel_review_content(object):
+    __slots__ = ("hotelUrl", "checkInDate", "hotelName", "feedContent", "evaluation", )
+    
     def __init__(self):
-        self.from_ = u''
-        self.isOrderBind = False
-        self.fileTypes = []
-        self.title = u''
-        self.feedContentStatus = 0
-        self.hotelUrl = u''
-        self.imageUrl = []
-        self.subScores = []
-        self.detailUrl = u''
-        self.checkInDate = u''
-        self.hotelName = u''
-        self.objSeq = u''
-        self.version = 0
-        self.fileStatus = []
-        self.recommend = u''
-        self.feedContent = u''
-        self.tripType = u''
-        self.evaluationDesc = u''
+        self.hotelUrl = ''
+        self.checkInDate = ''
+        self.hotelName = ''
+        self.feedContent = ''
         self.evaluation = 0
-        self.extUrl = u''
     
     @staticmethod
     def from_dict(dct):
         if not dct:
             return None
-        obj = hotel_review_content()
-        obj.from_ = dct.get("from")
-        obj.isOrderBind = dct.get("isOrderBind")
-        obj.fileTypes = dct.get("fileTypes")
-        obj.title = dct.get("title")
-        obj.feedContentStatus = dct.get("feedContentStatus")
-        obj.hotelUrl = dct.get("hotelUrl")
-        obj.imageUrl = dct.get("imageUrl")
-        obj.subScores = hotel_review_content_subScores_from_list(dct.get("subScores"))
-        obj.detailUrl = dct.get("detailUrl")
-        obj.checkInDate = dct.get("checkInDate")
-        obj.hotelName = dct.get("hotelName")
-        obj.objSeq = dct.get("objSeq")
-        obj.version = dct.get("version")
-        obj.fileStatus = dct.get("fileStatus")
-        obj.recommend = dct.get("recommend")
-        obj.feedContent = dct.get("feedContent")
-        obj.tripType = dct.get("tripType")
-        obj.evaluationDesc = dct.get("evaluationDesc")
-        obj.evaluation = dct.get("evaluation")
-        obj.extUrl = dct.get("extUrl")
+        get = dct.get
+        obj = object.__new__(hotel_review_content)
+        obj.hotelUrl = get("hotelUrl")
+        obj.checkInDate = get("checkInDate")
+        obj.hotelName = get("hotelName")
+        obj.feedContent = get("feedContent")
+        obj.evaluation = get("evaluation")
         return obj
-
-
-class hotel_review_content_subScores_item(object):
-    def __init__(self):
-        self.tag = u''
-        self.score = 0
-        self.desc = u''
     
     @staticmethod
-    def from_dict(dct):
-        if not dct:
+    def from_stream(stream):
+        if not stream.begin_object():
+            return None
+        key = stream.next_key()
+        if key is None:
             return None
-        obj = hotel_review_content_subScores_item()
-        obj.tag = dct.get("tag")
-        obj.score = dct.get("score")
-        obj.desc = dct.get("desc")
+        obj = object.__new__(hotel_review_content)
+        obj.hotelUrl = None
+        obj.checkInDate = None
+        obj.hotelName = None
+        obj.feedContent = None
+        obj.evaluation = None
+        while key is not None:
+            if key == "hotelUrl":
+                obj.hotelUrl = stream.value()
+            elif key == "checkInDate":
+                obj.checkInDate = stream.value()
+            elif key == "hotelName":
+                obj.hotelName = stream.value()
+            elif key == "feedContent":
+                obj.feedContent = stream.value()
+            elif key == "evaluation":
+                obj.evaluation = stream.value()
+            else:
+                stream.skip()
+            key = stream.next_key()
         return obj
-
-
-def hotel_review_content_subScores_from_list(lst):
-    if not lst:
-        return None
-    values = []
-    for v in lst:
-        values.append(hotel_review_content_subScores_item.from_dict(v))
-    return values
+    
+    def to_dict(self):
+        return {
+            "hotelUrl": self.hotelUrl,
+            "checkInDate": self.checkInDate,
+            "hotelName": self.hotelName,
+            "feedContent": self.feedContent,
+            "evaluation": self.evaluation,
+        }
+    
+    def to_json_fragment(self):
+        return "".join((
+            '{"hotelUrl":', _encode(self.hotelUrl),
+            ',"checkInDate":', _encode(self.checkInDate),
+            ',"hotelName":', _encode(self.hotelName),
+            ',"feedContent":', _encode(self.feedContent),
+            ',"evaluation":', _encode(self.evaluation),
+            '}',
+        ))
@@ -0,0 +1,131 @@
+import os
+import sys
+import Queue
+import types
+import shutil
+import tempfile
+import unittest
+
+import crawler
+from HistoryStore import HistoryStore
+from ReviewRecord import ReviewRecord
+
+
+def make_review(i):
+    r = ReviewRecord()
+    r.nick_name = u"user%d" % i
+    r.comment = u"comment %d" % i
+    return r
+
+
+class FetchLatestTest(unittest.TestCase):
+    """ fetch_latest over a crawler walking 1 page of 10 reviews on shallow cycles, 3 on deep ones. """
+    def setUp(self):
+        self.pages = 1
+        self.reviews = [make_review(i) for i in range(30)]
+        package = types.ModuleType("fakesite")
+        module = types.ModuleType("fakesite.fetch")
+        module.fetch = lambda args: self.reviews[:10 * self.pages]
+        package.fetch = module
+        sys.modules["fakesite"] = package
+        sys.modules["fakesite.fetch"] = module
+        self.module = module
+        self._load_hotels = crawler.load_hotels
+        crawler.load_hotels = lambda target: [[u"hotel", u"1"]]
+
+    def tearDown(self):
+        crawler.load_hotels = self._load_hotels
+        del sys.modules["fakesite"]
+        del sys.modules["fakesite.fetch"]
+
+    def walk(self, history, pages, keep=None, cycle=None):
+        self.pages = pages
+        return len(crawler.fetch_latest("fakesite", history, keep=keep, cycle=cycle))
+
+    def test_partial_walks_are_merged(self):
+        self.module.PARTIAL = True
+        history = HistoryStore(":memory:")
+        self.assertEqual([self.walk(history, p) for p in (1, 3, 1, 3)], [10, 20, 0, 0])
+        self.reviews.insert(0, make_review(30))
+        self.assertEqual(self.walk(history, 1), 1)
+
+    def test_partial_walks_are_capped(self):
+        self.module.PARTIAL = True
+        history = HistoryStore(":memory:")
+        saved, crawler.PARTIAL_KEEP = crawler.PARTIAL_KEEP, 15
+        try:
+            self.assertEqual(self.walk(history, 3), 30)
+        finally:
+            crawler.PARTIAL_KEEP = saved
+        self.assertEqual(list(history["fakesite-hotel-1"]), [r.digest for r in self.reviews[15:30]])
+
+    def test_commit_waits_for_the_push(self):
+        committed = []
+        self.module.commit = lambda hotel_arg: committed.append(hotel_arg)
+        history = HistoryStore(":memory:")
+        cycle = crawler.Cycle()
+        self.walk(history, 1, cycle=cycle)
+        crawler.end_cycle(history, cycle, None)
+        self.assertEqual(committed, [])
+        cycle = crawler.Cycle()
+        self.walk(history, 1, cycle=cycle)
+        crawler.end_cycle(history, cycle, [(200, "")] * 10)
+        self.assertEqual(committed, [[u"hotel", u"1"]])
+
+    def test_complete_walks_forget_reviews_left_out(self):
+        history = HistoryStore(":memory:")
+        self.assertEqual([self.walk(history, p) for p in (1, 3, 1, 3)], [10, 20, 0, 20])
+
+    def test_failed_push_rolls_back_the_cycle(self):
+        history = HistoryStore(":memory:")
+        cycle = crawler.Cycle()
+        self.assertEqual(self.walk(history, 1, cycle=cycle), 10)
+        crawler.end_cycle(history, cycle, [(200, "")] * 9 + [None])
+        cycle = crawler.Cycle()
+        self.assertEqual(self.walk(history, 1, cycle=cycle), 10)
+        crawler.end_cycle(history, cycle, [(200, "")] * 10)
+        self.assertEqual(self.walk(history, 1), 0)
+
+
+class DaemonCycleTest(unittest.TestCase):
+    """ Cycles of two crawlers sharing the history of run_daemon, settled as their pushes end. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "history.db")
+        reviews = [make_review(i) for i in range(10)]
+        for target in ("sitea", "siteb"):
+            package = types.ModuleType(target)
+            module = types.ModuleType(target + ".fetch")
+            module.fetch = lambda args: reviews
+            package.fetch = module
+            sys.modules[target] = package
+            sys.modules[target + ".fetch"] = module
+        self._load_hotels = crawler.load_hotels
+        crawler.load_hotels = lambda target: [[u"hotel", u"1"]]
+
+    def tearDown(self):
+        crawler.load_hotels = self._load_hotels
+        for target in ("sitea", "siteb"):
+            del sys.modules[target]
+            del sys.modules[target + ".fetch"]
+        shutil.rmtree(self.dir)
+
+    def test_each_push_settles_its_own_cycle(self):
+        history = HistoryStore(self.path)
+        done = Queue.Queue()
+        crawler._run_cycle("sitea", history, 1, None, done)
+        crawler._run_cycle("siteb", history, 1, None, done)
+        results = dict((target, (records, cycle)) for target, records, cycle in [done.get(), done.get()])
+        self.assertEqual([len(results[t][0]) for t in ("sitea", "siteb")], [10, 10])
+
+        crawler.end_cycle(history, results["siteb"][1], [(200, "")] * 10)
+        crawler.end_cycle(history, results["sitea"][1], None)
+        reopened = HistoryStore(self.path)
+        self.assertNotIn(u"sitea-hotel-1", reopened)
+        self.assertIn(u"siteb-hotel-1", reopened)
+        self.assertEqual(len(crawler.fetch_latest("sitea", history)), 10)
+        self.assertEqual(len(crawler.fetch_latest("siteb", history)), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
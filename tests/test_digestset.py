@@ -0,0 +1,72 @@
+import unittest
+
+from DigestSet import DigestSet
+
+
+def digest(i, prefix="\0" * 8):
+    """ 16-byte digests sharing their first 8 bytes, which DigestSet hashes, collide. """
+    return prefix + "%08d" % i
+
+
+class DigestSetTest(unittest.TestCase):
+    def test_colliding_digests_are_told_apart(self):
+        s = DigestSet()
+        for i in range(100):
+            self.assertTrue(s.add(digest(i)))
+        for i in range(100):
+            self.assertFalse(s.add(digest(i)))
+            self.assertIn(digest(i), s)
+        self.assertNotIn(digest(100), s)
+        self.assertEqual(len(s), 100)
+
+    def test_oldest_digests_are_evicted_at_capacity(self):
+        s = DigestSet(capacity=10)
+        for i in range(25):
+            s.add(digest(i, "%08d" % i))
+        self.assertEqual(len(s), 10)
+        self.assertEqual(list(s), [digest(i, "%08d" % i) for i in range(15, 25)])
+        self.assertNotIn(digest(14, "%08d" % 14), s)
+        # an evicted digest is new again
+        self.assertTrue(s.add(digest(0, "%08d" % 0)))
+        self.assertNotIn(digest(15, "%08d" % 15), s)
+
+    def test_eviction_among_collisions(self):
+        s = DigestSet(capacity=5)
+        for i in range(50):
+            s.add(digest(i))
+        self.assertEqual(list(s), [digest(i) for i in range(45, 50)])
+        for i in range(45):
+            self.assertNotIn(digest(i), s)
+
+    def test_bytes_round_trip(self):
+        s = DigestSet(capacity=20)
+        for i in range(30):
+            s.add(digest(i, "%08d" % (i % 7)))
+        data = s.tobytes()
+        self.assertEqual(len(data), 20 * DigestSet.WIDTH)
+        copy = DigestSet.frombytes(data)
+        self.assertEqual(list(copy), list(s))
+        self.assertEqual(copy.tobytes(), data)
+        self.assertEqual(list(DigestSet.frombytes(data, capacity=5)), list(s)[-5:])
+        self.assertEqual(len(DigestSet.frombytes("")), 0)
+
+    def test_shrinking_capacity_evicts_the_oldest(self):
+        s = DigestSet()
+        for i in range(100):
+            s.add(digest(i, "%08d" % i))
+        s.capacity = 30
+        self.assertEqual(len(s), 30)
+        self.assertEqual(list(s), [digest(i, "%08d" % i) for i in range(70, 100)])
+        for i in range(70):
+            self.assertNotIn(digest(i, "%08d" % i), s)
+        s.capacity = 0
+        for i in range(100, 200):
+            s.add(digest(i, "%08d" % i))
+        self.assertEqual(len(s), 130)
+
+    def test_digests_must_be_16_bytes(self):
+        self.assertRaises(ValueError, DigestSet().add, "short")
+
+
+if __name__ == "__main__":
+    unittest.main()
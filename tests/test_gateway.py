@@ -0,0 +1,180 @@
+import json
+import socket
+import datetime
+import threading
+import unittest
+import BaseHTTPServer
+
+import DataGatewayClient as gateway_client
+from DataGatewayClient import DataGatewayClient, DataGatewayJSONRequest
+from ReviewRecord import ReviewRecord
+from libhttp import HTTPIOStream, HTTPInputStream
+
+
+class GatewayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers batch PUTs with the body server.answer(records) returns. """
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        records = json.loads(body)
+        self.server.received.append(records)
+        answer = self.server.answer(records)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+    def log_message(self, *args):
+        pass
+
+
+class Gateway(BaseHTTPServer.HTTPServer):
+    """ A local stand-in of the data gateway, serving one connection at a time. """
+    def __init__(self, answer):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), GatewayHandler)
+        self.answer = answer
+        self.received = []
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def make_records(count):
+    records = []
+    for i in range(count):
+        r = ReviewRecord()
+        r.nick_name = u"user%d" % i
+        r.comment = u"comment %d" % i
+        records.append(r)
+    return records
+
+
+class PushBatchTest(unittest.TestCase):
+    def push(self, answer, count, batch_size=100):
+        gateway = Gateway(answer)
+        client = DataGatewayClient(gateway.server_address, batch_size=batch_size)
+        try:
+            statuses = client.push_batch("hotel_review", make_records(count), "mysql")
+        finally:
+            client.close()
+            gateway.stop()
+        return statuses, gateway.received
+
+    def test_per_record_statuses(self):
+        def answer(records):
+            return json.dumps([{"code": 200 if i % 2 else 409, "reason": "r%d" % i}
+                               for i in range(len(records))])
+
+        statuses, received = self.push(answer, 5, batch_size=3)
+        self.assertEqual([len(batch) for batch in received], [3, 2])
+        self.assertEqual([s[0] for s in statuses], [409, 200, 409, 409, 200])
+        self.assertEqual(received[1][0]["data"]["nick_name"], "user3")
+
+    def test_pairs_and_bare_codes(self):
+        statuses, _ = self.push(lambda records: json.dumps([[201, "created"], 200]), 2)
+        self.assertEqual(statuses, [(201, "created"), (200, "")])
+
+    def test_unparsable_status_applies_response_to_batch(self):
+        for body in ('[{"code": null}, 200]', '["ok", 200]', '[[], 200]', '{"code": 200}'):
+            statuses, _ = self.push(lambda records: body, 2)
+            self.assertEqual(statuses, [(200, body)] * 2)
+
+
+class EncoderTest(unittest.TestCase):
+    def test_registered_encoder_gives_equivalent_json(self):
+        r = ReviewRecord()
+        r.hotel_name = u"\u5434\u6c5f\u4e1c\u6052\u76db"
+        r.source_site = "qunar"
+        r.nick_name = u"kzrx \"3559\"\n"
+        r.comment = u"\u623f\u95f4\u633a\u5927\u7684\u3002\t\\"
+        r.rate = 4
+        r.comment_date = datetime.datetime(2015, 2, 23, 8, 0, 0)
+        r.timestamp = datetime.datetime(2015, 2, 23, 8, 0, 0, 123456)
+        registered = DataGatewayJSONRequest("hotel_review", r, "mysql").getstr()
+        encoder = gateway_client._encoders.pop(ReviewRecord)
+        try:
+            aggressive = DataGatewayJSONRequest("hotel_review", r, "mysql").getstr()
+        finally:
+            gateway_client.register_encoder(ReviewRecord, encoder)
+        self.assertIsInstance(registered, str)
+        self.assertEqual(json.loads(registered), json.loads(aggressive))
+
+
+class ReplaySocket(object):
+    """ A socket stand-in whose recv replays data, in pieces of at most piece_size bytes. What's
+    sent is kept in sent.
+    """
+    def __init__(self, data, piece_size=1000):
+        self._data = data
+        self._pos = 0
+        self._piece_size = piece_size
+        self.sent = []
+
+    def recv_into(self, buf, n=0):
+        n = min(n or len(buf), self._piece_size)
+        d = self._data[self._pos:self._pos+n]
+        self._pos += len(d)
+        buf[:len(d)] = d
+        return len(d)
+
+    def send(self, data):
+        self.sent.append(str(data))
+        return len(data)
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+def chunked(body, size=7):
+    pieces = ["%x\r\n%s\r\n" % (len(body[i:i+size]), body[i:i+size])
+              for i in range(0, len(body), size)]
+    return "".join(pieces) + "0\r\nX-Trailer: 1\r\n\r\n"
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        # the client connects on creation, to a gateway never answering
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+
+    def tearDown(self):
+        self.listener.close()
+
+    def replay(self, responses, batch_size):
+        client = DataGatewayClient(self.listener.getsockname(), batch_size=batch_size,
+                                   pipeline=len(responses))
+        client.close()
+        client._ios = HTTPIOStream(ReplaySocket("".join(responses)), ("gateway", 8086))
+        return client
+
+    def test_chunked_and_large_responses(self):
+        large = "x" * (HTTPInputStream.BUFFER_LIMIT + 1)
+        responses = ["HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n" +
+                     chunked(json.dumps([200, [409, "duplicate"]])),
+                     "HTTP/1.1 500 Error\r\nContent-Length: %d\r\n\r\n%s" % (len(large), large),
+                     "HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n" +
+                     chunked(json.dumps([{"code": 201}, {"code": 200}]))]
+        client = self.replay(responses, 2)
+        statuses = client.push_batch("hotel_review", make_records(6), "mysql")
+        self.assertEqual(statuses, [(200, ""), (409, "duplicate"), (500, large), (500, large),
+                                    (201, ""), (200, "")])
+
+    def test_chunked_responses_to_single_pushes(self):
+        responses = ["HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n" +
+                     chunked("stored %d" % i) for i in range(3)]
+        client = self.replay(responses, 0)
+        statuses = client.push_many("hotel_review", make_records(3), "mysql")
+        self.assertEqual(statuses, [(200, "stored %d" % i) for i in range(3)])
+
+
+if __name__ == "__main__":
+    unittest.main()
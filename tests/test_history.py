@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from DigestSet import DigestSet
+from HistoryStore import HistoryStore
+
+
+class HistoryStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "history.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_updates_are_committed_on_flush_only(self):
+        store = HistoryStore(self.path)
+        for i in range(200):
+            seen = DigestSet()
+            seen.add(("%016d" % i))
+            store["hotel-%d" % i] = seen
+        # another connection sees what a restart would
+        self.assertEqual(len(HistoryStore(self.path)), 0)
+        store.flush()
+        reopened = HistoryStore(self.path)
+        self.assertEqual(len(reopened), 200)
+        self.assertIn("%016d" % 7, reopened["hotel-7"])
+
+    def test_flush_and_rollback_only_touch_the_keys_given(self):
+        store = HistoryStore(self.path)
+        for key in ("a-1", "b-1"):
+            seen = DigestSet()
+            seen.add("%016d" % 1)
+            store[key] = seen
+        store.flush(["a-1"])
+        self.assertEqual(len(HistoryStore(self.path)), 1)
+        store.rollback(["b-1"])
+        self.assertNotIn("b-1", store)
+        store.flush()
+        self.assertEqual(len(HistoryStore(self.path)), 1)
+
+    def test_rollback_restores_sets_changed_in_place(self):
+        store = HistoryStore(self.path)
+        seen = DigestSet()
+        seen.add("%016d" % 1)
+        store["a-1"] = seen
+        store.flush()
+        seen = store["a-1"]
+        seen.add("%016d" % 2)
+        store["a-1"] = seen
+        store.rollback(["a-1"])
+        self.assertIn("%016d" % 1, store["a-1"])
+        self.assertNotIn("%016d" % 2, store["a-1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
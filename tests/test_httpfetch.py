@@ -0,0 +1,117 @@
+import os
+import ssl
+import threading
+import unittest
+import SocketServer
+import BaseHTTPServer
+
+import httpfetch
+
+
+class PageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves a page with an ETag, or 304 if it's matched. """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = "page"
+        self.send_response(200)
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RedirectHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Redirects every request to server.location. """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(301)
+        self.send_header("Location", self.server.location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class Site(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A local site, whose connections may be kept alive by the pool of httpfetch. """
+    daemon_threads = True
+
+    def __init__(self, handler, https=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), handler)
+        if https:
+            certfile = os.path.join(os.path.dirname(__file__), "localhost.pem")
+            self.socket = ssl.wrap_socket(self.socket, certfile=certfile, server_side=True)
+        self.url = "%s://127.0.0.1:%d/" % ("https" if https else "http", self.server_address[1])
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ValidatorsTest(unittest.TestCase):
+    def setUp(self):
+        self.site = Site(PageHandler)
+        self._validators = httpfetch._validators
+        httpfetch._validators = httpfetch.ValidatorCache(":memory:")
+
+    def tearDown(self):
+        httpfetch._validators = self._validators
+        httpfetch._client.close()
+        self.site.stop()
+
+    def test_staged_validators_are_stored_on_demand(self):
+        url = self.site.url
+        pending = {}
+        httpfetch.stage_validators(pending)
+        try:
+            self.assertEqual(httpfetch.urlopen(url).read(), "page")
+        finally:
+            httpfetch.stage_validators(None)
+        self.assertEqual(pending, {url: ('"v1"', None)})
+        self.assertEqual(httpfetch.validators().get(url), (None, None))
+        self.assertIsNotNone(httpfetch.urlopen(url, conditional=False))
+
+        httpfetch.store_validators(pending)
+        self.assertIsNone(httpfetch.urlopen(url))
+
+
+class RedirectTest(unittest.TestCase):
+    def setUp(self):
+        self.https = Site(PageHandler, https=True)
+        self.http = Site(RedirectHandler)
+        self.http.location = self.https.url + "moved"
+        # the certificate of the local site is self-signed
+        self._https_context = ssl._create_default_https_context
+        ssl._create_default_https_context = ssl._create_unverified_context
+
+    def tearDown(self):
+        ssl._create_default_https_context = self._https_context
+        httpfetch._client.close()
+        self.http.stop()
+        self.https.stop()
+
+    def test_redirect_to_https_is_followed(self):
+        for stream in (False, True):
+            f = httpfetch.urlopen(self.http.url, conditional=False, stream=stream)
+            self.assertEqual(f.getcode(), 200)
+            self.assertEqual(f.geturl(), self.http.location)
+            self.assertEqual(''.join(httpfetch.iter_body(f)), "page")
+            f.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+import json
+import operator
+import unittest
+from array import array
+
+from jpc import JSONPrototypeCompiler, LAYOUTS
+from jsonstream import JSONStream
+
+PROTOTYPE = {
+    "id": 1,
+    "name": "prototype",
+    "score": 1.5,
+    "ok": True,
+    "class": "keyword",
+    "tags": ["tag"],
+    "owner": {"nick": "nick", "age": 30},
+    "items": [{"title": "title", "rank": 1, "price": 2.5, "meta": {"k": "v", "z": 0}}],
+}
+
+DOCUMENT = {
+    "id": 7,
+    "name": u"document",
+    "score": 3.25,
+    "ok": False,
+    "class": u"c",
+    "tags": [u"a", u"b"],
+    "owner": {"nick": u"kzrx", "age": 41},
+    "items": [{"title": u"first", "rank": 2, "price": 9.5, "meta": {"k": u"x", "z": 1}},
+              {"title": u"second", "rank": 5, "price": 0.5, "meta": None}],
+}
+
+
+def compile_classes(layout="dict", projection=None, columns=False, prototype=PROTOTYPE):
+    """ Compiles prototype into classes, the top one being named proto, and returns them by name. """
+    compiler = JSONPrototypeCompiler(layout, columns)
+    compiler.compile_object("proto", prototype, projection)
+    ns = {}
+    exec compiler.python_code() in ns
+    return ns
+
+
+class LayoutTest(unittest.TestCase):
+    def test_layouts_decode_and_encode_alike(self):
+        for layout in LAYOUTS:
+            proto = compile_classes(layout)["proto"]
+            obj = proto.from_dict(DOCUMENT)
+            self.assertEqual(obj.to_dict(), DOCUMENT)
+            self.assertEqual(json.loads(obj.to_json_fragment()), DOCUMENT)
+            self.assertIsNone(proto.from_dict(None))
+
+    def test_slots_classes_have_attributes_only(self):
+        ns = compile_classes("slots")
+        obj = ns["proto"].from_dict(DOCUMENT)
+        self.assertFalse(hasattr(obj, "__dict__"))
+        self.assertEqual((obj.id, obj.name, obj.score, obj.ok), (7, u"document", 3.25, False))
+        self.assertEqual(obj.class_, u"c")
+        self.assertEqual(obj.owner.nick, u"kzrx")
+        self.assertEqual([(i.title, i.rank) for i in obj.items], [(u"first", 2), (u"second", 5)])
+        self.assertEqual(obj.items[0].meta.k, u"x")
+        self.assertIsNone(obj.items[1].meta)
+        obj.name = u"changed"
+        self.assertEqual(obj.name, u"changed")
+        self.assertRaises(AttributeError, setattr, obj, "undeclared", 1)
+
+        empty = ns["proto"]()
+        self.assertEqual((empty.id, empty.name, empty.score, empty.ok, empty.tags),
+                         (0, '', 0.0, False, []))
+        self.assertEqual(empty.owner.age, 0)
+
+    def test_tuple_classes_are_read_only_tuples(self):
+        ns = compile_classes("tuple")
+        proto = ns["proto"]
+        obj = proto.from_dict(DOCUMENT)
+        self.assertIsInstance(obj, tuple)
+        self.assertEqual(len(obj), len(proto._fields))
+        for name in ("id", "name", "score", "ok", "class_", "tags"):
+            self.assertEqual(obj[proto._fields.index(name)], getattr(obj, name))
+        self.assertEqual(obj.name, u"document")
+        self.assertEqual(obj.class_, u"c")
+        owner = obj[proto._fields.index("owner")]
+        self.assertEqual(owner[owner._fields.index("nick")], u"kzrx")
+        item = obj.items[1]
+        self.assertEqual(item[item._fields.index("title")], u"second")
+        self.assertRaises(AttributeError, setattr, obj, "name", u"changed")
+        self.assertRaises(TypeError, operator.setitem, obj, 0, 1)
+
+        empty = proto()
+        self.assertEqual((empty.id, empty.name, empty.ok), (0, '', False))
+        self.assertEqual(empty.owner.nick, '')
+
+
+class ProjectionTest(unittest.TestCase):
+    PROJECTION = ["name", "owner.nick", "items.title", "items.meta"]
+
+    def test_only_projected_members_are_generated(self):
+        for layout in ("slots", "tuple"):
+            ns = compile_classes(layout, self.PROJECTION)
+            fields = "_fields" if layout == "tuple" else "__slots__"
+            self.assertEqual(set(getattr(ns["proto"], fields)), set(["name", "owner", "items"]))
+            self.assertEqual(getattr(ns["proto_owner"], fields), ("nick",))
+            # a path ending on an object keeps all of its members
+            self.assertEqual(set(getattr(ns["proto_items_item"], fields)), set(["title", "meta"]))
+            self.assertEqual(set(getattr(ns["proto_items_item_meta"], fields)), set(["k", "z"]))
+
+    def test_dropped_paths_are_never_decoded(self):
+        doc = dict(DOCUMENT)
+        # decoders of these would fail on values of the wrong type, were they run
+        doc["tags"] = 42
+        doc["owner"] = {"nick": u"kzrx", "age": "not a number"}
+        doc["id"] = {"not": "an int"}
+        for layout in LAYOUTS:
+            proto = compile_classes(layout, self.PROJECTION)["proto"]
+            obj = proto.from_dict(doc)
+            self.assertEqual(obj.to_dict(), {
+                "name": u"document",
+                "owner": {"nick": u"kzrx"},
+                "items": [{"title": u"first", "meta": {"k": u"x", "z": 1}},
+                          {"title": u"second", "meta": None}],
+            })
+            self.assertFalse(hasattr(obj, "tags"))
+            self.assertFalse(hasattr(obj.owner, "age"))
+
+    def test_nested_lists_keep_only_the_listed_leaves(self):
+        prototype = {"pages": [{"rows": [{"a": 1, "b": "x", "c": {"d": 2}}], "n": 1}]}
+        doc = {"pages": [{"rows": [{"a": 5, "b": u"y", "c": {"d": 6}}, {"a": 7, "b": u"z"}], "n": 2},
+                         {"rows": None, "n": 3}]}
+        ns = compile_classes("slots", ["pages.rows.a", "pages.rows.c.d"], prototype=prototype)
+        self.assertEqual(ns["proto_pages_item"].__slots__, ("rows",))
+        self.assertEqual(set(ns["proto_pages_item_rows_item"].__slots__), set(["a", "c"]))
+        obj = ns["proto"].from_dict(doc)
+        self.assertEqual(obj.to_dict(), {"pages": [{"rows": [{"a": 5, "c": {"d": 6}},
+                                                             {"a": 7, "c": None}]},
+                                                   {"rows": None}]})
+
+    def test_streams_skip_dropped_paths(self):
+        text = json.dumps(DOCUMENT)
+        pieces = [text[i:i+7] for i in range(0, len(text), 7)]
+        for layout in LAYOUTS:
+            proto = compile_classes(layout, self.PROJECTION)["proto"]
+            self.assertEqual(proto.from_stream(JSONStream(pieces)).to_dict(),
+                             proto.from_dict(DOCUMENT).to_dict())
+
+    def test_bad_paths_are_refused(self):
+        self.assertRaises(ValueError, compile_classes, "slots", ["missing"])
+        self.assertRaises(ValueError, compile_classes, "slots", ["owner.missing"])
+        # name is a string, it has no members to project
+        self.assertRaises(ValueError, compile_classes, "slots", ["name.first"])
+
+
+class ColumnsTest(unittest.TestCase):
+    def setUp(self):
+        self.ns = compile_classes("slots", columns=True)
+        self.proto = self.ns["proto"]
+
+    def test_lists_of_objects_decode_into_columns(self):
+        items = self.proto.from_dict(DOCUMENT).items
+        self.assertIsInstance(items, self.ns["proto_items_columns"])
+        self.assertEqual(items.rank, array("l", [2, 5]))
+        self.assertEqual(items.price, array("d", [9.5, 0.5]))
+        self.assertEqual(items.title, [u"first", u"second"])
+        self.assertEqual(items.meta[0].k, u"x")
+        self.assertIsNone(items.meta[1])
+        # lists of scalars are left alone
+        self.assertEqual(self.proto.from_dict(DOCUMENT).tags, [u"a", u"b"])
+
+    def test_rows_view_the_columns(self):
+        items = self.proto.from_dict(DOCUMENT).items
+        self.assertEqual(len(items), 2)
+        self.assertEqual([(row.title, row.rank, row.price) for row in items],
+                         [(u"first", 2, 9.5), (u"second", 5, 0.5)])
+        self.assertEqual(items[-1].title, u"second")
+        self.assertRaises(IndexError, items.__getitem__, 2)
+        self.assertRaises(IndexError, items.__getitem__, -3)
+        self.assertEqual(items[0].to_dict(), DOCUMENT["items"][0])
+
+    def test_columns_encode_as_lists_of_objects(self):
+        obj = self.proto.from_dict(DOCUMENT)
+        self.assertEqual(obj.to_dict(), DOCUMENT)
+        self.assertEqual(json.loads(obj.to_json_fragment()), DOCUMENT)
+
+    def test_null_items_are_dropped_and_empty_lists_are_none(self):
+        doc = dict(DOCUMENT, items=[None, DOCUMENT["items"][1], {}])
+        self.assertEqual(self.proto.from_dict(doc).items.title, [u"second"])
+        self.assertIsNone(self.proto.from_dict(dict(DOCUMENT, items=[])).items)
+        self.assertIsNone(self.proto.from_dict(dict(DOCUMENT, items=None)).items)
+
+    def test_numeric_columns_fall_back_to_lists(self):
+        for ranks in ([1, None], [1, 2 ** 70], [1, 2.5]):
+            doc = dict(DOCUMENT, items=[dict(DOCUMENT["items"][0], rank=rank) for rank in ranks])
+            items = self.proto.from_dict(doc).items
+            self.assertEqual(list(items.rank), ranks)
+            self.assertEqual([row.rank for row in items], ranks)
+        doc = dict(DOCUMENT, items=[dict(DOCUMENT["items"][0], price=None)])
+        self.assertEqual(self.proto.from_dict(doc).items.price, [None])
+
+    def test_columns_are_read_from_streams(self):
+        text = json.dumps(DOCUMENT)
+        obj = self.proto.from_stream(JSONStream([text[i:i+5] for i in range(0, len(text), 5)]))
+        self.assertEqual(obj.items.rank, array("l", [2, 5]))
+        self.assertEqual(obj.to_dict(), DOCUMENT)
+
+
+if __name__ == "__main__":
+    unittest.main()
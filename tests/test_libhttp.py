@@ -0,0 +1,404 @@
+import time
+import random
+import socket
+import threading
+import unittest
+
+from libhttp import AsyncHTTPIOStream, EventLoop, HTTPRequest, Return, Task
+from libhttp import HTTPAddress, HTTPClient, HTTPDeadlineExceeded, HTTPHeaders, HTTPReadTimeout
+from libhttp import HTTPParser, HTTPResponse, HTTPIOStream, HTTPTunnel, HTTPTunnelRelay
+
+
+class Server(object):
+    """ A raw HTTP server answering every request with "ok".
+
+    Each connection serves up to `serve` requests, None for no limit, and is closed without a
+    response on the next one, as a peer timing out an idle connection does.
+    """
+    RESPONSE = "HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+
+    def __init__(self, serve=None):
+        self.serve = serve
+        self.connections = 0
+        self._sock = socket.socket()
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen(8)
+        self.address = HTTPAddress("127.0.0.1", self._sock.getsockname()[1])
+        self._start(self._accept)
+
+    def close(self):
+        self._sock.shutdown(socket.SHUT_RDWR)
+        self._sock.close()
+
+    @staticmethod
+    def _start(target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.daemon = True
+        t.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            self._start(self._handle, conn)
+
+    def _handle(self, conn):
+        data = ""
+        served = 0
+        try:
+            while True:
+                while "\r\n\r\n" not in data:
+                    d = conn.recv(4096)
+                    if not d:
+                        return
+                    data += d
+                data = data.split("\r\n\r\n", 1)[1]
+                if self.serve is not None and served >= self.serve:
+                    return
+                conn.sendall(Server.RESPONSE)
+                served += 1
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+
+class AsyncHTTPIOStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop()
+        a, self.peer = socket.socketpair()
+        self.ios = AsyncHTTPIOStream(self.loop, a)
+
+    def tearDown(self):
+        self.ios.close()
+        self.peer.close()
+        self.loop.close()
+
+    def test_read_and_read_message_return_futures(self):
+        self.peer.sendall("abcdefPUT /x HTTP/1.1\r\nContent-Length: 3\r\n\r\nxyz")
+
+        def read(ios):
+            first = yield ios.read(2)
+            rest = yield ios.read(4)
+            m = yield ios.read_message(HTTPRequest())
+            raise Return((first, rest, m))
+
+        first, rest, m = self.loop.run_until_complete(Task(read(self.ios)))
+        self.assertEqual((first, rest), ("ab", "cdef"))
+        self.assertEqual((m.method, m.body, m.body_pending), ("PUT", "xyz", False))
+
+    def test_read_fails_on_eof(self):
+        self.peer.sendall("abc")
+        self.peer.close()
+        self.assertRaises(EOFError, self.loop.run_until_complete, self.ios.read(4))
+
+
+class HTTPIOStreamTest(unittest.TestCase):
+    def setUp(self):
+        # connections are established in the backlog, and never answered
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(8)
+        self.address = HTTPAddress("127.0.0.1", self.sock.getsockname()[1])
+
+    def tearDown(self):
+        self.sock.close()
+
+    def test_connect_timeout_does_not_outlive_the_connection(self):
+        ios = HTTPIOStream(addr=self.address, connect_timeout=0.1)
+        self.assertIsNone(ios.socket.gettimeout())
+        ios.close()
+
+    def test_read_timeout_applies_once_connected(self):
+        ios = HTTPIOStream(addr=self.address, connect_timeout=5, read_timeout=0.1)
+        self.assertEqual(ios.socket.gettimeout(), 0.1)
+        start = time.time()
+        try:
+            ios.read_some(1)
+        except HTTPReadTimeout, e:
+            self.assertIn("0.1s", str(e))
+        else:
+            self.fail("read_some did not time out")
+        self.assertLess(time.time() - start, 2)
+        ios.close()
+
+
+class HTTPClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = None
+        self.client = None
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def get(self, **kwargs):
+        return self.client.request(self.server.address, HTTPRequest(method="GET", target="/"), **kwargs)
+
+    def test_connections_are_reused(self):
+        self.server = Server()
+        self.client = HTTPClient()
+        for _ in range(3):
+            self.assertEqual(self.get().body, "ok")
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.client._idle[self.server.address]), 1)
+
+    def test_connections_idle_too_long_are_not_reused(self):
+        self.server = Server()
+        self.client = HTTPClient(max_idle_time=0)
+        self.get()
+        time.sleep(0.01)
+        self.get()
+        self.assertEqual(self.server.connections, 2)
+
+    def test_request_failing_on_a_reused_connection_is_retried(self):
+        self.server = Server(serve=1)
+        self.client = HTTPClient()
+        self.assertEqual(self.get().body, "ok")
+        # the pooled connection looks alive, but is closed once the request is sent
+        self.assertEqual(self.get().body, "ok")
+        self.assertEqual(self.server.connections, 2)
+
+    def test_connections_per_host_are_limited(self):
+        self.server = Server()
+        self.client = HTTPClient(max_connections=1)
+        resp = self.get(stream=True)
+        self.assertRaises(HTTPDeadlineExceeded, self.get, timeout=0.1)
+        self.assertEqual(self.server.connections, 1)
+        resp.body_pieces.close()
+        # closing a body not read closes the connection, which frees a slot
+        self.assertEqual(self.get(timeout=5).body, "ok")
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.client._busy[self.server.address], 0)
+
+
+class HTTPHeadersTest(unittest.TestCase):
+    def assertIndexed(self, headers):
+        """ Checks lookups through the index against a scan of the fields. """
+        items = headers.items()
+        for name in set(k.lower() for k, v in items) | set(["missing"]):
+            values = [v for k, v in items if k.lower() == name]
+            self.assertEqual(headers.getall(name.upper()), values)
+            self.assertEqual(headers.get(name), values[0] if values else None)
+            self.assertEqual(name in headers, bool(values))
+            positions = [i for i, (k, v) in enumerate(items) if k.lower() == name]
+            for start in range(len(items) + 1):
+                later = [i for i in positions if i >= start]
+                self.assertEqual(headers.find(name, start), later[0] if later else -1)
+
+    def test_lookups_ignore_case_and_keep_order(self):
+        headers = HTTPHeaders()
+        for kv in [("Set-Cookie", "a"), ("Host", "x"), ("set-cookie", "b"), ("SET-COOKIE", "c")]:
+            headers.append(kv)
+        self.assertEqual(headers.getall("Set-Cookie"), ["a", "b", "c"])
+        self.assertEqual(list(headers.keys), ["Set-Cookie", "Host", "set-cookie", "SET-COOKIE"])
+        self.assertIndexed(headers)
+
+    def test_set_replaces_the_first_field_only(self):
+        headers = HTTPHeaders()
+        for kv in [("Via", "1"), ("Host", "x"), ("Via", "2")]:
+            headers.append(kv)
+        headers.set("via", 3)
+        self.assertEqual(headers.items(), [("via", "3"), ("Host", "x"), ("Via", "2")])
+        headers.set("Accept", "*/*")
+        self.assertEqual(headers.at(3), ("Accept", "*/*"))
+        self.assertIndexed(headers)
+
+    def test_setall_leaves_one_field(self):
+        headers = HTTPHeaders()
+        for kv in [("Host", "x"), ("Via", "1"), ("Age", "0"), ("Via", "2"), ("Via", "3")]:
+            headers.append(kv)
+        headers.setall("Via", "4")
+        self.assertEqual(headers.items(), [("Host", "x"), ("Via", "4"), ("Age", "0")])
+        self.assertIndexed(headers)
+
+    def test_removals_shift_positions(self):
+        headers = HTTPHeaders()
+        for kv in [("Via", "1"), ("Host", "x"), ("Via", "2"), ("Age", "0"), ("Via", "3")]:
+            headers.append(kv)
+        headers.remove("Via", 1)
+        self.assertEqual(headers.getall("Via"), ["1", "3"])
+        self.assertIndexed(headers)
+        headers.removeall("Via")
+        self.assertEqual(headers.items(), [("Host", "x"), ("Age", "0")])
+        self.assertIndexed(headers)
+        headers.pop(0)
+        self.assertEqual(headers.find("Age"), 0)
+        self.assertIndexed(headers)
+
+    def test_random_updates_keep_the_index_right(self):
+        rand = random.Random(7)
+        headers = HTTPHeaders()
+        names = ["Via", "via", "Host", "Set-Cookie", "Age"]
+        for step in range(500):
+            name = rand.choice(names)
+            op = rand.randrange(5)
+            if op == 0:
+                headers.append((name, step))
+            elif op == 1:
+                headers.set(name, step)
+            elif op == 2:
+                headers.setall(name, step)
+            elif op == 3:
+                headers.remove(name, rand.randrange(len(headers) + 1))
+            elif len(headers):
+                headers.pop(rand.randrange(len(headers)))
+            self.assertIndexed(headers)
+
+
+class HTTPParserTest(unittest.TestCase):
+    def parse(self, pieces, message_class=HTTPRequest, eof=False):
+        """ Feeds pieces to a parser and returns 2-tuples (message, body) of the messages completed. """
+        parser = HTTPParser(message_class)
+        messages = []
+        body = []
+        events = []
+        for piece in pieces:
+            events += parser.feed(piece)
+        if eof:
+            events += parser.feed_eof()
+        for event, value in events:
+            if event == HTTPParser.BODY:
+                body.append(value)
+            elif event == HTTPParser.MESSAGE_COMPLETE:
+                messages.append((value, ''.join(body)))
+                body = []
+        return messages
+
+    def bytewise(self, data):
+        return [data[i] for i in range(len(data))]
+
+    def test_chunk_extensions_are_ignored(self):
+        data = ("POST /x HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+                "5;name=value\r\nhello\r\n6 ; a=\"b;c\"\r\n world\r\n0;last\r\n\r\n")
+        (m, body), = self.parse([data])
+        self.assertEqual((m.method, body), ("POST", "hello world"))
+
+    def test_trailer_fields_are_added_to_the_message(self):
+        data = ("HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\nTrailer: X-Checksum\r\n\r\n"
+                "3\r\nabc\r\n0\r\nX-Checksum: 900150983cd2\r\nExpires: 0\r\n\r\n")
+        (m, body), = self.parse([data], HTTPResponse)
+        self.assertEqual(body, "abc")
+        self.assertEqual(m.get("X-Checksum"), "900150983cd2")
+        self.assertEqual(m.get("Expires"), "0")
+
+    def test_body_may_be_delimited_by_the_end_of_the_connection(self):
+        data = "HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n\r\nall of it"
+        self.assertEqual(self.parse([data], HTTPResponse), [])
+        (m, body), = self.parse([data[:40], data[40:]], HTTPResponse, eof=True)
+        self.assertEqual((m.code, body), (200, "all of it"))
+
+    def test_connection_closed_in_a_body_is_an_error(self):
+        data = "HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nshort"
+        self.assertRaises(EOFError, self.parse, [data], HTTPResponse, True)
+
+    def test_pipelined_messages_are_parsed_in_turn(self):
+        data = ("GET /a HTTP/1.1\r\nHost: x\r\n\r\n"
+                "PUT /b HTTP/1.1\r\nContent-Length: 3\r\n\r\nxyz"
+                "POST /c HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n2\r\nuv\r\n0\r\n\r\n"
+                "DELETE /d HTTP/1.1\r\n\r\n")
+        for pieces in ([data], self.bytewise(data)):
+            messages = self.parse(pieces)
+            self.assertEqual([(m.method, m.target, body) for m, body in messages],
+                             [("GET", "/a", ""), ("PUT", "/b", "xyz"), ("POST", "/c", "uv"),
+                              ("DELETE", "/d", "")])
+
+    def test_crlf_may_be_split_across_feeds(self):
+        data = ("HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\nX-A: 1\r\n\r\n"
+                "4\r\nabcd\r\n0\r\nX-B: 2\r\n\r\n")
+        expected = [(200, "1", "2", "abcd")]
+        for i in range(1, len(data)):
+            if data[i - 1] != "\r":
+                continue
+            messages = self.parse([data[:i], data[i:]], HTTPResponse)
+            self.assertEqual([(m.code, m.get("X-A"), m.get("X-B"), body) for m, body in messages],
+                             expected)
+        messages = self.parse(self.bytewise(data), HTTPResponse)
+        self.assertEqual([(m.code, m.get("X-A"), m.get("X-B"), body) for m, body in messages], expected)
+
+
+def read_all(sock):
+    data = []
+    d = sock.recv(65536)
+    while d:
+        data.append(d)
+        d = sock.recv(65536)
+    return ''.join(data)
+
+
+def start(target, *args):
+    t = threading.Thread(target=target, args=args)
+    t.daemon = True
+    t.start()
+    return t
+
+
+class HTTPTunnelRelayTest(unittest.TestCase):
+    """ Tunnels between the inner ends of socketpairs, driven from their outer ends. """
+    def setUp(self):
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+
+    def pair(self):
+        self.socks.extend(socket.socketpair())
+        return self.socks[-2:]
+
+    def exchange(self, a, b, up, down):
+        """ Sends up from a and down from b, each ending its side, and returns what both got. """
+        got = {}
+
+        def send(sock, data):
+            sock.sendall(data)
+            sock.shutdown(socket.SHUT_WR)
+        threads = [start(send, a, up), start(send, b, down)]
+        got[b] = read_all(b)
+        got[a] = read_all(a)
+        for t in threads:
+            t.join()
+        return got[b], got[a]
+
+    def test_many_tunnels_are_relayed_both_ways(self):
+        relay = HTTPTunnelRelay(buffer_size=4096)
+        ends = []
+        for i in range(3):
+            a, inner_a = self.pair()
+            b, inner_b = self.pair()
+            ends.append((a, b, relay.add(inner_a, inner_b)))
+        runner = start(relay.run)
+        for i, (a, b, t) in enumerate(ends):
+            up = ("up%d" % i) * 10000
+            down = ("down%d" % i) * 100
+            self.assertEqual(self.exchange(a, b, up, down), (up, down))
+        runner.join(5)
+        self.assertFalse(runner.is_alive())
+        for i, (a, b, t) in enumerate(ends):
+            self.assertTrue(t.done.done())
+            self.assertIsNone(t.error)
+            self.assertEqual((t.bytes_up, t.bytes_down), (30000, 500))
+        self.assertEqual(relay.bytes_relayed, 3 * 30500)
+        relay.loop.close()
+
+    def test_tunnel_forwards_buffered_data_and_keeps_timeouts(self):
+        a, inner_a = self.pair()
+        b, inner_b = self.pair()
+        inner_b.settimeout(9)
+        a.sendall("CONNECT x:443 HTTP/1.1\r\n\r\nearly")
+        ios = HTTPIOStream(inner_a, HTTPAddress("x", 443), read_timeout=7)
+        self.assertEqual(ios.read_request().method, "CONNECT")
+        self.assertEqual(ios.rdbuf, "early")
+        result = []
+        runner = start(lambda: result.append(HTTPTunnel([ios, inner_b]).run()))
+        self.assertEqual(self.exchange(a, b, "late", "back"), ("earlylate", "back"))
+        runner.join(5)
+        self.assertEqual(result, [(9, 4)])
+        self.assertEqual((inner_a.gettimeout(), inner_b.gettimeout()), (7, 9))
+
+
+if __name__ == "__main__":
+    unittest.main()
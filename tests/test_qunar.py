@@ -0,0 +1,109 @@
+import os
+import copy
+import json
+import threading
+import unittest
+import SocketServer
+import BaseHTTPServer
+
+import httpfetch
+from qunar import fetch
+
+SAMPLE = json.load(open(os.path.join(os.path.dirname(fetch.__file__), "hotel_review.json")))
+
+
+class ReviewHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the sample page, with server.count reviews, as the first 3 pages of reviews. """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        page = int(self.path.rsplit("/", 1)[1])
+        self.server.pages.append(page)
+        d = copy.deepcopy(SAMPLE)
+        d["data"]["count"] = self.server.count
+        if page > 3:
+            d["data"]["list"] = []
+        body = json.dumps(d)
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for i in range(0, len(body), 1024):
+                piece = body[i:i+1024]
+                self.wfile.write("%x\r\n%s\r\n" % (len(piece), piece))
+            self.wfile.write("0\r\n\r\n")
+        except IOError:
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class Site(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), ReviewHandler)
+        self.count = 119
+        self.pages = []
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FetchTest(unittest.TestCase):
+    def setUp(self):
+        self.site = Site()
+        self._api_url = fetch.API_URL
+        fetch.API_URL = "http://127.0.0.1:%d/api/h/%%s/page/%%d" % self.site.server_address[1]
+        fetch._watermarks.clear()
+        fetch._staged.clear()
+        self.times = sorted(item["feedTime"] for item in SAMPLE["data"]["list"])
+
+    def tearDown(self):
+        fetch.API_URL = self._api_url
+        fetch._watermarks.clear()
+        fetch._staged.clear()
+        httpfetch._client.close()
+        self.site.stop()
+
+    def test_first_fetch_reads_page_one(self):
+        records = fetch.fetch(["hotel", "1"])
+        self.assertEqual(len(records), len(SAMPLE["data"]["list"]))
+        self.assertEqual(self.site.pages, [1])
+        self.assertNotIn("1", fetch._watermarks)
+        fetch.commit(["hotel", "1"])
+        self.assertEqual(fetch._watermarks["1"], (119, self.times[-1]))
+
+    def test_uncommitted_fetch_is_fetched_again(self):
+        fetch.fetch(["hotel", "1"])
+        self.assertEqual(len(fetch.fetch(["hotel", "1"])), len(SAMPLE["data"]["list"]))
+        fetch.commit(["hotel", "1"])
+        self.assertEqual(fetch.fetch(["hotel", "1"]), [])
+        # an unchanged page stages nothing, the watermark committed stays
+        fetch.commit(["hotel", "1"])
+        self.assertEqual(fetch._watermarks["1"], (119, self.times[-1]))
+
+    def test_unchanged_count_gives_page_up(self):
+        fetch.fetch(["hotel", "1"])
+        fetch.commit(["hotel", "1"])
+        self.assertEqual(fetch.fetch(["hotel", "1"]), [])
+        # the connection is closed rather than drained and pooled
+        self.assertEqual(sum(len(c) for c in httpfetch._client._idle.values()), 0)
+        self.assertEqual(sum(httpfetch._client._busy.values()), 0)
+
+    def test_pages_are_walked_till_the_growth_is_found(self):
+        fetch._watermarks["1"] = (110, self.times[2])
+        self.assertEqual(len(fetch.fetch(["hotel", "1"])), 20)
+        self.assertEqual(self.site.pages, [1, 2])
+        fetch._watermarks["1"] = (100, self.times[-1])
+        self.assertEqual(len(fetch.fetch(["hotel", "1"])), 30)
+        self.assertEqual(self.site.pages, [1, 2, 1, 2, 3, 4])
+
+
+if __name__ == "__main__":
+    unittest.main()